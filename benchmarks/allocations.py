@@ -0,0 +1,64 @@
+"""
+Measures the time and memory allocated per record when FastCGIConnection.feed_data() processes a
+read containing many request body (FCGI_STDIN) records.
+
+The memory figures come from :mod:`tracemalloc`: "retained" is the number of memory blocks still
+allocated after the call (mostly the returned events and their data) and "peak" is the highest
+amount of memory allocated during the call, both divided by the number of records.
+"""
+from __future__ import print_function
+
+import tracemalloc
+from timeit import default_timer
+
+from fcgiproto import FastCGIConnection, FCGI_RESPONDER
+from fcgiproto.records import FCGIBeginRequest, FCGIParams, FCGIStdin
+
+RECORD_COUNT = 10000
+REPEAT = 20
+
+
+def make_payload(content_size):
+    records = [FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode(), FCGIParams(1, b'').encode()]
+    records.extend(FCGIStdin(1, b'x' * content_size).encode() for _ in range(RECORD_COUNT))
+    return b''.join(records)
+
+
+def measure(payload, **options):
+    best = None
+    for _ in range(REPEAT):
+        conn = FastCGIConnection(**options)
+        start = default_timer()
+        conn.feed_data(payload)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Only the memory allocated after tracing starts is accounted for
+    conn = FastCGIConnection(**options)
+    tracemalloc.start()
+    try:
+        events = conn.feed_data(payload)
+        peak = tracemalloc.get_traced_memory()[1]
+        retained = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    finally:
+        tracemalloc.stop()
+
+    del events
+    return best, retained, peak
+
+
+def main():
+    print('%-14s %8s %16s %20s %16s' % ('mode', 'content', 'per record (us)',
+                                         'retained blocks/rec', 'peak bytes/rec'))
+    for options in ({}, {'zero_copy': True}, {'coalesce_data': True}):
+        mode = ','.join(options) or 'default'
+        for content_size in (16, 1024):
+            payload = make_payload(content_size)
+            elapsed, retained, peak = measure(payload, **options)
+            print('%-14s %8d %16.3f %20.2f %16.1f' % (
+                mode, content_size, elapsed / RECORD_COUNT * 1000000,
+                float(retained) / RECORD_COUNT, float(peak) / RECORD_COUNT))
+
+
+if __name__ == '__main__':
+    main()
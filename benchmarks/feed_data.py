@@ -0,0 +1,48 @@
+"""
+Measures the cost of FastCGIConnection.feed_data() when a single read contains many small records.
+
+The time spent per record should stay roughly constant regardless of how many records are packed
+into one read. A per-record cost that grows with the record count indicates quadratic behavior.
+"""
+from __future__ import print_function
+
+from timeit import default_timer
+
+from fcgiproto import FastCGIConnection, FCGI_RESPONDER
+from fcgiproto.records import FCGIBeginRequest, FCGIParams, FCGIStdin
+
+REPEAT = 20
+
+
+def make_payload(record_count):
+    records = [FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode(), FCGIParams(1, b'').encode()]
+    records.extend(FCGIStdin(1, b'x' * 16).encode() for _ in range(record_count))
+    return b''.join(records)
+
+
+def measure(record_count):
+    payload = make_payload(record_count)
+    best = None
+    for _ in range(REPEAT):
+        conn = FastCGIConnection()
+        start = default_timer()
+        conn.feed_data(payload)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    print('%10s %12s %16s' % ('records', 'total (ms)', 'per record (us)'))
+    baseline = None
+    for record_count in (100, 1000, 10000, 100000):
+        elapsed = measure(record_count)
+        per_record = elapsed / record_count
+        baseline = baseline or per_record
+        print('%10d %12.2f %16.3f  (x%.2f)' % (record_count, elapsed * 1000, per_record * 1000000,
+                                               per_record / baseline))
+
+
+if __name__ == '__main__':
+    main()
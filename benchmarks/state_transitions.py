@@ -0,0 +1,38 @@
+"""
+Measures the cost of a single request state transition (RequestState.receive_record() and
+RequestState.send_record()) for the record types seen most often on a busy connection.
+"""
+from __future__ import print_function
+
+from timeit import repeat
+
+SETUP = '''
+from fcgiproto.constants import FCGI_RESPONDER, FCGI_REQUEST_COMPLETE
+from fcgiproto.records import FCGIStdin, FCGIStdout, FCGIEndRequest
+from fcgiproto.states import RequestState
+
+state = RequestState()
+state.role = FCGI_RESPONDER
+stdin = FCGIStdin(1, b'data')
+stdout = FCGIStdout(1, b'data')
+end_request = FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE)
+'''
+
+BENCHMARKS = [
+    ('receive STDIN', 'state.state = RequestState.EXPECT_STDIN; state.receive_record(stdin)'),
+    ('send STDOUT', 'state.state = RequestState.EXPECT_STDOUT; state.send_record(stdout)'),
+    ('send END_REQUEST',
+     'state.state = RequestState.EXPECT_END_REQUEST; state.send_record(end_request)')
+]
+NUMBER = 200000
+
+
+def main():
+    print('%-20s %12s' % ('transition', 'ns per call'))
+    for name, statement in BENCHMARKS:
+        best = min(repeat(statement, SETUP, number=NUMBER, repeat=7))
+        print('%-20s %12.1f' % (name, best / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import logging
+import os
+
+from fcgiproto.prefork import PreforkServer
+
+
+async def handle_request(request):
+    await request.body.read()
+    response = ('Served by worker %d\n' % os.getpid()).encode('ascii')
+    headers = [
+        (b'Content-Length', str(len(response)).encode('ascii')),
+        (b'Content-Type', b'text/plain; charset=UTF-8')
+    ]
+    request.send_headers(headers, 200)
+    await request.end(response)
+
+
+logging.basicConfig(level=logging.INFO)
+PreforkServer(handle_request, port=9500, reuse_port=True, max_requests=10000).run()
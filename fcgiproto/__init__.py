@@ -1,6 +1,6 @@
-from .connection import FastCGIConnection  # noqa
+from .connection import FastCGIConnection, FileSegment  # noqa
 from .constants import FCGI_RESPONDER, FCGI_AUTHORIZER, FCGI_FILTER  # noqa
 from .events import (  # noqa
     RequestEvent, RequestBeginEvent, RequestAbortEvent, RequestDataEvent,
-    RequestSecondaryDataEvent)
+    RequestSecondaryDataEvent, RequestParams)
 from .exceptions import ProtocolError  # noqa
@@ -0,0 +1,382 @@
+/*
+ * Optional C implementations of the performance critical functions in fcgiproto.records.
+ *
+ * Every function here must behave exactly like its pure Python counterpart.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#define HEADER_SIZE 8
+#define MAX_CONTENT_LENGTH 0xffff
+
+#if PY_MAJOR_VERSION >= 3
+#define PAIR_FORMAT "(y#y#)"
+#else
+#define PAIR_FORMAT "(s#s#)"
+#endif
+
+static PyObject *ProtocolError;
+
+
+static void
+pack_header(unsigned char *header, int record_type, int request_id, Py_ssize_t content_length)
+{
+    header[0] = 1;
+    header[1] = (unsigned char) record_type;
+    header[2] = (unsigned char) (request_id >> 8);
+    header[3] = (unsigned char) request_id;
+    header[4] = (unsigned char) (content_length >> 8);
+    header[5] = (unsigned char) content_length;
+    header[6] = 0;
+    header[7] = 0;
+}
+
+
+/*
+ * Reads a name or value length field. Returns the position after the field, or -1 if there's
+ * not enough data.
+ */
+static Py_ssize_t
+read_length(const unsigned char *data, Py_ssize_t index, Py_ssize_t size, Py_ssize_t *length)
+{
+    if (index < size) {
+        if ((data[index] & 0x80) == 0) {
+            *length = data[index];
+            return index + 1;
+        } else if (size - index >= 4) {
+            *length = ((Py_ssize_t) (data[index] & 0x7f) << 24) | (data[index + 1] << 16) |
+                      (data[index + 2] << 8) | data[index + 3];
+            return index + 4;
+        }
+    }
+
+    return -1;
+}
+
+
+static PyObject *
+unpack_header(PyObject *self, PyObject *args)
+{
+    PyObject *buffer;
+    Py_ssize_t offset;
+    Py_buffer view;
+    const unsigned char *data;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "On:unpack_header", &buffer, &offset))
+        return NULL;
+    if (PyObject_GetBuffer(buffer, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+
+    if (offset < 0 || view.len - offset < HEADER_SIZE) {
+        Py_INCREF(Py_None);
+        result = Py_None;
+    } else {
+        data = (const unsigned char *) view.buf + offset;
+        if (data[0] != 1) {
+            PyErr_Format(ProtocolError, "unexpected protocol version: %d", (int) data[0]);
+        } else {
+            result = Py_BuildValue("(iiii)", (int) data[1], (data[2] << 8) | data[3],
+                                   (data[4] << 8) | data[5], (int) data[6]);
+        }
+    }
+
+    PyBuffer_Release(&view);
+    return result;
+}
+
+
+static PyObject *
+decode_pairs_from(PyObject *self, PyObject *args)
+{
+    PyObject *buffer, *pairs, *pair, *result = NULL;
+    Py_ssize_t offset, position, name_start, value_start, end, name_length, value_length;
+    Py_buffer view;
+    const unsigned char *data;
+
+    if (!PyArg_ParseTuple(args, "On:decode_pairs_from", &buffer, &offset))
+        return NULL;
+    if (PyObject_GetBuffer(buffer, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    if ((pairs = PyList_New(0)) == NULL)
+        goto finally;
+
+    data = (const unsigned char *) view.buf;
+    while (offset < view.len) {
+        if ((position = read_length(data, offset, view.len, &name_length)) < 0)
+            break;
+        if ((name_start = read_length(data, position, view.len, &value_length)) < 0)
+            break;
+
+        /* Compare against the remaining data so the lengths can't overflow when added */
+        if (name_length > view.len - name_start ||
+                value_length > view.len - name_start - name_length)
+            break;
+
+        value_start = name_start + name_length;
+        end = value_start + value_length;
+
+        pair = Py_BuildValue(PAIR_FORMAT, data + name_start, name_length, data + value_start,
+                             value_length);
+        if (pair == NULL || PyList_Append(pairs, pair) < 0) {
+            Py_XDECREF(pair);
+            Py_DECREF(pairs);
+            goto finally;
+        }
+
+        Py_DECREF(pair);
+        offset = end;
+    }
+
+    result = Py_BuildValue("(Nn)", pairs, offset);
+
+finally:
+    PyBuffer_Release(&view);
+    return result;
+}
+
+
+static PyObject *
+scan_pairs_from(PyObject *self, PyObject *args)
+{
+    PyObject *buffer;
+    Py_ssize_t offset, position, name_start, name_length, value_length;
+    Py_buffer view;
+    const unsigned char *data;
+
+    if (!PyArg_ParseTuple(args, "On:scan_pairs_from", &buffer, &offset))
+        return NULL;
+    if (PyObject_GetBuffer(buffer, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+
+    data = (const unsigned char *) view.buf;
+    while (offset < view.len) {
+        if ((position = read_length(data, offset, view.len, &name_length)) < 0)
+            break;
+        if ((name_start = read_length(data, position, view.len, &value_length)) < 0)
+            break;
+
+        /* Compare against the remaining data so the lengths can't overflow when added */
+        if (name_length > view.len - name_start ||
+                value_length > view.len - name_start - name_length)
+            break;
+
+        offset = name_start + name_length + value_length;
+    }
+
+    PyBuffer_Release(&view);
+    return PyLong_FromSsize_t(offset);
+}
+
+
+/* Returns a new reference to the bytestring form of a name or value. */
+static PyObject *
+as_bytes(PyObject *item)
+{
+    if (PyBytes_Check(item)) {
+        Py_INCREF(item);
+        return item;
+    }
+
+    return PyUnicode_AsASCIIString(item);
+}
+
+
+static void
+append_length(char **out, Py_ssize_t length)
+{
+    unsigned char *dest = (unsigned char *) *out;
+
+    if (length < 128) {
+        dest[0] = (unsigned char) length;
+        *out += 1;
+    } else {
+        dest[0] = (unsigned char) ((length >> 24) | 0x80);
+        dest[1] = (unsigned char) (length >> 16);
+        dest[2] = (unsigned char) (length >> 8);
+        dest[3] = (unsigned char) length;
+        *out += 4;
+    }
+}
+
+
+static PyObject *
+encode_name_value_pairs(PyObject *self, PyObject *args)
+{
+    PyObject *pairs, *items = NULL, *encoded = NULL, *result = NULL;
+    PyObject *pair, *name, *value, *fields;
+    Py_ssize_t count, i, total = 0, name_length, value_length;
+    char *out;
+
+    if (!PyArg_ParseTuple(args, "O:encode_name_value_pairs", &pairs))
+        return NULL;
+    if ((items = PySequence_Fast(pairs, "pairs must be iterable")) == NULL)
+        return NULL;
+
+    /* Convert all names and values to bytestrings first to find out the total length */
+    count = PySequence_Fast_GET_SIZE(items);
+    if ((encoded = PyList_New(count * 2)) == NULL)
+        goto finally;
+
+    for (i = 0; i < count; i++) {
+        pair = PySequence_Fast_GET_ITEM(items, i);
+        if ((fields = PySequence_Fast(pair, "each pair must be iterable")) == NULL)
+            goto finally;
+        if (PySequence_Fast_GET_SIZE(fields) != 2) {
+            PyErr_SetString(PyExc_ValueError, "each pair must have exactly two elements");
+            Py_DECREF(fields);
+            goto finally;
+        }
+
+        name = as_bytes(PySequence_Fast_GET_ITEM(fields, 0));
+        value = name ? as_bytes(PySequence_Fast_GET_ITEM(fields, 1)) : NULL;
+        Py_DECREF(fields);
+        if (value == NULL) {
+            Py_XDECREF(name);
+            goto finally;
+        }
+
+        PyList_SET_ITEM(encoded, i * 2, name);
+        PyList_SET_ITEM(encoded, i * 2 + 1, value);
+
+        name_length = PyBytes_GET_SIZE(name);
+        value_length = PyBytes_GET_SIZE(value);
+        total += (name_length < 128 ? 1 : 4) + (value_length < 128 ? 1 : 4);
+        total += name_length + value_length;
+    }
+
+    if ((result = PyBytes_FromStringAndSize(NULL, total)) == NULL)
+        goto finally;
+
+    out = PyBytes_AS_STRING(result);
+    for (i = 0; i < count; i++) {
+        name = PyList_GET_ITEM(encoded, i * 2);
+        value = PyList_GET_ITEM(encoded, i * 2 + 1);
+        name_length = PyBytes_GET_SIZE(name);
+        value_length = PyBytes_GET_SIZE(value);
+        append_length(&out, name_length);
+        append_length(&out, value_length);
+        memcpy(out, PyBytes_AS_STRING(name), name_length);
+        out += name_length;
+        memcpy(out, PyBytes_AS_STRING(value), value_length);
+        out += value_length;
+    }
+
+finally:
+    Py_XDECREF(encoded);
+    Py_DECREF(items);
+    return result;
+}
+
+
+static PyObject *
+frame_records(PyObject *self, PyObject *args)
+{
+    PyObject *data, *parts, *header, *view = NULL, *chunk;
+    int record_type, request_id;
+    Py_ssize_t length, offset, chunk_length;
+
+    if (!PyArg_ParseTuple(args, "iiO:frame_records", &record_type, &request_id, &data))
+        return NULL;
+    if ((length = PyObject_Size(data)) < 0)
+        return NULL;
+
+    if (length <= MAX_CONTENT_LENGTH) {
+        if ((header = PyBytes_FromStringAndSize(NULL, HEADER_SIZE)) == NULL)
+            return NULL;
+        pack_header((unsigned char *) PyBytes_AS_STRING(header), record_type, request_id,
+                    length);
+        return Py_BuildValue("[NO]", header, data);
+    }
+
+    if ((parts = PyList_New(0)) == NULL)
+        return NULL;
+    if ((view = PyMemoryView_FromObject(data)) == NULL)
+        goto error;
+
+    for (offset = 0; offset < length; offset += MAX_CONTENT_LENGTH) {
+        chunk_length = length - offset;
+        if (chunk_length > MAX_CONTENT_LENGTH)
+            chunk_length = MAX_CONTENT_LENGTH;
+
+        if ((header = PyBytes_FromStringAndSize(NULL, HEADER_SIZE)) == NULL)
+            goto error;
+        pack_header((unsigned char *) PyBytes_AS_STRING(header), record_type, request_id,
+                    chunk_length);
+        if (PyList_Append(parts, header) < 0) {
+            Py_DECREF(header);
+            goto error;
+        }
+        Py_DECREF(header);
+
+        if ((chunk = PySequence_GetSlice(view, offset, offset + chunk_length)) == NULL)
+            goto error;
+        if (PyList_Append(parts, chunk) < 0) {
+            Py_DECREF(chunk);
+            goto error;
+        }
+        Py_DECREF(chunk);
+    }
+
+    Py_DECREF(view);
+    return parts;
+
+error:
+    Py_XDECREF(view);
+    Py_DECREF(parts);
+    return NULL;
+}
+
+
+static PyMethodDef speedups_methods[] = {
+    {"unpack_header", unpack_header, METH_VARARGS,
+     "Decode a record header from the given position in a buffer."},
+    {"decode_pairs_from", decode_pairs_from, METH_VARARGS,
+     "Decode complete name-value pairs from the given position in a buffer."},
+    {"scan_pairs_from", scan_pairs_from, METH_VARARGS,
+     "Find the end of the complete name-value pairs from the given position in a buffer."},
+    {"encode_name_value_pairs", encode_name_value_pairs, METH_VARARGS,
+     "Encode a list of name-pair values into a binary form that FCGI understands."},
+    {"frame_records", frame_records, METH_VARARGS,
+     "Encode a stream of data into records of the given type, splitting it as necessary."},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static int
+load_protocol_error(void)
+{
+    PyObject *module = PyImport_ImportModule("fcgiproto.exceptions");
+
+    if (module == NULL)
+        return -1;
+
+    ProtocolError = PyObject_GetAttrString(module, "ProtocolError");
+    Py_DECREF(module);
+    return ProtocolError == NULL ? -1 : 0;
+}
+
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT, "fcgiproto._speedups", NULL, -1, speedups_methods
+};
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    if (load_protocol_error() < 0)
+        return NULL;
+
+    return PyModule_Create(&speedups_module);
+}
+#else
+PyMODINIT_FUNC
+init_speedups(void)
+{
+    if (load_protocol_error() < 0)
+        return;
+
+    Py_InitModule("fcgiproto._speedups", speedups_methods);
+}
+#endif
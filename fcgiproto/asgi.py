@@ -0,0 +1,152 @@
+"""
+ASGI adapter for the :mod:`fcgiproto.asyncio` server.
+
+This module requires Python 3.5 or later.
+"""
+import asyncio
+from urllib.parse import unquote_to_bytes
+
+from fcgiproto.asyncio import start_server
+
+
+class ASGIAdapter(object):
+    """
+    Request handler that runs an ASGI (version 3) application.
+
+    Pass an instance of this class as the handler to :func:`fcgiproto.asyncio.start_server`, or
+    use :func:`start_asgi_server`. The HTTP connection scope is built from the FastCGI parameters
+    of each request. The request body is passed on to the application in ``http.request``
+    messages as it arrives, and each ``http.response.body`` message is sent right away as response
+    body data.
+
+    Only the ``http`` scope type is supported.
+
+    :param app: an ASGI application
+    :param str root_path: the root path the application is mounted at
+
+    """
+
+    __slots__ = ('app', 'root_path')
+
+    def __init__(self, app, root_path=''):
+        self.app = app
+        self.root_path = root_path
+
+    def build_scope(self, request):
+        """
+        Build the ASGI HTTP connection scope for the given request.
+
+        :param request: a :class:`~fcgiproto.asyncio.FastCGIRequest`
+        :rtype: dict
+
+        """
+        params = request.params
+        headers = []
+        for name, value in params.raw_items():
+            if name.startswith(b'HTTP_'):
+                headers.append((name[5:].lower().replace(b'_', b'-'), value))
+            elif name in (b'CONTENT_TYPE', b'CONTENT_LENGTH') and value:
+                headers.append((name.lower().replace(b'_', b'-'), value))
+
+        request_uri = params.get_bytes('REQUEST_URI')
+        if request_uri is not None:
+            raw_path = request_uri.partition(b'?')[0]
+        else:
+            raw_path = params.get_bytes('SCRIPT_NAME', b'') + params.get_bytes('PATH_INFO', b'')
+
+        https = params.get('HTTPS', '').lower() in ('on', '1')
+        server_protocol = params.get('SERVER_PROTOCOL', 'HTTP/1.1')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.1'},
+            'http_version': server_protocol.partition('/')[2] or '1.1',
+            'method': params.get('REQUEST_METHOD', 'GET'),
+            'scheme': params.get('REQUEST_SCHEME') or ('https' if https else 'http'),
+            'path': unquote_to_bytes(raw_path).decode('utf-8', errors='replace'),
+            'raw_path': raw_path,
+            'query_string': params.get_bytes('QUERY_STRING') or b'',
+            'root_path': self.root_path,
+            'headers': headers,
+            'client': None,
+            'server': None
+        }
+        if 'REMOTE_ADDR' in params:
+            scope['client'] = (params['REMOTE_ADDR'], int(params.get('REMOTE_PORT') or 0))
+        if 'SERVER_PORT' in params:
+            server_host = params.get('SERVER_ADDR') or params.get('SERVER_NAME', '')
+            scope['server'] = (server_host, int(params['SERVER_PORT']))
+
+        return scope
+
+    async def __call__(self, request):
+        response_start = None
+        unread_body = None
+        request_complete = response_complete = False
+        disconnected = asyncio.Event()
+
+        async def receive():
+            nonlocal unread_body, request_complete
+            if unread_body is not None:
+                data, unread_body = unread_body, None
+                request_complete = True
+                return {'type': 'http.request', 'body': data, 'more_body': False}
+            elif request_complete:
+                # There won't be any more messages until the response is complete
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            data = await request.body.read(65536)
+            request_complete = request.body.at_eof
+            return {'type': 'http.request', 'body': data, 'more_body': not request_complete}
+
+        async def send(message):
+            nonlocal response_start, unread_body, response_complete
+            message_type = message['type']
+            if message_type == 'http.response.start':
+                if response_start is not None:
+                    raise RuntimeError('the response has already been started')
+
+                response_start = message
+            elif message_type == 'http.response.body':
+                if response_start is None:
+                    raise RuntimeError('http.response.start must be sent before the body')
+                elif response_complete:
+                    raise RuntimeError('the response has already been completed')
+
+                if not request.headers_sent:
+                    # FastCGI doesn't allow responding before the request body has been received,
+                    # so read the rest of it in advance
+                    if not request_complete:
+                        unread_body = await request.body.read()
+
+                    request.send_headers(response_start.get('headers', ()),
+                                         response_start['status'])
+
+                body = message.get('body', b'')
+                if message.get('more_body', False):
+                    if body:
+                        await request.write(body)
+                else:
+                    response_complete = True
+                    disconnected.set()
+                    await request.end(body)
+            else:
+                raise ValueError('unexpected ASGI message type: %s' % message_type)
+
+        await self.app(self.build_scope(request), receive, send)
+        if not response_complete:
+            raise RuntimeError('the ASGI application returned without completing the response')
+
+
+async def start_asgi_server(app, host=None, port=None, *, root_path='', **kwargs):
+    """
+    Start a FastCGI server that runs the given ASGI application.
+
+    :param app: an ASGI application
+    :param str root_path: the root path the application is mounted at
+    :param kwargs: other keyword arguments passed to :func:`fcgiproto.asyncio.start_server`
+    :return: the server object
+    :rtype: asyncio.Server
+
+    """
+    return await start_server(ASGIAdapter(app, root_path), host, port, **kwargs)
@@ -0,0 +1,435 @@
+"""
+FastCGI server implementation for :mod:`asyncio`.
+
+This module requires Python 3.5 or later. On Python 3.7 and later, incoming data is read directly
+into the connection's buffer using the :class:`asyncio.BufferedProtocol` interface.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from fcgiproto.connection import FastCGIConnection
+from fcgiproto.constants import FCGI_AUTHORIZER, FCGI_FILTER
+from fcgiproto.events import (
+    RequestBeginEvent, RequestDataEvent, RequestSecondaryDataEvent, RequestAbortEvent)
+
+logger = logging.getLogger(__name__)
+
+BaseProtocol = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+
+class RequestStream(object):
+    """
+    A stream of incoming data (the request body or the secondary data stream) of a request.
+
+    The stream can also be iterated over asynchronously, yielding chunks of data as they arrive.
+    """
+
+    __slots__ = ('_request', '_chunks', '_eof', '_exception', '_waiter')
+
+    def __init__(self, request):
+        self._request = request
+        self._chunks = deque()
+        self._eof = False
+        self._exception = None
+        self._waiter = None
+
+    @property
+    def at_eof(self):
+        """``True`` if the stream has ended and all of its data has been read."""
+        return self._eof and not self._chunks
+
+    def _feed(self, data):
+        if data:
+            self._chunks.append(data)
+        else:
+            self._eof = True
+
+        self._wake_up()
+
+    def _abort(self, exception):
+        # Makes all further reads that would have to wait for data raise the given exception
+        self._exception = exception
+        self._wake_up(exception)
+
+    def _wake_up(self, exception=None):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            if exception is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exception)
+
+    async def _wait(self):
+        while not self._chunks and not self._eof:
+            if self._exception is not None:
+                raise self._exception
+
+            self._waiter = self._request._protocol._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+    async def read(self, n=-1):
+        """
+        Read data from the stream.
+
+        :param int n: the maximum number of bytes to read, or -1 to read until the end of the
+            stream
+        :return: the data (an empty bytestring at the end of the stream)
+        :rtype: bytes
+
+        """
+        protocol = self._request._protocol
+        if n < 0:
+            # Acknowledge each chunk as it's taken, as the connection stops reading once too much
+            # data is left unacknowledged and then the end of the stream would never arrive
+            chunks = []
+            while True:
+                while self._chunks:
+                    chunk = self._chunks.popleft()
+                    chunks.append(chunk)
+                    protocol._acknowledge(self._request.request_id, len(chunk))
+
+                if self._eof:
+                    break
+
+                await self._wait()
+
+            return b''.join(chunks)
+
+        await self._wait()
+        if not self._chunks:
+            return b''
+
+        data = self._chunks.popleft()
+        if len(data) > n:
+            self._chunks.appendleft(data[n:])
+            data = data[:n]
+
+        protocol._acknowledge(self._request.request_id, len(data))
+        return bytes(data)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self._wait()
+        if not self._chunks:
+            raise StopAsyncIteration
+
+        data = bytes(self._chunks.popleft())
+        self._request._protocol._acknowledge(self._request.request_id, len(data))
+        return data
+
+
+class FastCGIRequest(object):
+    """
+    Represents a single FastCGI request being processed by a request handler.
+
+    :ivar int request_id: identifier of the request
+    :ivar int role: expected role of the application for the request
+    :ivar params: FCGI parameters of the request
+    :vartype params: ~fcgiproto.RequestParams
+    :ivar bool keep_connection: ``True`` if the web server keeps the connection open after the
+        request
+    :ivar RequestStream body: the request body
+    :ivar RequestStream secondary_data: the secondary data stream (only for the filter role)
+    """
+
+    __slots__ = ('request_id', 'role', 'params', 'keep_connection', 'body', 'secondary_data',
+                 '_protocol', '_task', '_headers_sent', '_finished', '_aborted')
+
+    def __init__(self, protocol, event):
+        self.request_id = event.request_id
+        self.role = event.role
+        self.params = event.params
+        self.keep_connection = bool(event.keep_connection)
+        self.body = RequestStream(self)
+        self.secondary_data = RequestStream(self)
+        self._protocol = protocol
+        self._task = None
+        self._headers_sent = False
+        self._finished = False
+        self._aborted = False
+        if self.role == FCGI_AUTHORIZER:
+            self.body._eof = True
+        if self.role != FCGI_FILTER:
+            self.secondary_data._eof = True
+
+    @property
+    def headers_sent(self):
+        """``True`` if the response headers have been sent."""
+        return self._headers_sent
+
+    def send_headers(self, headers, status=None):
+        """
+        Send the response headers.
+
+        :param headers: an iterable of (key, value) tuples of bytestrings
+        :param int status: the response status code, if not 200
+
+        """
+        self._protocol._conn.send_headers(self.request_id, headers, status)
+        self._headers_sent = True
+        self._protocol._schedule_flush()
+
+    async def write(self, data):
+        """
+        Send response body data.
+
+        This waits until the connection is ready to accept more data, if necessary.
+
+        :param data: response body data
+        :type data: bytes, bytearray or memoryview
+
+        """
+        if self._protocol._closed:
+            raise ConnectionResetError('connection lost')
+
+        self._protocol._conn.send_data(self.request_id, data)
+        await self._protocol._drain()
+
+    def write_stderr(self, data):
+        """
+        Send error output (see :meth:`~fcgiproto.FastCGIConnection.send_stderr`).
+
+        :param data: error output
+        :type data: bytes, bytearray or memoryview
+
+        """
+        self._protocol._conn.send_stderr(self.request_id, data)
+
+    async def end(self, data=b''):
+        """
+        Finish the request.
+
+        :param data: optional final piece of response body data
+
+        """
+        if self._protocol._closed:
+            raise ConnectionResetError('connection lost')
+
+        if not self._finished:
+            # Only mark the request finished once the end of it has been successfully queued
+            self._protocol._conn.send_data(self.request_id, data, end_request=True)
+            self._finished = True
+            self._protocol._request_finished(self)
+            await self._protocol._drain()
+
+
+class FastCGIProtocol(BaseProtocol):
+    """
+    An :mod:`asyncio` protocol that serves FastCGI requests.
+
+    Each request is processed by calling the handler in a new task, so several requests
+    multiplexed on the same connection are processed concurrently. The handler receives a
+    :class:`FastCGIRequest` as its only argument. If the handler returns without finishing the
+    request, it is finished automatically. If the handler raises an exception before sending any
+    headers, a response with status 500 is sent; if it raises one afterwards, the connection is
+    aborted so that the web server doesn't mistake the partial response for a complete one. If
+    the web server aborts the request, the task is cancelled and the request is finished once the
+    handler exits. A handler cancelled for any other reason leaves the request unfinished.
+
+    :param handler: a coroutine function that takes a :class:`FastCGIRequest`
+    :param connection_options: keyword arguments passed to
+        :class:`~fcgiproto.FastCGIConnection`
+
+    """
+
+    def __init__(self, handler, **connection_options):
+        self.handler = handler
+        self.transport = None
+        self._conn = FastCGIConnection(**connection_options)
+        self._loop = None
+        self._requests = {}
+        self._flush_scheduled = False
+        self._reading_paused = False
+        self._writing_paused = False
+        self._drain_waiters = deque()
+        self._closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._loop = asyncio.get_event_loop()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._conn.close()
+        for request in list(self._requests.values()):
+            request._task.cancel()
+            request.body._abort(ConnectionResetError('connection lost'))
+            request.secondary_data._abort(ConnectionResetError('connection lost'))
+
+        self._requests.clear()
+        self._wake_drain_waiters(ConnectionResetError('connection lost'))
+
+    def get_buffer(self, sizehint):
+        return self._conn.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self._process_events(self._conn.buffer_updated, nbytes)
+
+    def data_received(self, data):
+        self._process_events(self._conn.feed_data, data)
+
+    def _process_events(self, func, arg):
+        try:
+            events = func(arg)
+        except Exception:
+            logger.exception('Error processing incoming data')
+            self.transport.abort()
+            return
+
+        for event in events:
+            if isinstance(event, RequestDataEvent):
+                self._requests[event.request_id].body._feed(event.data)
+            elif isinstance(event, RequestBeginEvent):
+                request = FastCGIRequest(self, event)
+                self._requests[event.request_id] = request
+                request._task = self._loop.create_task(self._run_handler(request))
+            elif isinstance(event, RequestSecondaryDataEvent):
+                self._requests[event.request_id].secondary_data._feed(event.data)
+            elif isinstance(event, RequestAbortEvent):
+                request = self._requests.get(event.request_id)
+                if request is not None:
+                    request._aborted = True
+                    request._task.cancel()
+                    request.body._abort(ConnectionAbortedError('the request was aborted'))
+                    request.secondary_data._abort(
+                        ConnectionAbortedError('the request was aborted'))
+
+        if self._conn.should_pause_reading and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+        self._flush()
+
+    async def _run_handler(self, request):
+        try:
+            await self.handler(request)
+        except asyncio.CancelledError:
+            if not request._aborted:
+                # Cancelled for some other reason than the web server aborting the request
+                raise
+
+            if not self._closed and not request._finished:
+                request._finished = True
+                self._conn.end_request(request.request_id)
+                self._request_finished(request)
+                self._schedule_flush()
+        except Exception:
+            logger.exception('Error in request handler')
+            if not request._finished and not self._closed:
+                await self._finish(request, failed=True)
+        else:
+            if not request._finished and not self._closed:
+                await self._finish(request, failed=False)
+
+    async def _finish(self, request, failed):
+        if failed and request.headers_sent:
+            # Ending the request normally would make the web server accept the partial response
+            # as complete, so drop the connection instead
+            self.transport.abort()
+            return
+
+        # The request can only be finished once the incoming data streams have ended
+        await request.body.read()
+        await request.secondary_data.read()
+
+        if failed and not request.headers_sent:
+            request.send_headers([(b'Content-Type', b'text/plain')], 500)
+            await request.end(b'Internal Server Error')
+        else:
+            await request.end()
+
+    def _request_finished(self, request):
+        del self._requests[request.request_id]
+        if not request.keep_connection:
+            # The web server expects the connection to be closed after the response
+            self._flush()
+            self.transport.close()
+
+    def _acknowledge(self, request_id, nbytes):
+        self._conn.acknowledge_data(request_id, nbytes)
+        if self._reading_paused and not self._conn.should_pause_reading:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._conn.pending_bytes and not self.transport.is_closing():
+            self.transport.writelines(self._conn.buffers_to_send())
+
+    async def _drain(self):
+        if self._conn.is_writable:
+            self._schedule_flush()
+        else:
+            self._flush()
+
+        if self._writing_paused and not self._closed:
+            waiter = self._loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._wake_drain_waiters()
+
+    def _wake_drain_waiters(self, exception=None):
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                if exception is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exception)
+
+
+async def start_server(handler, host=None, port=None, *, path=None, connection_options=None,
+                       stats_registry=None, **kwargs):
+    """
+    Start a FastCGI server.
+
+    The server listens either on a TCP port or, if ``path`` is given, a UNIX domain socket.
+
+    :param handler: a coroutine function that takes a :class:`FastCGIRequest`
+    :param str host: the interface to listen on
+    :param int port: the TCP port to listen on
+    :param str path: the file system path of a UNIX domain socket to listen on
+    :param dict connection_options: keyword arguments passed to
+        :class:`~fcgiproto.FastCGIConnection`
+    :param stats_registry: a :class:`~fcgiproto.stats.StatsRegistry` to collect the statistics of
+        every connection in (this cannot be combined with a ``stats`` connection option)
+    :param kwargs: extra keyword arguments passed to :meth:`~asyncio.loop.create_server` or
+        :meth:`~asyncio.loop.create_unix_server`
+    :return: the server object
+    :rtype: asyncio.Server
+
+    """
+    connection_options = dict(connection_options or {})
+    if stats_registry is not None and 'stats' in connection_options:
+        raise ValueError('stats_registry and the "stats" connection option are mutually '
+                         'exclusive')
+
+    def protocol_factory():
+        if stats_registry is not None:
+            connection_options['stats'] = stats_registry.connection_stats()
+
+        return FastCGIProtocol(handler, **connection_options)
+
+    loop = asyncio.get_event_loop()
+
+    if path is not None:
+        return await loop.create_unix_server(protocol_factory, path, **kwargs)
+    else:
+        return await loop.create_server(protocol_factory, host, port, **kwargs)
@@ -1,15 +1,117 @@
-from collections import defaultdict
+import os
+from collections import deque
 
 from fcgiproto.constants import (
-    FCGI_REQUEST_COMPLETE, FCGI_GET_VALUES, FCGI_RESPONDER, FCGI_BEGIN_REQUEST, FCGI_UNKNOWN_ROLE)
+    FCGI_REQUEST_COMPLETE, FCGI_GET_VALUES, FCGI_RESPONDER, FCGI_BEGIN_REQUEST, FCGI_UNKNOWN_ROLE,
+    FCGI_STDOUT, FCGI_STDERR, FCGI_STDIN, FCGI_DATA, FCGI_ABORT_REQUEST, FCGI_END_REQUEST)
 from fcgiproto.records import (
-    FCGIStdout, FCGIEndRequest, FCGIGetValuesResult, FCGIUnknownType, decode_record)
-from fcgiproto.states import RequestState
+    FCGIStdout, FCGIStderr, FCGIEndRequest, FCGIGetValuesResult, FCGIUnknownType,
+    decode_record_from, frame_records, headers_struct, max_content_length, to_bytes,
+    unpack_header)
+from fcgiproto.states import RequestState, idle_request_state
+from fcgiproto.stats import (
+    EVENTS, GET_VALUES_QUERIES, PEAK_INPUT_BUFFER, PEAK_OUTPUT_BUFFER, PEAK_UNACKNOWLEDGED,
+    REQUESTS_ABORTED, REQUESTS_COMPLETED, REQUESTS_REJECTED, REQUESTS_STARTED, RequestTimeline,
+    clock)
+
+#: outgoing data shorter than this is copied into a shared buffer instead of being queued by
+#: reference, to keep the number of segments returned from ``buffers_to_send()`` low
+max_coalesced_size = 1024
+
+#: default size of the buffer returned from ``get_buffer()``
+default_receive_size = 65536
+
+#: the maximum number of finished request states kept by each connection for reuse
+state_pool_size = 16
+
+#: the amount of data (in bytes) a request gets to send on its turn when the output of several
+#: requests is interleaved, multiplied by the priority of the request
+scheduling_quantum = 65536
+
+data_record_types = frozenset([FCGI_STDIN, FCGI_DATA])
+
+pread = getattr(os, 'pread', None)
+
+
+class OutputQueue(object):
+    """Queue of outgoing records of a single request."""
+
+    __slots__ = ('request_id', 'priority', 'items', 'head', 'tail')
+
+    def __init__(self, request_id, priority):
+        self.request_id = request_id
+        self.priority = priority
+        # Each item is either a bytearray containing whole records, or a tuple of a bytearray
+        # ending with the header of a record and the content of that record, so the output of
+        # different requests can be interleaved between any two items
+        self.items = []
+        # Index of the first item not yet retrieved; the retrieved items are only deleted once
+        # they make up half of the list, to keep draining the queue in small steps linear
+        self.head = 0
+        self.tail = None
+
+
+class FileSegment(object):
+    """
+    A range of bytes in a file, queued for sending by :meth:`FastCGIConnection.send_file`.
+
+    The length of a segment (``len(segment)``) is the number of bytes in the range.
+
+    :ivar int fd: the file descriptor
+    :ivar int offset: the position in the file where the range starts
+    :ivar int count: the number of bytes in the range
+    """
+
+    __slots__ = ('fd', 'offset', 'count')
+
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return '%s(fd=%d, offset=%d, count=%d)' % (self.__class__.__name__, self.fd, self.offset,
+                                                   self.count)
+
+    def read(self):
+        """
+        Read the contents of the range from the file.
+
+        The current position of the file descriptor is not used, but it may be changed on
+        platforms lacking :func:`os.pread`.
+
+        :raise IOError: if the file ends before the end of the range
+        :rtype: bytes
+
+        """
+        chunks = []
+        offset = self.offset
+        remaining = self.count
+        while remaining:
+            if pread is not None:
+                chunk = pread(self.fd, remaining, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                chunk = os.read(self.fd, remaining)
+
+            if not chunk:
+                raise IOError('file ended %d bytes short of the segment end' % remaining)
+
+            chunks.append(chunk)
+            offset += len(chunk)
+            remaining -= len(chunk)
+
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
 
 
 class FastCGIConnection(object):
     """
-    FastCGIConnection(roles=(FCGI_RESPONDER,), fcgi_values=None)
+    FastCGIConnection(roles=(FCGI_RESPONDER,), fcgi_values=None, zero_copy=False, \
+        coalesce_data=False, write_high_water=65536, write_low_water=16384, \
+        read_high_water=1048576, read_low_water=262144, stats=None, timeline_callback=None)
 
     FastCGI connection state machine.
 
@@ -17,21 +119,128 @@ class FastCGIConnection(object):
         ``FCGI_FILTER``)
     :param dict fcgi_values: dictionary of FastCGI management values (see the
         `FastCGI specification`_ for a list); keys and values must be unicode strings
+    :param bool zero_copy: ``True`` to deliver request body data as :class:`memoryview` slices of
+        the received data instead of copying it into new bytestrings (see
+        :ref:`zero-copy-mode`)
+    :param bool coalesce_data: ``True`` to merge all the request body (or secondary) data of each
+        request received in a single call to :meth:`.feed_data` into a single event
+    :param int write_high_water: when the amount of outgoing data waiting to be retrieved exceeds
+        this many bytes, the connection stops being writable (see :ref:`flow-control`)
+    :param int write_low_water: the connection becomes writable again once the amount of waiting
+        outgoing data drops to this many bytes or less
+    :param int read_high_water: when the amount of received request body data not yet
+        acknowledged by the application exceeds this many bytes, the I/O layer should stop
+        reading from the connection
+    :param int read_low_water: reading can be resumed once the amount of unacknowledged request
+        body data drops to this many bytes or less
+    :param stats: a :class:`~fcgiproto.stats.ConnectionStats` to count the connection's activity
+        in (see :ref:`statistics`)
+    :param timeline_callback: a callable that is called as ``timeline_callback(request_id,
+        timeline)`` with a :class:`~fcgiproto.stats.RequestTimeline` when each request finishes
+        (see :ref:`request-timelines`)
 
     .. _FastCGI specification: https://htmlpreview.github.io/?https://github.com/FastCGI-Archives/\
         FastCGI.com/blob/master/docs/FastCGI%20Specification.html
 
     """
 
-    __slots__ = ('roles', 'fcgi_values', '_input_buffer', '_output_buffer', '_request_states')
+    __slots__ = ('roles', 'fcgi_values', 'zero_copy', 'coalesce_data', 'write_high_water',
+                 'write_low_water', 'read_high_water', 'read_low_water', 'stats',
+                 'timeline_callback', '_input_buffer', '_input_size', '_reading_paused',
+                 '_output_queues', '_scheduled', '_output_size', '_writing_paused',
+                 '_receive_buffer', '_request_states', '_state_pool')
+
+    def __init__(self, roles=(FCGI_RESPONDER,), fcgi_values=None, zero_copy=False,
+                 coalesce_data=False, write_high_water=65536, write_low_water=16384,
+                 read_high_water=1048576, read_low_water=262144, stats=None,
+                 timeline_callback=None):
+        if write_low_water > write_high_water:
+            raise ValueError('write_low_water must not be greater than write_high_water')
+        if read_low_water > read_high_water:
+            raise ValueError('read_low_water must not be greater than read_high_water')
 
-    def __init__(self, roles=(FCGI_RESPONDER,), fcgi_values=None):
         self.roles = frozenset(roles)
         self.fcgi_values = fcgi_values or {}
         self.fcgi_values.setdefault(u'FCGI_MPXS_CONNS', u'1')
+        self.zero_copy = zero_copy
+        self.coalesce_data = coalesce_data
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        self.read_high_water = read_high_water
+        self.read_low_water = read_low_water
+        self.stats = stats
+        self.timeline_callback = timeline_callback
         self._input_buffer = bytearray()
-        self._output_buffer = bytearray()
-        self._request_states = defaultdict(RequestState)
+        self._input_size = 0
+        self._reading_paused = False
+        self._receive_buffer = None
+        self._output_queues = {}
+        self._scheduled = deque()
+        self._output_size = 0
+        self._writing_paused = False
+        self._request_states = {}
+        self._state_pool = []
+
+    @property
+    def pending_bytes(self):
+        """The number of outgoing bytes waiting to be retrieved using :meth:`.data_to_send`."""
+        return self._output_size
+
+    @property
+    def is_writable(self):
+        """
+        ``False`` if the application should stop sending response data until the pending outgoing
+        data has been retrieved and sent.
+
+        """
+        return not self._writing_paused
+
+    @property
+    def should_pause_reading(self):
+        """
+        ``True`` if the I/O layer should stop reading from the connection until the application
+        has acknowledged enough of the received request body data using
+        :meth:`.acknowledge_data`.
+
+        """
+        return self._reading_paused
+
+    def unacknowledged_bytes(self, request_id=None):
+        """
+        Return the amount of request body data delivered in events but not yet acknowledged.
+
+        :param int request_id: identifier of the request, or ``None`` for the total of all
+            requests on the connection
+        :rtype: int
+
+        """
+        if request_id is None:
+            return self._input_size
+
+        request_state = self._request_states.get(request_id)
+        return request_state.unacknowledged if request_state is not None else 0
+
+    def acknowledge_data(self, request_id, nbytes):
+        """
+        Acknowledge that the application has consumed request body data of the given request.
+
+        Both request body (``FCGI_STDIN``) and secondary (``FCGI_DATA``) data are counted.
+        Acknowledging data of a request that has already finished or been aborted is allowed and
+        has no effect, as is acknowledging more data than has been received.
+
+        :param int request_id: identifier of the request
+        :param int nbytes: the number of bytes consumed
+
+        """
+        request_state = self._request_states.get(request_id)
+        if request_state is not None:
+            self._release_input(request_state, min(nbytes, request_state.unacknowledged))
+
+    def _release_input(self, request_state, nbytes):
+        request_state.unacknowledged -= nbytes
+        self._input_size -= nbytes
+        if self._reading_paused and self._input_size <= self.read_low_water:
+            self._reading_paused = False
 
     def feed_data(self, data):
         """
@@ -49,28 +258,234 @@ class FastCGIConnection(object):
         :rtype: list
 
         """
-        self._input_buffer.extend(data)
+        if self.zero_copy and not isinstance(data, bytes):
+            # Event data will refer to the buffer, so it must never change afterwards
+            data = to_bytes(data)
+
+        return self._process_input(data)
+
+    def get_buffer(self, sizehint=-1):
+        """
+        Return a buffer for receiving incoming data into.
+
+        This, together with :meth:`.buffer_updated`, lets the I/O layer receive data directly into
+        memory owned by the connection, instead of allocating a new bytestring for every read. The
+        method signatures match those of :class:`asyncio.BufferedProtocol`, so they can simply be
+        delegated to. With plain sockets, this can be used with :meth:`~socket.socket.recv_into`::
+
+            nbytes = sock.recv_into(conn.get_buffer())
+            events = conn.buffer_updated(nbytes)
+
+        The buffer is reused for subsequent reads, except in zero-copy mode where a new one is
+        allocated each time since the events refer to the data in it.
+
+        :param int sizehint: the minimum size of the buffer (negative or zero for the default)
+        :return: a writable buffer
+        :rtype: memoryview
+
+        """
+        size = max(sizehint, default_receive_size)
+        if self.zero_copy or self._receive_buffer is None or len(self._receive_buffer) < size:
+            self._receive_buffer = bytearray(size)
+
+        return memoryview(self._receive_buffer)
+
+    def buffer_updated(self, nbytes):
+        """
+        Process data written to the buffer returned from :meth:`.get_buffer`.
+
+        This works exactly like :meth:`.feed_data` otherwise.
+
+        :param int nbytes: the number of bytes written to the start of the buffer
+        :raise fcgiproto.ProtocolError: if the protocol is violated
+        :return: the list of generated FastCGI events
+        :rtype: list
+
+        """
+        return self._process_input(memoryview(self._receive_buffer)[:nbytes])
+
+    def _process_input(self, data):
+        input_buffer = self._input_buffer
+        start = 0
         events = []
-        while True:
-            record = decode_record(self._input_buffer)
-            if record is None:
+        coalesced = {} if self.coalesce_data else None  # request ID -> data chunks
+        merged_events = []
+        if input_buffer:
+            # Complete the partial record left over from the previous call by moving over only the
+            # bytes it's missing; the rest of the new data is decoded in place
+            start = self._complete_partial_record(data)
+            if start < 0:
+                if self.stats is not None:
+                    self.stats.update_peak(PEAK_INPUT_BUFFER, len(input_buffer))
+
                 return events
 
-            if record.request_id:
-                request_state = self._request_states[record.request_id]
-                event = request_state.receive_record(record)
-                if record.record_type == FCGI_BEGIN_REQUEST and record.role not in self.roles:
-                    # Reject requests where the role isn't among our set of allowed roles
-                    self._send_record(FCGIEndRequest(record.request_id, 0, FCGI_UNKNOWN_ROLE))
-                elif event is not None:
-                    events.append(event)
+            if self.zero_copy:
+                buffer = memoryview(bytes(input_buffer))
+                del input_buffer[:]
             else:
-                if record.record_type == FCGI_GET_VALUES:
-                    pairs = [(key, self.fcgi_values[key]) for key in record.keys
-                             if key in self.fcgi_values]
-                    self._send_record(FCGIGetValuesResult(pairs))
+                buffer = input_buffer
+
+            try:
+                self._decode_records(buffer, 0, events, coalesced, merged_events)
+            except Exception:
+                input_buffer.extend(data[start:])
+                raise
+
+        self._decode_records(memoryview(data) if self.zero_copy else data, start, events,
+                             coalesced, merged_events)
+        for event, chunks in merged_events:
+            if len(chunks) > 1:
+                event.data = b''.join(chunks)
+
+        if self._input_size > self.read_high_water:
+            self._reading_paused = True
+
+        if self.stats is not None:
+            self.stats.counters[EVENTS] += len(events)
+            self.stats.update_peak(PEAK_INPUT_BUFFER, len(input_buffer))
+            self.stats.update_peak(PEAK_UNACKNOWLEDGED, self._input_size)
+
+        return events
+
+    def _complete_partial_record(self, data):
+        # Returns the number of bytes taken from data, or -1 if the record is still incomplete
+        input_buffer = self._input_buffer
+        taken = 0
+        if len(input_buffer) < headers_struct.size:
+            taken = headers_struct.size - len(input_buffer)
+            input_buffer.extend(data[:taken])
+            if len(input_buffer) < headers_struct.size:
+                return -1
+
+        content_length, padding_length = unpack_header(input_buffer, 0)[2:]
+        missing = headers_struct.size + content_length + padding_length - len(input_buffer)
+        input_buffer.extend(data[taken:taken + missing])
+        taken += missing
+        return taken if taken <= len(data) else -1
+
+    def _decode_records(self, buffer, offset, events, coalesced, merged_events):
+        # Records are decoded by advancing a cursor through the buffer and the consumed data is
+        # discarded only once at the end, so the cost stays linear in the number of records
+        copy = not self.zero_copy
+        stats = self.stats
+        size = len(buffer)
+        try:
+            while True:
+                header = unpack_header(buffer, offset)
+                if header is None:
+                    break
+
+                record_type, request_id, content_length, padding_length = header
+                content_start = offset + headers_struct.size
+                content_end = content_start + content_length
+                if size < content_end + padding_length:
+                    break
+
+                if stats is not None:
+                    stats.record_received(record_type, content_end + padding_length - offset)
+
+                if record_type in data_record_types:
+                    # Fast path for request body data which skips creating a record object
+                    content = buffer[content_start:content_end]
+                    if copy:
+                        content = to_bytes(content)
+
+                    request_state = self._request_states.get(request_id, idle_request_state)
+                    event = request_state.receive_data(record_type, request_id, content)
+                    if event is None:
+                        # This raises the appropriate protocol error
+                        request_state.receive_record(decode_record_from(buffer, offset)[0])
+
+                    offset = content_end + padding_length
+                    request_state.unacknowledged += content_length
+                    self._input_size += content_length
+                    if coalesced is not None:
+                        # Append the data to the previous event of the same stream, if any
+                        chunks = coalesced.get(request_id)
+                        if not content:
+                            coalesced.pop(request_id, None)
+                        elif chunks is not None:
+                            chunks.append(content)
+                            continue
+                        else:
+                            chunks = coalesced[request_id] = [content]
+                            merged_events.append((event, chunks))
+
+                    events.append(event)
+                    continue
+
+                record, offset = decode_record_from(buffer, offset, copy)
+                if record.request_id:
+                    request_state = self._request_states.get(record.request_id)
+                    if request_state is None:
+                        if record.record_type == FCGI_BEGIN_REQUEST:
+                            request_state = self._add_request_state(record.request_id)
+                        else:
+                            # This raises the appropriate protocol error
+                            request_state = idle_request_state
+
+                    event = request_state.receive_record(record)
+                    if record.record_type == FCGI_BEGIN_REQUEST:
+                        if record.role not in self.roles:
+                            # Reject requests where the role isn't among our set of allowed roles
+                            self._send_record(FCGIEndRequest(record.request_id, 0,
+                                                             FCGI_UNKNOWN_ROLE))
+                        else:
+                            if stats is not None:
+                                stats.counters[REQUESTS_STARTED] += 1
+                            if self.timeline_callback is not None:
+                                request_state.timeline = RequestTimeline(clock())
+                    elif event is not None:
+                        if record.record_type == FCGI_ABORT_REQUEST:
+                            # The application is expected to discard any data it still holds
+                            self._release_input(request_state, request_state.unacknowledged)
+                            if stats is not None:
+                                stats.counters[REQUESTS_ABORTED] += 1
+
+                        events.append(event)
                 else:
-                    self._send_record(FCGIUnknownType(record.record_type))
+                    if record.record_type == FCGI_GET_VALUES:
+                        if stats is not None:
+                            stats.counters[GET_VALUES_QUERIES] += 1
+
+                        pairs = [(key, self.fcgi_values[key]) for key in record.keys
+                                 if key in self.fcgi_values]
+                        self._send_record(FCGIGetValuesResult(pairs))
+                    else:
+                        self._send_record(FCGIUnknownType(record.record_type))
+        finally:
+            if buffer is self._input_buffer:
+                del buffer[:offset]
+            elif offset < size:
+                # Keep the trailing partial record for the next call
+                self._input_buffer.extend(buffer[offset:])
+
+    def close(self):
+        """
+        Release the resources held by the connection.
+
+        This should be called when the underlying transport has been closed. Any unfinished
+        requests and queued outgoing data are discarded.
+
+        :return: the identifiers of the requests that were unfinished
+        :rtype: list
+
+        """
+        request_ids = list(self._request_states)
+        for request_id in request_ids:
+            self._remove_request_state(request_id)
+
+        self._input_buffer = bytearray()
+        self._receive_buffer = None
+        self._output_queues.clear()
+        self._scheduled.clear()
+        self._output_size = 0
+        self._writing_paused = False
+        if self.stats is not None:
+            self.stats.close()
+
+        return request_ids
 
     def data_to_send(self):
         """
@@ -79,9 +494,120 @@ class FastCGIConnection(object):
         :rtype: bytes
 
         """
-        data = bytes(self._output_buffer)
-        del self._output_buffer[:]
-        return data
+        buffers = self.buffers_to_send()
+        if bytes is str:  # pragma: no cover
+            # Python 2's str.join() does not accept bytearrays or memoryviews
+            buffers = [to_bytes(buffer) for buffer in buffers]
+
+        return b''.join(buffers)
+
+    def buffers_to_send(self, max_bytes=None):
+        """
+        Return any data that is due to be sent to the other end as a list of buffers.
+
+        This is an alternative to :meth:`.data_to_send` that avoids copying the data into a single
+        bytestring. The returned list can be passed directly to functions like
+        :func:`os.writev`, :meth:`socket.socket.sendmsg` or
+        :meth:`asyncio.WriteTransport.writelines`.
+
+        Larger chunks of response data are returned as the very objects (or memoryview slices of
+        them) that were passed to :meth:`.send_data`. File contents queued with
+        :meth:`.send_file` are read into memory.
+
+        :param int max_bytes: if given, return at most this many bytes (but always at least one
+            buffer, as buffers are never split) and leave the rest of the data for later calls
+        :return: a list of bytes-like objects
+        :rtype: list
+
+        """
+        return self._take_output(max_bytes, True)
+
+    def output_plan(self, max_bytes=None):
+        """
+        Return any data that is due to be sent to the other end as a list of buffers and file
+        segments.
+
+        This works like :meth:`.buffers_to_send`, except that file contents queued with
+        :meth:`.send_file` are returned as :class:`~fcgiproto.FileSegment` objects instead of
+        being read into memory. The I/O layer is expected to write the other buffers as is and the
+        file segments using :func:`os.sendfile` or a similar mechanism, in the order they appear
+        in the list.
+
+        :param int max_bytes: if given, return at most this many bytes (but always at least one
+            item, as items are never split) and leave the rest of the data for later calls
+        :return: a list of bytes-like objects and :class:`~fcgiproto.FileSegment` objects
+        :rtype: list
+
+        """
+        return self._take_output(max_bytes, False)
+
+    def _take_output(self, max_bytes, read_files):
+        if max_bytes is None:
+            max_bytes = self._output_size
+
+        # Requests with queued output take turns in round-robin order, each sending (roughly) up to
+        # its share of data on each turn. The queues are only updated once everything has been
+        # collected, so that failing to read a file leaves all the queued output intact.
+        buffers = []
+        scheduled = deque(self._scheduled)
+        heads = {}  # queue -> index of the first item not taken
+        size = 0
+        exhausted = False
+        while scheduled and not exhausted:
+            queue = scheduled[0]
+            items = queue.items
+            head = heads.get(queue, queue.head)
+            quantum = queue.priority * scheduling_quantum
+            served = 0
+            while head < len(items):
+                item = items[head]
+                if item.__class__ is tuple:
+                    length = len(item[0]) + len(item[1])
+                else:
+                    length = len(item)
+
+                if served >= quantum:
+                    break
+                elif size + length > max_bytes and buffers:
+                    exhausted = True
+                    break
+
+                if item.__class__ is tuple:
+                    header, content = item
+                    if read_files and content.__class__ is FileSegment:
+                        content = content.read()
+
+                    buffers.append(header)
+                    buffers.append(content)
+                else:
+                    buffers.append(item)
+
+                size += length
+                served += length
+                head += 1
+
+            heads[queue] = head
+            if head == len(items):
+                scheduled.popleft()
+            elif not exhausted:
+                scheduled.rotate(-1)
+
+        for queue, head in heads.items():
+            if head == len(queue.items):
+                queue.tail = None
+                del self._output_queues[queue.request_id]
+            elif head * 2 >= len(queue.items):
+                del queue.items[:head]
+                head = 0
+
+            queue.head = head
+
+        self._scheduled = scheduled
+        self._output_size -= size
+        if self._writing_paused and self._output_size <= self.write_low_water:
+            self._writing_paused = False
+
+        return buffers
 
     def send_headers(self, request_id, headers, status=None):
         """
@@ -111,8 +637,7 @@ class FastCGIConnection(object):
             payload.extend(key + b': ' + value + b'\r\n')
 
         payload.extend(b'\r\n')
-        record = FCGIStdout(request_id, payload)
-        self._send_record(record)
+        self._send_stdout(request_id, payload)
 
     def send_data(self, request_id, data, end_request=False):
         """
@@ -120,17 +645,113 @@ class FastCGIConnection(object):
 
         This method may be called several times before :meth:`.end_request`.
 
+        Data of any length is accepted. Anything longer than the maximum record size (65535 bytes)
+        is split into several records which refer to the original object through memoryviews
+        instead of copying it, so mutable objects (like ``bytearray``) must not be modified until
+        the data has been retrieved using :meth:`.data_to_send`.
+
         :param int request_id: identifier of the request
-        :param bytes data: request body data
+        :param data: response body data
+        :type data: bytes, bytearray or memoryview
         :param bool end_request: ``True`` to finish the request
         :raise fcgiproto.ProtocolError: if the protocol is violated
+        :return: the value of :attr:`.is_writable` after queuing the data
+        :rtype: bool
 
         """
-        self._send_record(FCGIStdout(request_id, data))
+        if data or not end_request:
+            self._send_stdout(request_id, data)
+
         if end_request:
             self._send_record(FCGIStdout(request_id, b''))
             self._send_record(FCGIEndRequest(request_id, 0, FCGI_REQUEST_COMPLETE))
 
+        return not self._writing_paused
+
+    def send_stderr(self, request_id, data, flush=False):
+        """
+        Send error output (such as log messages) for the given request.
+
+        To keep the number of records low, the data is buffered and sent along with the next
+        response headers or data, or when the request is finished, unless ``flush`` is ``True``.
+        The error stream is terminated automatically when the request is finished.
+
+        :param int request_id: identifier of the request
+        :param data: error output
+        :type data: bytes, bytearray or memoryview
+        :param bool flush: ``True`` to queue all the buffered error output for sending right away
+        :raise fcgiproto.ProtocolError: if the protocol is violated
+
+        """
+        request_state = self._request_states.get(request_id, idle_request_state)
+        request_state.send_record(FCGIStderr(request_id, data))
+        if data:
+            if request_state.stderr_buffer is None:
+                request_state.stderr_buffer = bytearray(data)
+            else:
+                request_state.stderr_buffer += data
+
+        if flush or len(request_state.stderr_buffer or b'') >= max_content_length:
+            self._flush_stderr(request_id, request_state)
+
+    def send_file(self, request_id, fd, offset, count, end_request=False):
+        """
+        Send a range of bytes from a file as response body data for the given request.
+
+        The file contents are not read here. Instead, the range is queued as a number of
+        :class:`~fcgiproto.FileSegment` objects (one per record) which the I/O layer can send
+        using :func:`os.sendfile` after retrieving them with :meth:`.output_plan`. The file
+        descriptor must remain open, and the range unchanged, until the segments have been sent.
+
+        :param int request_id: identifier of the request
+        :param int fd: a file descriptor
+        :param int offset: the position in the file where the data starts
+        :param int count: the number of bytes to send
+        :param bool end_request: ``True`` to finish the request
+        :raise fcgiproto.ProtocolError: if the protocol is violated
+        :return: the value of :attr:`.is_writable` after queuing the data
+        :rtype: bool
+
+        """
+        if count:
+            parts = []
+            for position in range(offset, offset + count, max_content_length):
+                segment = FileSegment(fd, position, min(offset + count - position,
+                                                        max_content_length))
+                parts.append(headers_struct.pack(1, FCGI_STDOUT, request_id, segment.count, 0))
+                parts.append(segment)
+
+            self._send_record(FCGIStdout(request_id, FileSegment(fd, offset, count)), parts)
+
+        if end_request:
+            self._send_record(FCGIStdout(request_id, b''))
+            self._send_record(FCGIEndRequest(request_id, 0, FCGI_REQUEST_COMPLETE))
+
+        return not self._writing_paused
+
+    def set_priority(self, request_id, priority):
+        """
+        Set the priority of the given request's output.
+
+        When several requests have output waiting to be sent, they take turns in sending it, and
+        on each turn a request gets to send an amount of data proportional to its priority. This
+        keeps large responses from delaying smaller ones sent on the same connection.
+
+        :param int request_id: identifier of the request
+        :param int priority: a positive integer (the default priority is 1)
+
+        """
+        if priority < 1:
+            raise ValueError('priority must be a positive integer')
+
+        request_state = self._request_states.get(request_id)
+        if request_state is not None:
+            request_state.priority = priority
+
+        queue = self._output_queues.get(request_id)
+        if queue is not None:
+            queue.priority = priority
+
     def end_request(self, request_id):
         """
         Mark the given request finished.
@@ -141,11 +762,99 @@ class FastCGIConnection(object):
         """
         self._send_record(FCGIEndRequest(request_id, 0, FCGI_REQUEST_COMPLETE))
 
-    def _send_record(self, record):
+    def _send_stdout(self, request_id, data):
+        record = FCGIStdout(request_id, data)
+        if len(data) >= max_coalesced_size:
+            # Queue larger data by reference; the state only needs to be checked once for the
+            # whole stream of records if the data has to be split
+            self._send_record(record, frame_records(FCGI_STDOUT, request_id, data))
+        else:
+            self._send_record(record)
+
+    def _flush_stderr(self, request_id, request_state):
+        data = request_state.stderr_buffer
+        if data:
+            # The buffer is queued as is, so replace it with a new one
+            request_state.stderr_buffer = bytearray()
+            if len(data) >= max_coalesced_size:
+                self._queue_record(request_id, FCGIStderr(request_id, data),
+                                   frame_records(FCGI_STDERR, request_id, data))
+            else:
+                self._queue_record(request_id, FCGIStderr(request_id, data))
+
+    def _send_record(self, record, parts=None):
         if record.request_id:
-            request_state = self._request_states[record.request_id]
+            request_state = self._request_states.get(record.request_id, idle_request_state)
             request_state.send_record(record)
-            if request_state.state == RequestState.FINISHED:
-                del self._request_states[record.request_id]
+            if request_state.stderr_buffer is not None:
+                # Send any buffered error output ahead of the record
+                self._flush_stderr(record.request_id, request_state)
+                if record.record_type == FCGI_END_REQUEST:
+                    self._queue_record(record.request_id, FCGIStderr(record.request_id, b''))
 
-        self._output_buffer.extend(record.encode())
+            self._queue_record(record.request_id, record, parts)
+            if request_state.state == RequestState.FINISHED:
+                timeline = request_state.timeline
+                self._remove_request_state(record.request_id)
+                if self.stats is not None:
+                    if record.protocol_status == FCGI_REQUEST_COMPLETE:
+                        self.stats.counters[REQUESTS_COMPLETED] += 1
+                    else:
+                        self.stats.counters[REQUESTS_REJECTED] += 1
+                if timeline is not None:
+                    self.timeline_callback(record.request_id, timeline)
+        else:
+            self._queue_record(0, record, parts)
+
+    def _add_request_state(self, request_id):
+        request_state = self._state_pool.pop() if self._state_pool else RequestState()
+        self._request_states[request_id] = request_state
+        return request_state
+
+    def _remove_request_state(self, request_id):
+        request_state = self._request_states.pop(request_id)
+        if request_state.unacknowledged:
+            self._release_input(request_state, request_state.unacknowledged)
+
+        if len(self._state_pool) < state_pool_size:
+            request_state.reset()
+            self._state_pool.append(request_state)
+
+    def _queue_record(self, request_id, record, parts=None):
+        queue = self._output_queues.get(request_id)
+        if queue is None:
+            request_state = self._request_states.get(request_id)
+            priority = request_state.priority if request_state is not None else 1
+            queue = self._output_queues[request_id] = OutputQueue(request_id, priority)
+            self._scheduled.append(queue)
+
+        output_size = self._output_size
+        if parts is None:
+            # Encode small records directly into the shared buffer at the end of the queue
+            tail = queue.tail
+            if tail is None or len(tail) >= scheduling_quantum:
+                tail = queue.tail = bytearray()
+                queue.items.append(tail)
+
+            self._output_size += record.encode_into(tail)
+        else:
+            for part in parts:
+                length = len(part)
+                self._output_size += length
+                if length >= max_coalesced_size or part.__class__ is FileSegment:
+                    # The header of the record was written at the end of the last item
+                    queue.items[-1] = (queue.items[-1], part)
+                    queue.tail = None
+                elif queue.tail is not None:
+                    queue.tail += part
+                elif part:
+                    queue.tail = bytearray(part)
+                    queue.items.append(queue.tail)
+
+        if self.stats is not None:
+            self.stats.records_sent(record.record_type, 1 if parts is None else len(parts) // 2,
+                                    self._output_size - output_size)
+            self.stats.update_peak(PEAK_OUTPUT_BUFFER, self._output_size)
+
+        if self._output_size > self.write_high_water:
+            self._writing_paused = True
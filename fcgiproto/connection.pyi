@@ -1,37 +1,164 @@
 from typing import Dict
 from typing import List, Iterable, Tuple, Any
-from typing import Set
+from typing import Set, Deque
+from typing import Union, Optional, Callable
 
 from fcgiproto.constants import FCGI_RESPONDER
 from fcgiproto.events import RequestEvent
 from fcgiproto.records import FCGIRecord
 from fcgiproto.states import RequestState
+from fcgiproto.stats import ConnectionStats, RequestTimeline
+
+
+pread = None  # type: Optional[Callable[[int, int, int], bytes]]
+
+
+class FileSegment:
+    def __init__(self, fd: int, offset: int, count: int) -> None:
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def __len__(self) -> int:
+        ...
+
+    def read(self) -> bytes:
+        ...
+
+
+class OutputQueue:
+    def __init__(self, request_id: int, priority: int) -> None:
+        self.request_id = request_id
+        self.priority = priority
+        self.items = None  # type: List[Union[bytearray, Tuple[bytearray, Any]]]
+        self.head = None  # type: int
+        self.tail = None  # type: bytearray
 
 
 class FastCGIConnection:
     def __init__(self, roles: Iterable[int] = (FCGI_RESPONDER,),
-                 fcgi_values: Dict[str, str] = None) -> None:
+                 fcgi_values: Dict[str, str] = None, zero_copy: bool = False,
+                 coalesce_data: bool = False, write_high_water: int = 65536,
+                 write_low_water: int = 16384, read_high_water: int = 1048576,
+                 read_low_water: int = 262144, stats: ConnectionStats = None,
+                 timeline_callback: Callable[[int, RequestTimeline], Any] = None) -> None:
         self.roles = None  # type: Set[int]
         self.fcgi_values = None  # type: Dict[str, str]
+        self.zero_copy = None  # type: bool
+        self.coalesce_data = None  # type: bool
+        self.write_high_water = None  # type: int
+        self.write_low_water = None  # type: int
+        self.read_high_water = None  # type: int
+        self.read_low_water = None  # type: int
+        self.stats = None  # type: Optional[ConnectionStats]
+        self.timeline_callback = None  # type: Optional[Callable[[int, RequestTimeline], Any]]
         self._input_buffer = None  # type: bytearray
-        self._output_buffer = None  # type: bytearray
+        self._input_size = None  # type: int
+        self._reading_paused = None  # type: bool
+        self._receive_buffer = None  # type: bytearray
+        self._output_queues = None  # type: Dict[int, OutputQueue]
+        self._scheduled = None  # type: Deque[OutputQueue]
+        self._output_size = None  # type: int
+        self._writing_paused = None  # type: bool
         self._request_states = None  # type: Dict[int, RequestState]
+        self._state_pool = None  # type: List[RequestState]
+
+    @property
+    def pending_bytes(self) -> int:
+        ...
+
+    @property
+    def is_writable(self) -> bool:
+        ...
+
+    @property
+    def should_pause_reading(self) -> bool:
+        ...
+
+    def unacknowledged_bytes(self, request_id: int = None) -> int:
+        ...
+
+    def acknowledge_data(self, request_id: int, nbytes: int) -> None:
+        ...
+
+    def _release_input(self, request_state: RequestState, nbytes: int) -> None:
+        ...
 
     def feed_data(self, data: bytes) -> List[RequestEvent]:
         ...
 
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        ...
+
+    def buffer_updated(self, nbytes: int) -> List[RequestEvent]:
+        ...
+
+    def _process_input(self, data: Union[bytes, bytearray, memoryview]) -> List[RequestEvent]:
+        ...
+
+    def _complete_partial_record(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        ...
+
+    def _decode_records(self, buffer: Union[bytes, bytearray, memoryview], offset: int,
+                        events: List[RequestEvent], coalesced: Optional[Dict[int, List[Any]]],
+                        merged_events: List[Tuple[RequestEvent, List[Any]]]) -> None:
+        ...
+
+    def close(self) -> List[int]:
+        ...
+
     def data_to_send(self) -> bytes:
         ...
 
+    def buffers_to_send(self, max_bytes: int = None) -> List[Union[bytes, bytearray, memoryview]]:
+        ...
+
+    def output_plan(self, max_bytes: int = None) -> List[Union[bytes, bytearray, memoryview,
+                                                              FileSegment]]:
+        ...
+
+    def _take_output(self, max_bytes: Optional[int],
+                     read_files: bool) -> List[Union[bytes, bytearray, memoryview, FileSegment]]:
+        ...
+
     def send_headers(self, request_id: int, headers: Iterable[Tuple[bytes, bytes]],
                      status: int = None) -> None:
         ...
 
-    def send_data(self, request_id: int, data: bytes, end_request: bool = False) -> None:
+    def send_data(self, request_id: int, data: Union[bytes, bytearray, memoryview],
+                  end_request: bool = False) -> bool:
+        ...
+
+    def send_file(self, request_id: int, fd: int, offset: int, count: int,
+                  end_request: bool = False) -> bool:
+        ...
+
+    def send_stderr(self, request_id: int, data: Union[bytes, bytearray, memoryview],
+                    flush: bool = False) -> None:
+        ...
+
+    def set_priority(self, request_id: int, priority: int) -> None:
         ...
 
     def end_request(self, request_id: int) -> None:
         ...
 
-    def _send_record(self, record: FCGIRecord) -> None:
+    def _send_stdout(self, request_id: int, data: Union[bytes, bytearray, memoryview]) -> None:
+        ...
+
+    def _flush_stderr(self, request_id: int, request_state: RequestState) -> None:
+        ...
+
+    def _send_record(self, record: FCGIRecord,
+                     parts: List[Union[bytes, bytearray, memoryview]] = None) -> None:
+        ...
+
+    def _add_request_state(self, request_id: int) -> RequestState:
+        ...
+
+    def _remove_request_state(self, request_id: int) -> None:
+        ...
+
+    def _queue_record(self, request_id: int, record: FCGIRecord,
+                      parts: List[Union[bytes, bytearray, memoryview]] = None) -> None:
         ...
@@ -1,6 +1,128 @@
 from collections import OrderedDict
 
 from fcgiproto.constants import FCGI_KEEP_CONN
+from fcgiproto.records import decode_pairs_from
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+
+class RequestParams(Mapping):
+    """
+    Read-only mapping of FastCGI request parameters.
+
+    Names and values are stored as bytestrings. Values are decoded to unicode strings (as UTF-8)
+    only when they're looked up, so parameters the application never reads cost nothing to
+    decode. Keys are unicode strings like in a regular dictionary.
+
+    Applications that prefer to work with bytestrings can use :meth:`get_bytes` and
+    :meth:`raw_items` which never decode anything to unicode.
+
+    :param pairs: an iterable of (name, value) tuples; names are encoded as ASCII and values as
+        UTF-8 if they're unicode strings
+    """
+
+    __slots__ = ('_encoded', '_pairs')
+
+    def __init__(self, pairs=()):
+        self._encoded = None
+        self._pairs = OrderedDict(
+            (name if isinstance(name, bytes) else name.encode('ascii'),
+             value if isinstance(value, bytes) else value.encode('utf-8'))
+            for name, value in pairs)
+
+    @classmethod
+    def from_encoded(cls, data):
+        """
+        Create a mapping from an encoded name-value pair list, without decoding it yet.
+
+        :param bytes data: a complete FastCGI name-value pair list (as checked by
+            :func:`~fcgiproto.records.scan_pairs_from`)
+        :rtype: RequestParams
+
+        """
+        params = cls.__new__(cls)
+        params._encoded = data
+        params._pairs = None
+        return params
+
+    @classmethod
+    def from_raw_pairs(cls, pairs):
+        """
+        Create a mapping that takes over an already decoded dictionary of parameters.
+
+        :param ~collections.OrderedDict pairs: a dictionary of bytestring names to bytestring
+            values; it's used as is, so it must not be modified afterwards
+        :rtype: RequestParams
+
+        """
+        params = cls.__new__(cls)
+        params._encoded = None
+        params._pairs = pairs
+        return params
+
+    @property
+    def _raw(self):
+        if self._pairs is None:
+            self._pairs = OrderedDict(decode_pairs_from(self._encoded, 0)[0])
+            self._encoded = None
+
+        return self._pairs
+
+    @staticmethod
+    def _encode_name(name):
+        if isinstance(name, bytes):
+            return name
+
+        try:
+            return name.encode('ascii')
+        except UnicodeEncodeError:
+            raise KeyError(name)
+
+    def get_bytes(self, name, default=None):
+        """
+        Return the raw value of the named parameter.
+
+        :param name: name of the parameter (a unicode string or bytestring)
+        :param default: value to return if the parameter is not present
+        :return: the value as a bytestring, or ``default``
+
+        """
+        try:
+            return self._raw.get(self._encode_name(name), default)
+        except KeyError:
+            return default
+
+    def raw_items(self):
+        """
+        Return the parameters without decoding them.
+
+        :return: a list of (name, value) tuples where both elements are bytestrings
+        :rtype: list
+
+        """
+        return list(self._raw.items())
+
+    def __getitem__(self, name):
+        return self._raw[self._encode_name(name)].decode('utf-8')
+
+    def __contains__(self, name):
+        try:
+            return self._encode_name(name) in self._raw
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        for name in self._raw:
+            yield name.decode('ascii')
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.raw_items())
 
 
 class RequestEvent(object):
@@ -23,7 +145,9 @@ class RequestBeginEvent(RequestEvent):
     :ivar int request_id: identifier of the request
     :ivar int role: expected role of the application for the request
         one of (``FCGI_RESPONDER``, ``FCGI_AUTHORIZER``, ``FCGI_FILTER``)
-    :ivar dict params: FCGI parameters for the request
+    :ivar params: FCGI parameters for the request (if given as anything other than a
+        :class:`~fcgiproto.RequestParams`, they're converted into one)
+    :vartype params: ~fcgiproto.RequestParams
     """
 
     __slots__ = ('role', 'keep_connection', 'params')
@@ -32,7 +156,7 @@ class RequestBeginEvent(RequestEvent):
         super(RequestBeginEvent, self).__init__(request_id)
         self.role = role
         self.keep_connection = flags & FCGI_KEEP_CONN
-        self.params = OrderedDict(params)
+        self.params = params if isinstance(params, RequestParams) else RequestParams(params)
 
 
 class RequestDataEvent(RequestEvent):
@@ -42,13 +166,15 @@ class RequestDataEvent(RequestEvent):
     An empty ``data`` argument signifies the end of the data stream.
 
     :ivar int request_id: identifier of the request
-    :ivar bytes data: bytestring containing raw request data
+    :ivar bytes data: bytestring containing raw request data (a :class:`memoryview` if the
+        connection is in zero-copy mode)
     """
 
     __slots__ = ('data',)
 
     def __init__(self, request_id, data):
-        super(RequestDataEvent, self).__init__(request_id)
+        # Not calling the superclass constructor saves a function call for every STDIN record
+        self.request_id = request_id
         self.data = data
 
 
@@ -61,13 +187,15 @@ class RequestSecondaryDataEvent(RequestEvent):
     These events are only received for the ``FCGI_FILTER`` role.
 
     :ivar int request_id: identifier of the request
-    :ivar bytes data: bytestring containing raw secondary data
+    :ivar bytes data: bytestring containing raw secondary data (a :class:`memoryview` if the
+        connection is in zero-copy mode)
     """
 
     __slots__ = ('data',)
 
     def __init__(self, request_id, data):
-        super(RequestSecondaryDataEvent, self).__init__(request_id)
+        # Not calling the superclass constructor saves a function call for every DATA record
+        self.request_id = request_id
         self.data = data
 
 
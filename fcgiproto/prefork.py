@@ -0,0 +1,438 @@
+"""
+Pre-forking multi-process runner for the :mod:`fcgiproto.asyncio` server.
+
+A supervisor process creates the listening sockets and forks a number of worker processes, each
+running its own event loop. This module requires Python 3.5 or later and a platform with
+:func:`os.fork` (that is, not Windows).
+
+The supervisor responds to the following signals:
+
+* ``SIGTERM``, ``SIGINT``: stop the workers gracefully and exit
+* ``SIGHUP``: graceful reload (start a new set of workers and stop the old ones gracefully)
+"""
+import asyncio
+import logging
+import os
+import select
+import signal
+import socket
+import stat
+import time
+
+from fcgiproto.asyncio import FastCGIProtocol
+
+logger = logging.getLogger(__name__)
+
+#: minimum number of seconds between restarts of workers that exit right after starting
+restart_delay = 1.0
+
+
+def _ignore_signal(signum, frame):
+    pass
+
+
+class WorkerProtocol(FastCGIProtocol):
+    """A :class:`~fcgiproto.asyncio.FastCGIProtocol` that reports to the worker it runs in."""
+
+    def __init__(self, worker, handler, **connection_options):
+        super(WorkerProtocol, self).__init__(handler, **connection_options)
+        self._worker = worker
+        self._requests_served = 0
+        worker.connections.add(self)
+
+    def connection_lost(self, exc):
+        super(WorkerProtocol, self).connection_lost(exc)
+        self._worker.connections.discard(self)
+        self._worker.check_stopped()
+
+    def _request_finished(self, request):
+        super(WorkerProtocol, self)._request_finished(request)
+        self._requests_served += 1
+        self._worker.request_finished()
+        if self._worker.stopping:
+            self.close_if_idle()
+
+    def close_if_idle(self):
+        """Close the connection if it is being kept alive between requests."""
+        # A connection that hasn't served any requests yet may have one on the way, so it's left
+        # open until the request has been finished
+        if (self._requests_served and not self._requests and self.transport is not None and
+                not self._closed):
+            self._flush()
+            self.transport.close()
+
+
+class Worker(object):
+    """
+    Serves requests in a worker process.
+
+    When stopping, the worker stops accepting new connections, closes connections that are kept
+    alive between requests right away and closes the others as soon as their current request has
+    finished.
+    """
+
+    __slots__ = ('server', 'handler', 'sockets', 'connections', 'requests_served', 'stopping',
+                 '_loop', '_servers', '_parent_pid', '_pending_accepts')
+
+    def __init__(self, server, handler, sockets):
+        self.server = server
+        self.handler = handler
+        self.sockets = sockets
+        self.connections = set()
+        self.requests_served = 0
+        self.stopping = False
+        self._loop = None
+        self._servers = []
+        self._parent_pid = os.getppid()
+        self._pending_accepts = 0
+
+    def run(self):
+        self._loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            for sock in self.sockets:
+                server = loop.run_until_complete(loop.create_server(self._create_protocol,
+                                                                    sock=sock))
+                self._servers.append(server)
+
+            # The supervisor forks workers with SIGTERM blocked, so a pending one is only
+            # delivered now
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+            loop.call_later(1, self._check_parent)
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def _create_protocol(self):
+        return WorkerProtocol(self, self.handler, **self.server.connection_options)
+
+    def _check_parent(self):
+        # Stop if the supervisor has died (and this process has been adopted by another one)
+        if os.getppid() != self._parent_pid:
+            self.stop()
+        else:
+            self._loop.call_later(1, self._check_parent)
+
+    def request_finished(self):
+        self.requests_served += 1
+        max_requests = self.server.max_requests
+        if max_requests and self.requests_served >= max_requests:
+            self.stop()
+
+    def stop(self):
+        if self.stopping:
+            return
+
+        self.stopping = True
+        if self.server.reuse_port:
+            for sock in self.sockets:
+                self._accept_queued(sock)
+
+        for server in self._servers:
+            server.close()
+
+        for protocol in list(self.connections):
+            protocol.close_if_idle()
+
+        self._loop.call_later(self.server.graceful_timeout, self._loop.stop)
+        # Let connections that have just been accepted create their protocols first
+        self._loop.call_soon(self.check_stopped)
+
+    def _accept_queued(self, sock):
+        # Each SO_REUSEPORT socket has an accept queue of its own, and the connections left in it
+        # would be reset when the socket is closed
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                break
+
+            self._pending_accepts += 1
+            self._loop.create_task(self._serve_accepted(conn))
+
+    async def _serve_accepted(self, conn):
+        try:
+            await self._loop.connect_accepted_socket(self._create_protocol, conn)
+        finally:
+            self._pending_accepts -= 1
+            self.check_stopped()
+
+    def check_stopped(self):
+        if self.stopping and not self.connections and not self._pending_accepts:
+            self._loop.stop()
+
+
+class PreforkServer(object):
+    """
+    Runs a FastCGI server in several worker processes.
+
+    By default, the supervisor creates the listening sockets and all the workers accept
+    connections from the same sockets. With ``reuse_port=True``, each worker instead listens on a
+    socket of its own bound to the same address with ``SO_REUSEPORT``, letting the kernel
+    distribute the incoming connections evenly between the workers (Linux 3.9+, BSD).
+
+    Workers that exit are replaced by new ones. With ``max_requests`` set, each worker exits
+    gracefully after serving that many requests, which limits the effects of memory leaks in the
+    application.
+
+    Sending ``SIGHUP`` to the supervisor replaces all the workers gracefully. A handler given
+    directly has been imported in the supervisor, so the new workers keep running the same code.
+    To pick up changes to the application, pass ``handler_factory`` instead: it's called in each
+    worker after it has been forked, so the application can be imported there.
+
+    :param handler: a coroutine function that takes a
+        :class:`~fcgiproto.asyncio.FastCGIRequest`
+    :param str host: the interface to listen on
+    :param int port: the TCP port to listen on
+    :param str path: the file system path of a UNIX domain socket to listen on
+    :param sockets: already listening sockets to use instead of creating new ones
+    :param int workers: the number of worker processes (defaults to the number of CPUs)
+    :param bool reuse_port: ``True`` to give each worker its own TCP socket using
+        ``SO_REUSEPORT``
+    :param int max_requests: the number of requests after which a worker is replaced (0 = never)
+    :param float graceful_timeout: the maximum number of seconds a stopping worker waits for
+        requests in progress to finish
+    :param int backlog: the maximum number of queued connections
+    :param dict connection_options: keyword arguments passed to
+        :class:`~fcgiproto.FastCGIConnection`
+    :param handler_factory: a callable that returns the handler, called in each worker process
+        (can be given instead of ``handler``)
+
+    """
+
+    def __init__(self, handler=None, host=None, port=None, *, path=None, sockets=None,
+                 workers=None, reuse_port=False, max_requests=0, graceful_timeout=30,
+                 backlog=100, connection_options=None, handler_factory=None):
+        if (handler is None) == (handler_factory is None):
+            raise ValueError('exactly one of handler and handler_factory must be given')
+        if sockets is None and path is None and port is None:
+            raise ValueError('either port, path or sockets must be given')
+        if reuse_port and (sockets is not None or path is not None):
+            raise ValueError('reuse_port can only be used with TCP sockets created by the server')
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported on this platform')
+
+        self.handler = handler
+        self.handler_factory = handler_factory
+        self.host = host
+        self.port = port
+        self.path = path
+        self.sockets = list(sockets) if sockets is not None else None
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.connection_options = connection_options or {}
+        self._worker_pids = {}  # pid -> (generation, start time)
+        self._generation = 0
+        self._stopping = False
+        self._spawn_after = 0
+
+    @property
+    def addresses(self):
+        """The addresses of the listening sockets (only available after :meth:`listen`)."""
+        return [sock.getsockname() for sock in self.sockets or ()]
+
+    def listen(self):
+        """
+        Create the listening sockets.
+
+        This is done automatically by :meth:`run`, but can be called beforehand to find out which
+        port was assigned if the server was created with ``port=0``.
+
+        """
+        if self.sockets is not None:
+            return
+
+        if self.path is not None:
+            # Remove a stale socket left behind by an earlier run
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.path)
+            sock.listen(self.backlog)
+            self.sockets = [sock]
+        else:
+            self.sockets = []
+            infos = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC,
+                                       socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
+            for family, type_, proto, _, address in infos:
+                sock = self._create_tcp_socket(family, type_, proto, address)
+                if not self.reuse_port:
+                    # The sockets of the supervisor only reserve the address in the reuse_port
+                    # mode, so they must not accept connections
+                    sock.listen(self.backlog)
+
+                self.sockets.append(sock)
+
+        for sock in self.sockets:
+            sock.setblocking(False)
+
+    def _create_tcp_socket(self, family, type_, proto, address):
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+
+            sock.bind(address)
+        except BaseException:
+            sock.close()
+            raise
+
+        return sock
+
+    def run(self):
+        """
+        Run the supervisor until it is stopped with ``SIGTERM`` or ``SIGINT``.
+
+        This must be called from the main thread.
+
+        """
+        self.listen()
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        old_wakeup_fd = signal.set_wakeup_fd(wakeup_write)
+        old_handlers = {signum: signal.signal(signum, _ignore_signal)
+                        for signum in (signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM,
+                                       signal.SIGINT)}
+        self._stopping = False
+        stop_deadline = None
+        try:
+            self._spawn_workers()
+            while self._worker_pids or not self._stopping:
+                try:
+                    select.select([wakeup_read], [], [], 1)
+                    signals = os.read(wakeup_read, 64)
+                except (BlockingIOError, InterruptedError):
+                    signals = b''
+
+                for signum in signals:
+                    if signum == signal.SIGHUP and not self._stopping:
+                        logger.info('Reloading workers')
+                        self._generation += 1
+                        self._signal_workers(signal.SIGTERM)
+                    elif signum in (signal.SIGTERM, signal.SIGINT) and not self._stopping:
+                        logger.info('Stopping workers')
+                        self._stopping = True
+                        stop_deadline = time.monotonic() + self.graceful_timeout + 5
+                        self._signal_workers(signal.SIGTERM)
+
+                self._reap_workers()
+                if self._stopping:
+                    if time.monotonic() > stop_deadline:
+                        self._signal_workers(signal.SIGKILL)
+                else:
+                    self._spawn_workers()
+        finally:
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+
+            signal.set_wakeup_fd(old_wakeup_fd)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
+            self.close()
+
+    def close(self):
+        """Close the listening sockets (and remove the UNIX socket file, if any)."""
+        for sock in self.sockets or ():
+            sock.close()
+
+        self.sockets = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _signal_workers(self, signum):
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _reap_workers(self):
+        while self._worker_pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+
+            if not pid:
+                break
+
+            worker_info = self._worker_pids.pop(pid, None)
+            if worker_info is not None:
+                if time.monotonic() - worker_info[1] < restart_delay:
+                    # Avoid spinning if the workers keep dying right after starting
+                    self._spawn_after = time.monotonic() + restart_delay
+
+                if os.WIFSIGNALED(status):
+                    logger.warning('Worker %d was terminated by signal %d', pid,
+                                   os.WTERMSIG(status))
+                elif os.WEXITSTATUS(status):
+                    logger.warning('Worker %d exited with status %d', pid, os.WEXITSTATUS(status))
+                else:
+                    logger.info('Worker %d exited', pid)
+
+    def _spawn_workers(self):
+        if time.monotonic() < self._spawn_after:
+            return
+
+        current = sum(1 for generation, _ in self._worker_pids.values()
+                      if generation == self._generation)
+        for _ in range(self.workers - current):
+            # SIGTERM stays blocked in the worker until it's ready to stop gracefully
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+            try:
+                pid = os.fork()
+                if pid == 0:
+                    self._run_worker()
+            finally:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
+            self._worker_pids[pid] = (self._generation, time.monotonic())
+            logger.info('Started worker %d', pid)
+
+    def _run_worker(self):
+        exit_code = 0
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # These are handled by the supervisor
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+            sockets = self.sockets
+            if self.reuse_port:
+                sockets = []
+                for parent_sock in self.sockets:
+                    sock = self._create_tcp_socket(parent_sock.family, parent_sock.type,
+                                                   parent_sock.proto, parent_sock.getsockname())
+                    sock.listen(self.backlog)
+                    sock.setblocking(False)
+                    sockets.append(sock)
+                    parent_sock.close()
+
+            handler = self.handler
+            if handler is None:
+                handler = self.handler_factory()
+
+            Worker(self, handler, sockets).run()
+        except BaseException:
+            logger.exception('Error in worker %d', os.getpid())
+            exit_code = 1
+        finally:
+            # Never return to the supervisor's code in the forked process
+            os._exit(exit_code)
@@ -1,3 +1,4 @@
+import os
 from struct import Struct
 
 from fcgiproto.constants import (
@@ -6,7 +7,18 @@ from fcgiproto.constants import (
 from fcgiproto.exceptions import ProtocolError
 
 headers_struct = Struct('>BBHHBx')
+length1_struct = Struct('>B')
 length4_struct = Struct('>I')
+max_content_length = 0xffff
+empty_header = b'\x00' * headers_struct.size
+
+if bytes is str:  # pragma: no cover
+    def to_bytes(data):
+        """Return a copy of the given bytes-like object as a bytestring."""
+        # On Python 2, bytes(memoryview) returns the object's repr instead of its contents
+        return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+else:
+    to_bytes = bytes
 
 
 class FCGIRecord(object):
@@ -26,9 +38,31 @@ class FCGIRecord(object):
     def encode_header(self, content):
         return headers_struct.pack(1, self.record_type, self.request_id, len(content), 0)
 
+    def encode_header_into(self, buffer, content_length):
+        offset = len(buffer)
+        buffer += empty_header
+        headers_struct.pack_into(buffer, offset, 1, self.record_type, self.request_id,
+                                 content_length, 0)
+
     def encode(self):  # pragma: no cover
         raise NotImplementedError
 
+    def encode_into(self, buffer):
+        """
+        Append the encoded record to the end of a bytearray.
+
+        This produces the same bytes as :meth:`encode` but avoids creating intermediate objects
+        where possible.
+
+        :param bytearray buffer: the buffer to write to
+        :return: the number of bytes written
+        :rtype: int
+
+        """
+        data = self.encode()
+        buffer += data
+        return len(data)
+
 
 class FCGIBytestreamRecord(FCGIRecord):
     __slots__ = ('content',)
@@ -39,10 +73,43 @@ class FCGIBytestreamRecord(FCGIRecord):
 
     @classmethod
     def parse(cls, request_id, content):
-        return cls(request_id, bytes(content))
+        return cls(request_id, to_bytes(content))
+
+    def encode(self):
+        return self.encode_header(self.content) + to_bytes(self.content)
+
+    def encode_into(self, buffer):
+        content_length = len(self.content)
+        offset = len(buffer)
+        buffer += empty_header
+        headers_struct.pack_into(buffer, offset, 1, self.record_type, self.request_id,
+                                 content_length, 0)
+        buffer += self.content
+        return headers_struct.size + content_length
+
+
+class FCGIFixedSizeRecord(FCGIRecord):
+    """Base class for records whose content is a fixed size structure."""
+
+    __slots__ = ()
+
+    record_struct = Struct('')  # type: Struct  # the header followed by the content
+
+    def encode_fields(self):  # pragma: no cover
+        raise NotImplementedError
 
     def encode(self):
-        return self.encode_header(self.content) + self.content
+        content = self.struct.pack(*self.encode_fields())
+        return self.encode_header(content) + content
+
+    def encode_into(self, buffer):
+        # Reserve the space for the whole record and pack the header and content into it at once
+        offset = len(buffer)
+        size = self.record_struct.size
+        buffer += b'\x00' * size
+        self.record_struct.pack_into(buffer, offset, 1, self.record_type, self.request_id,
+                                     self.struct.size, 0, *self.encode_fields())
+        return size
 
 
 class FCGIUnknownManagementRecord(FCGIRecord):
@@ -71,6 +138,12 @@ class FCGIGetValues(FCGIRecord):
         content = encode_name_value_pairs(pairs)
         return self.encode_header(content) + content
 
+    def encode_into(self, buffer):
+        content = encode_name_value_pairs([(key, '') for key in self.keys])
+        self.encode_header_into(buffer, len(content))
+        buffer += content
+        return headers_struct.size + len(content)
+
 
 class FCGIGetValuesResult(FCGIRecord):
     __slots__ = ('values',)
@@ -91,11 +164,18 @@ class FCGIGetValuesResult(FCGIRecord):
         content = encode_name_value_pairs(self.values)
         return self.encode_header(content) + content
 
+    def encode_into(self, buffer):
+        content = encode_name_value_pairs(self.values)
+        self.encode_header_into(buffer, len(content))
+        buffer += content
+        return headers_struct.size + len(content)
+
 
-class FCGIUnknownType(FCGIRecord):
+class FCGIUnknownType(FCGIFixedSizeRecord):
     __slots__ = ('type',)
 
     struct = Struct('>B7x')
+    record_struct = Struct('>BBHHBxB7x')
     record_type = FCGI_UNKNOWN_TYPE
 
     def __init__(self, type):
@@ -103,15 +183,15 @@ class FCGIUnknownType(FCGIRecord):
         super(FCGIUnknownType, self).__init__(0)
         self.type = type
 
-    def encode(self):
-        content = self.struct.pack(self.type)
-        return self.encode_header(content) + content
+    def encode_fields(self):
+        return self.type,
 
 
-class FCGIBeginRequest(FCGIRecord):
+class FCGIBeginRequest(FCGIFixedSizeRecord):
     __slots__ = ('role', 'flags')
 
     struct = Struct('>HB5x')
+    record_struct = Struct('>BBHHBxHB5x')
     record_type = FCGI_BEGIN_REQUEST
 
     def __init__(self, request_id, role, flags):
@@ -119,9 +199,8 @@ class FCGIBeginRequest(FCGIRecord):
         self.role = role
         self.flags = flags
 
-    def encode(self):
-        content = self.struct.pack(self.role, self.flags)
-        return self.encode_header(content) + content
+    def encode_fields(self):
+        return self.role, self.flags
 
 
 class FCGIAbortRequest(FCGIRecord):
@@ -136,6 +215,10 @@ class FCGIAbortRequest(FCGIRecord):
     def encode(self):
         return self.encode_header(b'')
 
+    def encode_into(self, buffer):
+        self.encode_header_into(buffer, 0)
+        return headers_struct.size
+
 
 class FCGIParams(FCGIBytestreamRecord):
     __slots__ = ()
@@ -167,10 +250,11 @@ class FCGIData(FCGIBytestreamRecord):
     record_type = FCGI_DATA
 
 
-class FCGIEndRequest(FCGIRecord):
+class FCGIEndRequest(FCGIFixedSizeRecord):
     __slots__ = ('app_status', 'protocol_status')
 
     struct = Struct('>IB3x')
+    record_struct = Struct('>BBHHBxIB3x')
     record_type = FCGI_END_REQUEST
 
     def __init__(self, request_id, app_status, protocol_status):
@@ -178,9 +262,8 @@ class FCGIEndRequest(FCGIRecord):
         self.app_status = app_status
         self.protocol_status = protocol_status
 
-    def encode(self):
-        content = self.struct.pack(self.app_status, self.protocol_status)
-        return self.encode_header(content) + content
+    def encode_fields(self):
+        return self.app_status, self.protocol_status
 
 
 record_classes = {cls.record_type: cls for cls in globals().values()  # type: ignore
@@ -188,48 +271,190 @@ record_classes = {cls.record_type: cls for cls in globals().values()  # type: ig
                   and cls.record_type}  # type: ignore
 
 
-def decode_name_value_pairs(buffer):
+def _read_length(data, index, size):
+    # Returns (length, index after the length field) or None if there's not enough data
+    if index < size:
+        length = length1_struct.unpack_from(data, index)[0]
+        if length & 0x80 == 0:
+            return length, index + 1
+        elif size - index >= 4:
+            return length4_struct.unpack_from(data, index)[0] & 0x7fffffff, index + 4
+
+    return None
+
+
+def decode_pairs_from(buffer, offset):
     """
-    Decode a name-value pair list from a buffer.
+    Decode complete name-value pairs from the given position in a buffer.
 
-    :param bytearray buffer: a buffer containing a FastCGI name-value pair list
-    :raise ProtocolError: if the buffer contains incomplete data
-    :return: a list of (name, value) tuples where both elements are unicode strings
-    :rtype: list
+    :param buffer: a bytes-like object containing (part of) a FastCGI name-value pair list
+    :param int offset: the position in the buffer where the first pair starts
+    :return: a tuple of (list of (name, value) tuples of bytestrings, offset of the first
+        incomplete pair or the end of the buffer)
 
     """
-    index = 0
+    size = len(buffer)
     pairs = []
-    while index < len(buffer):
-        if buffer[index] & 0x80 == 0:
-            name_length = buffer[index]
-            index += 1
-        elif len(buffer) - index > 4:
-            name_length = length4_struct.unpack_from(buffer, index)[0] & 0x7fffffff
-            index += 4
-        else:
-            raise ProtocolError('not enough data to decode name length in name-value pair')
+    while offset < size:
+        result = _read_length(buffer, offset, size)
+        if result is None:
+            break
 
-        if len(buffer) - index > 1 and buffer[index] & 0x80 == 0:
-            value_length = buffer[index]
-            index += 1
-        elif len(buffer) - index > 4:
-            value_length = length4_struct.unpack_from(buffer, index)[0] & 0x7fffffff
-            index += 4
-        else:
-            raise ProtocolError('not enough data to decode value length in name-value pair')
+        name_length, position = result
+        result = _read_length(buffer, position, size)
+        if result is None:
+            break
+
+        value_length, name_start = result
+        value_start = name_start + name_length
+        end = value_start + value_length
+        if end > size:
+            break
+
+        pairs.append((to_bytes(buffer[name_start:value_start]), to_bytes(buffer[value_start:end])))
+        offset = end
+
+    return pairs, offset
+
+
+def scan_pairs_from(buffer, offset):
+    """
+    Find the end of the complete name-value pairs from the given position in a buffer.
+
+    Only the length fields are read, so this validates the structure of a name-value pair list
+    without creating any objects for the names and values.
+
+    :param buffer: a bytes-like object containing (part of) a FastCGI name-value pair list
+    :param int offset: the position in the buffer where the first pair starts
+    :return: the offset of the first incomplete pair or the end of the buffer
+    :rtype: int
+
+    """
+    size = len(buffer)
+    while offset < size:
+        result = _read_length(buffer, offset, size)
+        if result is None:
+            break
+
+        name_length, position = result
+        result = _read_length(buffer, position, size)
+        if result is None:
+            break
 
-        if len(buffer) - index >= name_length + value_length:
-            name = buffer[index:index + name_length].decode('ascii')
-            value = buffer[index + name_length:index + name_length + value_length].decode('utf-8')
-            pairs.append((name, value))
-            index += name_length + value_length
+        value_length, name_start = result
+        end = name_start + name_length + value_length
+        if end > size:
+            break
+
+        offset = end
+
+    return offset
+
+
+def check_pairs_end(buffer, offset):
+    """
+    Check that a name-value pair list does not end with an incomplete pair.
+
+    :param buffer: a bytes-like object containing a FastCGI name-value pair list
+    :param int offset: the position after the last complete pair in the buffer (as returned by
+        :func:`scan_pairs_from`)
+    :raise ProtocolError: if there is any data after ``offset``
+
+    """
+    size = len(buffer)
+    if offset < size:
+        result = _read_length(buffer, offset, size)
+        if result is None:
+            raise ProtocolError('not enough data to decode name length in name-value pair')
+        elif _read_length(buffer, result[1], size) is None:
+            raise ProtocolError('not enough data to decode value length in name-value pair')
         else:
             raise ProtocolError('name/value data missing from buffer')
 
+
+class NameValuePairDecoder(object):
+    """
+    Incremental decoder for FastCGI name-value pair lists.
+
+    The encoded list can be fed to the decoder in arbitrarily sized pieces, such as the contents
+    of consecutive ``FCGI_PARAMS`` records. Each call to :meth:`feed` returns the pairs completed
+    by that piece of data. Only the data belonging to an incomplete pair is held in the decoder
+    between calls.
+    """
+
+    __slots__ = ('_buffer',)
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Decode as many name-value pairs as possible.
+
+        :param data: the next piece of the encoded name-value pair list (a bytes-like object)
+        :return: a list of (name, value) tuples where both elements are bytestrings
+        :rtype: list
+
+        """
+        if self._buffer:
+            self._buffer.extend(data)
+            data = self._buffer
+
+        pairs, index = decode_pairs_from(data, 0)
+        if data is self._buffer:
+            del data[:index]
+        elif index < len(data):
+            self._buffer.extend(data[index:])
+
+        return pairs
+
+    def reset(self):
+        """Discard any buffered data."""
+        del self._buffer[:]
+
+    def close(self):
+        """
+        Signal the end of the name-value pair list.
+
+        :raise ProtocolError: if the decoder holds the data of an incomplete pair
+
+        """
+        buffer = self._buffer
+        if buffer:
+            self._buffer = bytearray()
+            check_pairs_end(buffer, 0)
+
+
+def decode_raw_name_value_pairs(buffer):
+    """
+    Decode a name-value pair list from a buffer, leaving the names and values as bytestrings.
+
+    :param buffer: a bytes-like object containing a FastCGI name-value pair list
+    :raise ProtocolError: if the buffer contains incomplete data
+    :return: a list of (name, value) tuples where both elements are bytestrings
+    :rtype: list
+
+    """
+    decoder = NameValuePairDecoder()
+    pairs = decoder.feed(buffer)
+    decoder.close()
     return pairs
 
 
+def decode_name_value_pairs(buffer):
+    """
+    Decode a name-value pair list from a buffer.
+
+    :param buffer: a bytes-like object containing a FastCGI name-value pair list
+    :raise ProtocolError: if the buffer contains incomplete data
+    :return: a list of (name, value) tuples where both elements are unicode strings
+    :rtype: list
+
+    """
+    return [(name.decode('ascii'), value.decode('utf-8'))
+            for name, value in decode_raw_name_value_pairs(buffer)]
+
+
 def encode_name_value_pairs(pairs):
     """
     Encode a list of name-pair values into a binary form that FCGI understands.
@@ -258,32 +483,124 @@ def encode_name_value_pairs(pairs):
     return bytes(content)
 
 
-def decode_record(buffer):
+def unpack_header(buffer, offset):
     """
-    Create a new FCGI message from the bytes in the given buffer.
-
-    If successful, the record's data is removed from the byte array.
+    Decode a record header from the given position in a buffer.
 
-    :param bytearray buffer: the byte array containing the data
-    :return: an instance of this class, or ``None`` if there was not enough data
+    :param buffer: a bytes-like object containing the data
+    :param int offset: the position in the buffer where the header starts
+    :raise ProtocolError: if the header has an unsupported protocol version
+    :return: a tuple of (record type, request ID, content length, padding length), or ``None`` if
+        there was not enough data
 
     """
-    if len(buffer) >= headers_struct.size:
+    if len(buffer) - offset >= headers_struct.size:
         version, record_type, request_id, content_length, padding_length = \
-            headers_struct.unpack_from(buffer)
+            headers_struct.unpack_from(buffer, offset)
         if version != 1:
-            raise ProtocolError('unexpected protocol version: %d' % buffer[0])
-        elif len(buffer) >= headers_struct.size + content_length + padding_length:
-            content = buffer[headers_struct.size:headers_struct.size + content_length]
-            del buffer[:headers_struct.size + content_length + padding_length]
+            raise ProtocolError('unexpected protocol version: %d' % version)
+
+        return record_type, request_id, content_length, padding_length
+
+    return None
+
+
+def frame_records(record_type, request_id, data):
+    """
+    Encode a stream of data into records of the given type, splitting it as necessary.
+
+    The data is not copied: the returned parts are the record headers interleaved with
+    :class:`memoryview` slices of ``data`` (or ``data`` itself if it fits into a single record).
+
+    :param int record_type: type of the records (like ``FCGI_STDOUT``)
+    :param int request_id: identifier of the request
+    :param data: a bytes-like object
+    :return: a list of bytes-like objects
+    :rtype: list
+
+    """
+    length = len(data)
+    if length <= max_content_length:
+        return [headers_struct.pack(1, record_type, request_id, length, 0), data]
+
+    view = memoryview(data)
+    parts = []
+    for offset in range(0, length, max_content_length):
+        chunk = view[offset:offset + max_content_length]
+        parts.append(headers_struct.pack(1, record_type, request_id, len(chunk), 0))
+        parts.append(chunk)
+
+    return parts
+
+
+def decode_record_from(buffer, offset=0, copy=True):
+    """
+    Create a new FCGI message from the bytes in the given buffer, starting at ``offset``.
+
+    Unlike :func:`decode_record`, this function does not modify the buffer, so several records can
+    be decoded from the same buffer before the consumed data is discarded in one go.
+
+    :param buffer: a bytes-like object containing the data
+    :param int offset: the position in the buffer where the record starts
+    :param bool copy: ``False`` to make the contents of bytestream records (``FCGI_PARAMS``,
+        ``FCGI_STDIN`` etc.) slices of ``buffer`` instead of copies (pass a :class:`memoryview`
+        as the buffer to avoid copying altogether)
+    :return: a tuple of (record, offset of the next record), or (``None``, ``offset``) if there
+        was not enough data
+
+    """
+    header = unpack_header(buffer, offset)
+    if header is not None:
+        record_type, request_id, content_length, padding_length = header
+        content_start = offset + headers_struct.size
+        content_end = content_start + content_length
+        if len(buffer) >= content_end + padding_length:
             try:
                 record_class = record_classes[record_type]
             except KeyError:
                 if request_id:
                     raise ProtocolError('unknown record type: %d' % record_type)
                 else:
-                    return FCGIUnknownManagementRecord(record_type)
+                    record = FCGIUnknownManagementRecord(record_type)
+            else:
+                content = buffer[content_start:content_end]
+                if copy or not issubclass(record_class, FCGIBytestreamRecord):
+                    record = record_class.parse(request_id, content)
+                else:
+                    record = record_class(request_id, content)
 
-            return record_class.parse(request_id, content)
+            return record, content_end + padding_length
 
-    return None
+    return None, offset
+
+
+def decode_record(buffer):
+    """
+    Create a new FCGI message from the bytes in the given buffer.
+
+    If successful, the record's data is removed from the byte array.
+
+    :param bytearray buffer: the byte array containing the data
+    :return: an instance of this class, or ``None`` if there was not enough data
+
+    """
+    record, offset = decode_record_from(buffer)
+    if offset:
+        del buffer[:offset]
+
+    return record
+
+
+# Replace the functions above with their C implementations, unless disabled or unavailable
+_python_implementations = {func.__name__: func for func in (
+    unpack_header, decode_pairs_from, scan_pairs_from, encode_name_value_pairs, frame_records)}
+using_speedups = False
+if not os.environ.get('FCGIPROTO_NO_SPEEDUPS'):
+    try:
+        from fcgiproto._speedups import (  # noqa: F811
+            unpack_header, decode_pairs_from, scan_pairs_from, encode_name_value_pairs,
+            frame_records)
+    except ImportError:
+        pass
+    else:
+        using_speedups = True
@@ -0,0 +1,180 @@
+"""
+Command line entry point for running applications with the pre-forking server.
+
+Usage: ``python -m fcgiproto.runner [options] module:attribute``
+
+If the process was started with listening sockets already open, they are adopted instead of
+creating new ones. This covers both the FastCGI convention of passing a listening socket as
+standard input (``FCGI_LISTENSOCK_FILENO``), used by process managers like mod_fcgid and
+spawn-fcgi, and systemd style socket activation (``LISTEN_FDS``). Because the listening sockets
+outlive the server process in these setups, the server can be restarted without refusing any
+connections.
+
+This module requires Python 3.5 or later.
+"""
+import argparse
+import importlib
+import logging
+import os
+import socket
+import stat
+import sys
+
+from fcgiproto.prefork import PreforkServer
+
+#: file descriptor of the listening socket passed by the web server, as per the FastCGI spec
+FCGI_LISTENSOCK_FILENO = 0
+
+#: the first file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+logger = logging.getLogger(__name__)
+
+
+def _listening_socket(fd):
+    try:
+        if not stat.S_ISSOCK(os.fstat(fd).st_mode):
+            return None
+    except OSError:
+        return None
+
+    sock = socket.socket(fileno=fd)
+    if sock.type == socket.SOCK_STREAM:
+        try:
+            sock.getpeername()
+        except OSError:
+            # A listening socket has no peer
+            return sock
+
+    sock.detach()
+    return None
+
+
+def inherited_sockets(environ=None):
+    """
+    Find the listening sockets passed to this process by its parent.
+
+    Sockets passed through systemd socket activation (when ``LISTEN_PID`` matches the current
+    process) take precedence. The ``LISTEN_PID`` and ``LISTEN_FDS`` variables are then removed
+    from the environment so that child processes won't try to adopt the same sockets. Otherwise,
+    if standard input is a listening socket, it is returned instead and standard input is
+    replaced with :data:`os.devnull`.
+
+    :param dict environ: the environment variables to look at (defaults to :data:`os.environ`)
+    :return: the listening sockets (an empty list if there were none)
+    :rtype: list[socket.socket]
+
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get('LISTEN_PID') == str(os.getpid()):
+        num_fds = int(environ.get('LISTEN_FDS') or 0)
+        environ.pop('LISTEN_PID', None)
+        environ.pop('LISTEN_FDS', None)
+        environ.pop('LISTEN_FDNAMES', None)
+        sockets = []
+        for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + num_fds):
+            os.set_inheritable(fd, False)
+            sock = _listening_socket(fd)
+            if sock is not None:
+                sockets.append(sock)
+
+        return sockets
+
+    sock = _listening_socket(FCGI_LISTENSOCK_FILENO)
+    if sock is None:
+        return []
+
+    # Move the socket off standard input so that nothing else mistakes it for a regular stream
+    new_sock = sock.dup()
+    sock.detach()
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, FCGI_LISTENSOCK_FILENO)
+    os.close(null_fd)
+    return [new_sock]
+
+
+def load_application(reference):
+    """
+    Import an object given as ``module:attribute``.
+
+    :param str reference: the module name and the (possibly dotted) attribute name, separated by a
+        colon
+    :return: the imported object
+
+    """
+    module_name, separator, attribute = reference.partition(':')
+    if not separator or not module_name or not attribute:
+        raise ValueError('expected a reference in the form module:attribute, got %r' % reference)
+
+    obj = importlib.import_module(module_name)
+    for name in attribute.split('.'):
+        obj = getattr(obj, name)
+
+    return obj
+
+
+def create_handler(app, interface):
+    """
+    Wrap an application in a request handler for the given interface.
+
+    :param app: the application
+    :param str interface: ``fastcgi`` (the application is a request handler already), ``asgi`` or
+        ``wsgi``
+    :return: a request handler
+
+    """
+    if interface == 'asgi':
+        from fcgiproto.asgi import ASGIAdapter
+        return ASGIAdapter(app)
+    elif interface == 'wsgi':
+        from fcgiproto.wsgi import WSGIGateway
+        return WSGIGateway(app)
+    elif interface == 'fastcgi':
+        return app
+    else:
+        raise ValueError('unknown interface: %s' % interface)
+
+
+def main(args=None):
+    """Run the command line interface."""
+    parser = argparse.ArgumentParser(
+        prog='python -m fcgiproto.runner',
+        description='Run a FastCGI server. Inherited listening sockets are used if available.')
+    parser.add_argument('app', help='the application as module:attribute')
+    parser.add_argument('--interface', choices=('fastcgi', 'asgi', 'wsgi'), default='fastcgi',
+                        help='the kind of application (default: %(default)s)')
+    parser.add_argument('--host', help='the interface to listen on')
+    parser.add_argument('--port', type=int, help='the TCP port to listen on')
+    parser.add_argument('--path', help='the path of a UNIX domain socket to listen on')
+    parser.add_argument('--workers', type=int,
+                        help='the number of worker processes (default: number of CPUs)')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='give each worker its own socket using SO_REUSEPORT')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='replace workers after this many requests')
+    parser.add_argument('--log-level', default='INFO', help='the logging level')
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=options.log_level.upper(),
+                        format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+    sockets = inherited_sockets()
+    if sockets:
+        logger.info('Using %d inherited listening socket(s)', len(sockets))
+    elif options.port is None and options.path is None:
+        parser.error('no inherited listening sockets found, so either --port or --path is '
+                     'required')
+
+    # The application is only imported in the workers, so that reloading them with SIGHUP picks
+    # up any changes to its code
+    sys.path.insert(0, '')
+    server = PreforkServer(host=options.host, port=options.port, path=options.path,
+                           sockets=sockets or None, workers=options.workers,
+                           reuse_port=options.reuse_port and not sockets,
+                           max_requests=options.max_requests,
+                           handler_factory=lambda: create_handler(load_application(options.app),
+                                                                  options.interface))
+    server.run()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -1,14 +1,20 @@
+from collections import OrderedDict
+
 from fcgiproto.constants import (
-    FCGI_BEGIN_REQUEST, FCGI_PARAMS, FCGI_STDIN, FCGI_STDOUT, FCGI_END_REQUEST, FCGI_DATA,
-    FCGI_FILTER, FCGI_AUTHORIZER, FCGI_ABORT_REQUEST, FCGI_REQUEST_COMPLETE)
+    FCGI_BEGIN_REQUEST, FCGI_PARAMS, FCGI_STDIN, FCGI_STDOUT, FCGI_STDERR, FCGI_END_REQUEST,
+    FCGI_DATA, FCGI_FILTER, FCGI_AUTHORIZER, FCGI_ABORT_REQUEST, FCGI_REQUEST_COMPLETE,
+    FCGI_UNKNOWN_TYPE)
 from fcgiproto.events import (
-    RequestDataEvent, RequestSecondaryDataEvent, RequestAbortEvent, RequestBeginEvent)
+    RequestDataEvent, RequestSecondaryDataEvent, RequestAbortEvent, RequestBeginEvent,
+    RequestParams)
 from fcgiproto.exceptions import ProtocolError
-from fcgiproto.records import decode_name_value_pairs
+from fcgiproto.records import NameValuePairDecoder
+from fcgiproto.stats import clock
 
 
 class RequestState(object):
-    __slots__ = ('state', 'role', 'flags', 'params_buffer')
+    __slots__ = ('state', 'role', 'flags', 'params', 'params_decoder', 'unacknowledged',
+                 'stderr_buffer', 'priority', 'timeline')
 
     EXPECT_BEGIN_REQUEST = 1
     EXPECT_PARAMS = 2
@@ -20,71 +26,159 @@ class RequestState(object):
     state_names = {value: varname for varname, value in locals().items() if isinstance(value, int)}
 
     def __init__(self):
+        self.params_decoder = NameValuePairDecoder()
+        self.reset()
+
+    def reset(self):
+        """Return the state to what it was after instantiation, so it can be reused."""
         self.state = RequestState.EXPECT_BEGIN_REQUEST
         self.role = self.flags = None
-        self.params_buffer = bytearray()
+        self.params = OrderedDict()
+        self.params_decoder.reset()
+        self.unacknowledged = 0
+        self.stderr_buffer = None
+        self.priority = 1
+        self.timeline = None
 
     def receive_record(self, record):
-        if record.record_type == FCGI_BEGIN_REQUEST:
-            if self.state == RequestState.EXPECT_BEGIN_REQUEST:
-                self.role = record.role
-                self.flags = record.flags
-                self.state = RequestState.EXPECT_PARAMS
-                return None
-        elif record.record_type == FCGI_PARAMS:
-            if self.state == RequestState.EXPECT_PARAMS:
-                if record.content:
-                    self.params_buffer.extend(record.content)
-                    return None
-                else:
-                    params = decode_name_value_pairs(self.params_buffer)
-                    if self.role == FCGI_AUTHORIZER:
-                        self.state = RequestState.EXPECT_STDOUT
-                    else:
-                        self.state = RequestState.EXPECT_STDIN
+        handler = receive_handlers[self.state][record.record_type]
+        if handler is None:
+            raise ProtocolError('received unexpected %s record in the %s state' % (
+                record.__class__.__name__, self.state_names[self.state]))
 
-                    return RequestBeginEvent(record.request_id, self.role, self.flags, params)
-        elif record.record_type == FCGI_STDIN:
+        return handler(self, record)
+
+    def receive_data(self, record_type, request_id, content):
+        """
+        Handle the contents of a ``FCGI_STDIN`` or ``FCGI_DATA`` record without a record object.
+
+        :return: the resulting event, or ``None`` if the record is not allowed in the current
+            state (:meth:`receive_record` will then raise the appropriate error)
+
+        """
+        if record_type == FCGI_STDIN:
             if self.state == RequestState.EXPECT_STDIN:
-                if not record.content:
+                if not content:
+                    if self.timeline is not None:
+                        self.timeline.stdin_end = clock()
+
                     if self.role == FCGI_FILTER:
                         self.state = RequestState.EXPECT_DATA
                     else:
                         self.state = RequestState.EXPECT_STDOUT
 
-                return RequestDataEvent(record.request_id, record.content)
-        elif record.record_type == FCGI_DATA:
-            if self.state == RequestState.EXPECT_DATA:
-                if not record.content:
-                    self.state = RequestState.EXPECT_STDOUT
+                return RequestDataEvent(request_id, content)
+        elif self.state == RequestState.EXPECT_DATA:
+            if not content:
+                self.state = RequestState.EXPECT_STDOUT
 
-                return RequestSecondaryDataEvent(record.request_id, record.content)
-        elif record.record_type == FCGI_ABORT_REQUEST:
-            if RequestState.EXPECT_BEGIN_REQUEST < self.state < RequestState.FINISHED:
-                self.state = RequestState.EXPECT_END_REQUEST
-                return RequestAbortEvent(record.request_id)
+            return RequestSecondaryDataEvent(request_id, content)
 
-        raise ProtocolError('received unexpected %s record in the %s state' % (
-            record.__class__.__name__, self.state_names[self.state]))
+        return None
 
     def send_record(self, record):
-        if record.record_type == FCGI_STDOUT:
-            if self.state == RequestState.EXPECT_STDOUT:
-                if not record.content:
-                    self.state = RequestState.EXPECT_END_REQUEST
-
-                return
-        elif record.record_type == FCGI_END_REQUEST:
-            # Only allow a normal request finish when it's expected
-            if self.state == RequestState.EXPECT_END_REQUEST:
-                if record.protocol_status == FCGI_REQUEST_COMPLETE:
-                    self.state = RequestState.FINISHED
-                    return
-            elif self.state == RequestState.EXPECT_PARAMS:
-                # Allow rejecting the request right after receiving it but not later
-                if record.protocol_status != FCGI_REQUEST_COMPLETE:
-                    self.state = RequestState.FINISHED
-                    return
+        handler = send_handlers[self.state][record.record_type]
+        if handler is None:
+            self._reject_send(record)
+
+        handler(self, record)
 
+    def _reject_send(self, record):
         raise ProtocolError('cannot send %s record in the %s state' % (
             record.__class__.__name__, self.state_names[self.state]))
+
+    def _receive_begin_request(self, record):
+        self.role = record.role
+        self.flags = record.flags
+        self.state = RequestState.EXPECT_PARAMS
+
+    def _receive_params(self, record):
+        if record.content:
+            # Decode the pairs as they arrive, so only the data of an incomplete pair is buffered
+            self.params.update(self.params_decoder.feed(record.content))
+            return None
+
+        self.params_decoder.close()
+        if self.timeline is not None:
+            self.timeline.params_end = clock()
+
+        params = RequestParams.from_raw_pairs(self.params)
+        self.params = OrderedDict()
+        if self.role == FCGI_AUTHORIZER:
+            self.state = RequestState.EXPECT_STDOUT
+        else:
+            self.state = RequestState.EXPECT_STDIN
+
+        return RequestBeginEvent(record.request_id, self.role, self.flags, params)
+
+    def _receive_stdin(self, record):
+        return self.receive_data(FCGI_STDIN, record.request_id, record.content)
+
+    def _receive_data(self, record):
+        return self.receive_data(FCGI_DATA, record.request_id, record.content)
+
+    def _receive_abort_request(self, record):
+        self.state = RequestState.EXPECT_END_REQUEST
+        return RequestAbortEvent(record.request_id)
+
+    def _send_stdout(self, record):
+        if self.timeline is not None and self.timeline.first_stdout is None:
+            self.timeline.first_stdout = clock()
+
+        if not record.content:
+            self.state = RequestState.EXPECT_END_REQUEST
+
+    def _send_stderr(self, record):
+        # The error stream is independent of the other streams, so it doesn't affect the state
+        pass
+
+    def _send_end_request(self, record):
+        # Only allow a normal request finish when it's expected
+        if record.protocol_status != FCGI_REQUEST_COMPLETE:
+            self._reject_send(record)
+
+        self.state = RequestState.FINISHED
+        if self.timeline is not None:
+            self.timeline.end = clock()
+
+    def _send_rejection(self, record):
+        # Allow rejecting the request right after receiving it but not later
+        if record.protocol_status == FCGI_REQUEST_COMPLETE:
+            self._reject_send(record)
+
+        self.state = RequestState.FINISHED
+
+
+def _build_table(transitions):
+    # Index the table by [state][record type], with None marking a protocol violation
+    table = [[None] * (FCGI_UNKNOWN_TYPE + 1) for _ in range(RequestState.FINISHED + 1)]
+    for (state, record_type), handler in transitions.items():
+        table[state][record_type] = handler
+
+    return table
+
+
+receive_handlers = _build_table({
+    (RequestState.EXPECT_BEGIN_REQUEST, FCGI_BEGIN_REQUEST): RequestState._receive_begin_request,
+    (RequestState.EXPECT_PARAMS, FCGI_PARAMS): RequestState._receive_params,
+    (RequestState.EXPECT_STDIN, FCGI_STDIN): RequestState._receive_stdin,
+    (RequestState.EXPECT_DATA, FCGI_DATA): RequestState._receive_data,
+    (RequestState.EXPECT_PARAMS, FCGI_ABORT_REQUEST): RequestState._receive_abort_request,
+    (RequestState.EXPECT_STDIN, FCGI_ABORT_REQUEST): RequestState._receive_abort_request,
+    (RequestState.EXPECT_DATA, FCGI_ABORT_REQUEST): RequestState._receive_abort_request,
+    (RequestState.EXPECT_STDOUT, FCGI_ABORT_REQUEST): RequestState._receive_abort_request,
+    (RequestState.EXPECT_END_REQUEST, FCGI_ABORT_REQUEST): RequestState._receive_abort_request
+})
+send_handlers = _build_table({
+    (RequestState.EXPECT_STDOUT, FCGI_STDOUT): RequestState._send_stdout,
+    (RequestState.EXPECT_STDIN, FCGI_STDERR): RequestState._send_stderr,
+    (RequestState.EXPECT_DATA, FCGI_STDERR): RequestState._send_stderr,
+    (RequestState.EXPECT_STDOUT, FCGI_STDERR): RequestState._send_stderr,
+    (RequestState.EXPECT_END_REQUEST, FCGI_STDERR): RequestState._send_stderr,
+    (RequestState.EXPECT_END_REQUEST, FCGI_END_REQUEST): RequestState._send_end_request,
+    (RequestState.EXPECT_PARAMS, FCGI_END_REQUEST): RequestState._send_rejection
+})
+
+
+#: shared state for request IDs without an active request; it only serves to reject records
+idle_request_state = RequestState()
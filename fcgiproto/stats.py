@@ -0,0 +1,335 @@
+import time
+from array import array
+from bisect import bisect_left
+
+#: the clock used for request timelines (a monotonic clock where available)
+clock = getattr(time, 'monotonic', time.time)
+
+#: names of the record types, indexed by record type (index 0 is for unrecognized types)
+record_type_names = (
+    'other', 'FCGI_BEGIN_REQUEST', 'FCGI_ABORT_REQUEST', 'FCGI_END_REQUEST', 'FCGI_PARAMS',
+    'FCGI_STDIN', 'FCGI_STDOUT', 'FCGI_STDERR', 'FCGI_DATA', 'FCGI_GET_VALUES',
+    'FCGI_GET_VALUES_RESULT', 'FCGI_UNKNOWN_TYPE')
+num_record_types = len(record_type_names)
+
+# Offsets of the counters in ConnectionStats.counters; the per record type counters take one
+# slot for each record type
+RECORDS_RECEIVED = 0
+BYTES_RECEIVED = RECORDS_RECEIVED + num_record_types
+RECORDS_SENT = BYTES_RECEIVED + num_record_types
+BYTES_SENT = RECORDS_SENT + num_record_types
+EVENTS = BYTES_SENT + num_record_types
+REQUESTS_STARTED = EVENTS + 1
+REQUESTS_COMPLETED = EVENTS + 2
+REQUESTS_ABORTED = EVENTS + 3
+REQUESTS_REJECTED = EVENTS + 4
+GET_VALUES_QUERIES = EVENTS + 5
+PEAK_INPUT_BUFFER = EVENTS + 6
+PEAK_UNACKNOWLEDGED = EVENTS + 7
+PEAK_OUTPUT_BUFFER = EVENTS + 8
+num_counters = PEAK_OUTPUT_BUFFER + 1
+
+#: counters that hold the highest value seen rather than a running total
+peak_counters = (PEAK_INPUT_BUFFER, PEAK_UNACKNOWLEDGED, PEAK_OUTPUT_BUFFER)
+
+_per_type_metrics = (
+    (RECORDS_RECEIVED, 'records_received_total', 'Records received, by record type'),
+    (BYTES_RECEIVED, 'received_bytes_total', 'Bytes received (including headers and padding), by '
+                                             'record type'),
+    (RECORDS_SENT, 'records_sent_total', 'Records sent, by record type'),
+    (BYTES_SENT, 'sent_bytes_total', 'Bytes sent (including headers), by record type')
+)
+
+_counter_metrics = (
+    (EVENTS, 'events_total', 'Events returned to the application'),
+    (REQUESTS_STARTED, 'requests_started_total', 'Requests started'),
+    (REQUESTS_COMPLETED, 'requests_completed_total', 'Requests completed'),
+    (REQUESTS_ABORTED, 'requests_aborted_total', 'Requests aborted by the web server'),
+    (REQUESTS_REJECTED, 'requests_rejected_total', 'Requests rejected by the application'),
+    (GET_VALUES_QUERIES, 'get_values_queries_total', 'FCGI_GET_VALUES queries answered')
+)
+
+_gauge_metrics = (
+    (PEAK_INPUT_BUFFER, 'peak_input_buffer_bytes',
+     'Highest number of bytes of incomplete records buffered by a connection'),
+    (PEAK_UNACKNOWLEDGED, 'peak_unacknowledged_bytes',
+     'Highest number of bytes of request body data awaiting acknowledgement on a connection'),
+    (PEAK_OUTPUT_BUFFER, 'peak_output_buffer_bytes',
+     'Highest number of bytes of outgoing data waiting to be sent on a connection')
+)
+
+
+class ConnectionStats(object):
+    """
+    Counters for the activity of a single connection.
+
+    All the counters are kept in a single flat array (:attr:`counters`) to keep updates cheap.
+    Pass an instance to :class:`~fcgiproto.FastCGIConnection` as the ``stats`` option to enable
+    counting; connections without one pay only a ``None`` check on their hot paths.
+
+    :ivar counters: the counters, indexed by the offsets defined in this module
+    :vartype counters: array.array
+    :ivar registry: the registry this object belongs to, if any
+    :vartype registry: StatsRegistry
+    """
+
+    __slots__ = ('counters', 'registry')
+
+    def __init__(self, registry=None):
+        self.counters = array('d', [0]) * num_counters
+        self.registry = registry
+
+    def __getitem__(self, index):
+        return int(self.counters[index])
+
+    def record_received(self, record_type, nbytes):
+        """Count a received record of the given type and total size."""
+        if record_type >= num_record_types:
+            record_type = 0
+
+        self.counters[RECORDS_RECEIVED + record_type] += 1
+        self.counters[BYTES_RECEIVED + record_type] += nbytes
+
+    def records_sent(self, record_type, nrecords, nbytes):
+        """Count records of the given type and their total size queued for sending."""
+        self.counters[RECORDS_SENT + record_type] += nrecords
+        self.counters[BYTES_SENT + record_type] += nbytes
+
+    def update_peak(self, index, value):
+        """Raise the peak counter at ``index`` to ``value`` if it's lower."""
+        if value > self.counters[index]:
+            self.counters[index] = value
+
+    def close(self):
+        """Add the counters to the registry's totals, and stop tracking this object there."""
+        if self.registry is not None:
+            self.registry.release(self)
+            self.registry = None
+
+
+class StatsRegistry(object):
+    """
+    Aggregates the counters of any number of connections.
+
+    The counters of closed connections are kept in the totals, so the totals only ever grow (except
+    for the peak values, which are the highest seen on any connection).
+    """
+
+    __slots__ = ('_active', '_retired', '_connections_total')
+
+    def __init__(self):
+        self._active = set()
+        self._retired = array('d', [0]) * num_counters
+        self._connections_total = 0
+
+    def connection_stats(self):
+        """
+        Create a new :class:`ConnectionStats` tracked by this registry.
+
+        :rtype: ConnectionStats
+
+        """
+        stats = ConnectionStats(self)
+        self._active.add(stats)
+        self._connections_total += 1
+        return stats
+
+    def release(self, stats):
+        """
+        Add the counters of a closed connection to the totals and stop tracking it.
+
+        :param ConnectionStats stats: the connection's counters
+
+        """
+        if stats in self._active:
+            self._active.remove(stats)
+            self._merge(self._retired, stats.counters)
+
+    @staticmethod
+    def _merge(totals, counters):
+        for index, value in enumerate(counters):
+            if index in peak_counters:
+                if value > totals[index]:
+                    totals[index] = value
+            else:
+                totals[index] += value
+
+    def totals(self):
+        """
+        Return the combined counters of all the connections, past and present.
+
+        :rtype: ConnectionStats
+
+        """
+        totals = ConnectionStats()
+        totals.counters[:] = self._retired
+        for stats in self._active:
+            self._merge(totals.counters, stats.counters)
+
+        return totals
+
+    def export_prometheus(self, prefix='fcgiproto'):
+        """
+        Export the combined counters in the Prometheus text exposition format.
+
+        :param str prefix: prefix for the metric names
+        :rtype: str
+
+        """
+        totals = self.totals().counters
+        lines = []
+
+        def add_metric(name, metric_type, description, samples):
+            name = '%s_%s' % (prefix, name)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                lines.append('%s%s %d' % (name, labels, value))
+
+        for offset, name, description in _per_type_metrics:
+            samples = [('{type="%s"}' % type_name, totals[offset + record_type])
+                       for record_type, type_name in enumerate(record_type_names)]
+            add_metric(name, 'counter', description, samples)
+
+        for index, name, description in _counter_metrics:
+            add_metric(name, 'counter', description, [('', totals[index])])
+
+        for index, name, description in _gauge_metrics:
+            add_metric(name, 'gauge', description, [('', totals[index])])
+
+        add_metric('connections_total', 'counter', 'Connections opened',
+                   [('', self._connections_total)])
+        add_metric('connections_open', 'gauge', 'Connections currently open',
+                   [('', len(self._active))])
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimeline(object):
+    """
+    Timestamps of the milestones of a single request, taken from :func:`clock`.
+
+    Milestones that the request never reached (like the first ``FCGI_STDOUT`` record of an
+    aborted request) are ``None``.
+
+    :ivar float begin: when the ``FCGI_BEGIN_REQUEST`` record was received
+    :ivar float params_end: when the last ``FCGI_PARAMS`` record was received
+    :ivar float stdin_end: when the last ``FCGI_STDIN`` record was received
+    :ivar float first_stdout: when the first ``FCGI_STDOUT`` record was queued for sending
+    :ivar float end: when the ``FCGI_END_REQUEST`` record was queued for sending
+    """
+
+    __slots__ = ('begin', 'params_end', 'stdin_end', 'first_stdout', 'end')
+
+    def __init__(self, begin):
+        self.begin = begin
+        self.params_end = self.stdin_end = self.first_stdout = self.end = None
+
+    @staticmethod
+    def _interval(start, end):
+        if start is None or end is None:
+            return None
+
+        return end - start
+
+    def phases(self):
+        """
+        Return the durations of the phases of the request, in seconds.
+
+        The phases are ``params`` (receiving the parameters), ``stdin`` (receiving the request
+        body), ``application`` (from the end of the request input to the first output),
+        ``output`` (from the first output to the end of the request) and ``total``. The duration
+        is ``None`` for phases the request didn't complete.
+
+        :rtype: list[tuple[str, float]]
+
+        """
+        input_end = self.params_end if self.stdin_end is None else self.stdin_end
+        return [
+            ('params', self._interval(self.begin, self.params_end)),
+            ('stdin', self._interval(self.params_end, self.stdin_end)),
+            ('application', self._interval(input_end, self.first_stdout)),
+            ('output', self._interval(self.first_stdout, self.end)),
+            ('total', self._interval(self.begin, self.end))
+        ]
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (key, getattr(self, key)) for key in self.__slots__))
+
+
+class TimelineHistogram(object):
+    """
+    Aggregates request timelines into a histogram of the duration of each phase.
+
+    Instances are callable with the same signature as the ``timeline_callback`` option of
+    :class:`~fcgiproto.FastCGIConnection`, so a single instance can be shared by any number of
+    connections.
+
+    :param buckets: upper bounds of the histogram buckets, in seconds (in ascending order)
+    """
+
+    __slots__ = ('buckets', 'phase_names', '_counts', '_sums')
+
+    #: default bucket boundaries, in seconds
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                       5, 10)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.phase_names = ('params', 'stdin', 'application', 'output', 'total')
+        # One row of bucket counts (plus the +Inf bucket) per phase
+        self._counts = array('d', [0]) * ((len(self.buckets) + 1) * len(self.phase_names))
+        self._sums = array('d', [0]) * len(self.phase_names)
+
+    def __call__(self, request_id, timeline):
+        self.add(timeline)
+
+    def add(self, timeline):
+        """
+        Add the phase durations of a request to the histogram.
+
+        :param RequestTimeline timeline: the timeline of a finished request
+
+        """
+        row_length = len(self.buckets) + 1
+        for index, (phase, duration) in enumerate(timeline.phases()):
+            if duration is not None:
+                offset = index * row_length + bisect_left(self.buckets, duration)
+                self._counts[offset] += 1
+                self._sums[index] += duration
+
+    def count(self, phase):
+        """
+        Return the number of samples recorded for the given phase.
+
+        :param str phase: name of the phase
+        :rtype: int
+
+        """
+        row_length = len(self.buckets) + 1
+        offset = self.phase_names.index(phase) * row_length
+        return int(sum(self._counts[offset:offset + row_length]))
+
+    def export_prometheus(self, prefix='fcgiproto'):
+        """
+        Export the histogram in the Prometheus text exposition format.
+
+        :param str prefix: prefix for the metric name
+        :rtype: str
+
+        """
+        name = '%s_request_phase_seconds' % prefix
+        lines = ['# HELP %s Duration of the phases of FastCGI requests' % name,
+                 '# TYPE %s histogram' % name]
+        row_length = len(self.buckets) + 1
+        bounds = ['%g' % bound for bound in self.buckets] + ['+Inf']
+        for index, phase in enumerate(self.phase_names):
+            cumulative = 0
+            for bucket, bound in enumerate(bounds):
+                cumulative += self._counts[index * row_length + bucket]
+                lines.append('%s_bucket{phase="%s",le="%s"} %d' % (name, phase, bound, cumulative))
+
+            lines.append('%s_sum{phase="%s"} %r' % (name, phase, self._sums[index]))
+            lines.append('%s_count{phase="%s"} %d' % (name, phase, cumulative))
+
+        return '\n'.join(lines) + '\n'
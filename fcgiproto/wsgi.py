@@ -0,0 +1,302 @@
+"""
+WSGI gateway for the :mod:`fcgiproto.asyncio` server.
+
+The event loop runs in a single thread and handles all the I/O, while the WSGI applications are
+run in a thread pool. This module requires Python 3.5 or later.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fcgiproto.asyncio import start_server
+
+#: the amount of request body data fetched from the event loop thread at a time
+input_chunk_size = 65536
+
+
+async def _call(func, *args):
+    return func(*args)
+
+
+class WSGIInput(object):
+    """
+    The ``wsgi.input`` stream of a request.
+
+    Data is fetched from the request's :class:`~fcgiproto.asyncio.RequestStream` as the
+    application reads it, so the request body does not need to be received in full before the
+    application is called.
+    """
+
+    __slots__ = ('_stream', '_loop', '_buffer', '_eof')
+
+    def __init__(self, stream, loop):
+        self._stream = stream
+        self._loop = loop
+        self._buffer = bytearray()
+        self._eof = False
+
+    def _fill(self):
+        if not self._eof:
+            future = asyncio.run_coroutine_threadsafe(self._stream.read(input_chunk_size),
+                                                      self._loop)
+            chunk = future.result()
+            if chunk:
+                self._buffer.extend(chunk)
+            else:
+                self._eof = True
+
+        return not self._eof
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+        else:
+            while len(self._buffer) < size and self._fill():
+                pass
+
+        return self._take(size if size is not None and size >= 0 else len(self._buffer))
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            index = self._buffer.find(b'\n', start)
+            if index >= 0:
+                end = index + 1
+                break
+
+            start = len(self._buffer)
+            if (size is not None and 0 <= size <= start) or not self._fill():
+                end = start
+                break
+
+        if size is not None and size >= 0:
+            end = min(end, size)
+
+        return self._take(end)
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+
+        return line
+
+
+class WSGIErrors(object):
+    """
+    The ``wsgi.errors`` stream of a request.
+
+    Text written to this stream is sent to the web server as error output of the request.
+    """
+
+    __slots__ = ('_request', '_loop')
+
+    def __init__(self, request, loop):
+        self._request = request
+        self._loop = loop
+
+    def _write_stderr(self, data):
+        if not self._request._finished:
+            self._request.write_stderr(data)
+
+    def write(self, text):
+        self._loop.call_soon_threadsafe(self._write_stderr, text.encode('utf-8'))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+
+class WSGIGateway(object):
+    """
+    Request handler that runs a WSGI application in a thread pool.
+
+    Pass an instance of this class as the handler to :func:`fcgiproto.asyncio.start_server`, or
+    use :func:`start_wsgi_server`. The request body is streamed to the application through
+    ``wsgi.input`` as it arrives, and each item yielded by the response iterable is sent to the
+    web server as soon as the connection can accept more data.
+
+    The number of applications running at the same time is limited by the executor's worker
+    count. Requests beyond that wait in the executor's queue without tying up a thread.
+
+    :param app: a WSGI application
+    :param executor: the :class:`~concurrent.futures.Executor` to run the application in
+        (defaults to a new :class:`~concurrent.futures.ThreadPoolExecutor`)
+    :param int max_workers: the maximum number of worker threads, if no executor was given
+
+    """
+
+    __slots__ = ('app', 'executor')
+
+    def __init__(self, app, executor=None, max_workers=None):
+        self.app = app
+        self.executor = executor or ThreadPoolExecutor(max_workers)
+
+    def build_environ(self, request):
+        """
+        Build the WSGI environment for the given request.
+
+        The request parameters are decoded as ISO-8859-1, as required by :pep:`3333`. The
+        ``wsgi.input`` and ``wsgi.errors`` streams are only usable from a thread other than the
+        event loop's.
+
+        :param request: a :class:`~fcgiproto.asyncio.FastCGIRequest`
+        :rtype: dict
+
+        """
+        loop = request._protocol._loop
+        environ = {name.decode('latin-1'): value.decode('latin-1')
+                   for name, value in request.params.raw_items()}
+        environ.setdefault('REQUEST_METHOD', 'GET')
+        environ.setdefault('SCRIPT_NAME', '')
+        environ.setdefault('PATH_INFO', '')
+        environ.setdefault('QUERY_STRING', '')
+        environ.setdefault('SERVER_PROTOCOL', 'HTTP/1.1')
+        https = environ.get('HTTPS', '').lower() in ('on', '1')
+        environ.update({
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': environ.get('REQUEST_SCHEME') or ('https' if https else 'http'),
+            'wsgi.input': WSGIInput(request.body, loop),
+            'wsgi.input_terminated': True,
+            'wsgi.errors': WSGIErrors(request, loop),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        })
+        return environ
+
+    async def __call__(self, request):
+        loop = request._protocol._loop
+        environ = self.build_environ(request)
+        await loop.run_in_executor(self.executor, self._run_app, request, environ)
+        await request.end()
+
+    def _run_app(self, request, environ):
+        loop = request._protocol._loop
+        wsgi_input = environ['wsgi.input']
+        response = []
+        headers_sent = False
+
+        def call(func, *args):
+            return asyncio.run_coroutine_threadsafe(_call(func, *args), loop).result()
+
+        async def write_data(data):
+            if request._finished:
+                raise ConnectionAbortedError('the request was aborted')
+
+            await request.write(data)
+
+        def send_headers():
+            nonlocal headers_sent
+            if not response:
+                raise RuntimeError('start_response() must be called before sending data')
+
+            # FastCGI doesn't allow responding before the request body has been received, so read
+            # the rest of it in advance
+            while wsgi_input._fill():
+                pass
+
+            status, headers = response
+            headers = [(b'Status', status.encode('latin-1'))] + \
+                [(key.encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+            call(request.send_headers, headers)
+            headers_sent = True
+
+        def write(data):
+            if not headers_sent:
+                send_headers()
+
+            asyncio.run_coroutine_threadsafe(write_data(data), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if headers_sent:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            elif response:
+                raise RuntimeError('start_response() has already been called')
+
+            response[:] = [status, headers]
+            return write
+
+        result = self.app(environ, start_response)
+        try:
+            for data in result:
+                if data:
+                    write(data)
+
+            if not headers_sent:
+                send_headers()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+async def start_wsgi_server(app, host=None, port=None, *, executor=None, max_workers=None,
+                            **kwargs):
+    """
+    Start a FastCGI server that runs the given WSGI application.
+
+    :param app: a WSGI application
+    :param executor: the :class:`~concurrent.futures.Executor` to run the application in
+    :param int max_workers: the maximum number of worker threads, if no executor was given
+    :param kwargs: other keyword arguments passed to :func:`fcgiproto.asyncio.start_server`
+    :return: the server object
+    :rtype: asyncio.Server
+
+    """
+    return await start_server(WSGIGateway(app, executor, max_workers), host, port, **kwargs)
+
+
+def serve_wsgi(app, host=None, port=None, *, max_workers=None, **kwargs):
+    """
+    Run a FastCGI server for the given WSGI application until interrupted.
+
+    This creates a new event loop in the calling thread.
+
+    :param app: a WSGI application
+    :param int max_workers: the maximum number of worker threads
+    :param kwargs: other keyword arguments passed to :func:`fcgiproto.asyncio.start_server`
+
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = ThreadPoolExecutor(max_workers)
+    try:
+        server = loop.run_until_complete(
+            start_wsgi_server(app, host, port, executor=executor, **kwargs))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+    finally:
+        executor.shutdown()
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -1,13 +1,19 @@
 # coding: utf-8
 import os.path
+import platform
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 
 
 here = os.path.dirname(__file__)
 readme_path = os.path.join(here, 'README.rst')
 readme = open(readme_path).read()
 
+# The C extension is optional; if it can't be built, the pure Python implementation is used
+ext_modules = []
+if platform.python_implementation() == 'CPython':
+    ext_modules.append(Extension('fcgiproto._speedups', ['fcgiproto/_speedups.c'], optional=True))
+
 setup(
     name='fcgiproto',
     use_scm_version={
@@ -34,6 +40,7 @@ setup(
     keywords='fastcgi http',
     license='MIT',
     packages=find_packages(exclude=['tests']),
+    ext_modules=ext_modules,
     include_package_data=True,
     setup_requires=['setuptools_scm']
 )
@@ -0,0 +1,107 @@
+"""
+Client side helpers shared by the tests of the asyncio based servers.
+
+This module requires Python 3.5 or later.
+"""
+import asyncio
+import socket
+import time
+
+from fcgiproto.asyncio import start_server
+from fcgiproto.constants import FCGI_RESPONDER
+from fcgiproto.records import (
+    FCGIBeginRequest, FCGIParams, FCGIStdin, FCGIStdout, FCGIEndRequest, encode_name_value_pairs,
+    decode_record)
+
+
+def begin_request(request_id=1, flags=0, role=FCGI_RESPONDER, params=()):
+    data = FCGIBeginRequest(request_id, role, flags).encode()
+    if params:
+        data += FCGIParams(request_id, encode_name_value_pairs(params)).encode()
+
+    return data + FCGIParams(request_id, b'').encode()
+
+
+async def read_records(reader, request_ids=(1,)):
+    buffer = bytearray()
+    records = []
+    unfinished = set(request_ids)
+    while unfinished:
+        data = await reader.read(65536)
+        if not data:
+            break
+
+        buffer.extend(data)
+        while True:
+            record = decode_record(buffer)
+            if record is None:
+                break
+
+            records.append(record)
+            if isinstance(record, FCGIEndRequest):
+                unfinished.discard(record.request_id)
+
+    return records
+
+
+def stdout_data(records, request_id=1):
+    return b''.join(record.content for record in records
+                    if isinstance(record, FCGIStdout) and record.request_id == request_id)
+
+
+def run_server(loop, handler, client, **kwargs):
+    async def run():
+        server = await start_server(handler, '127.0.0.1', 0, **kwargs)
+        try:
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                return await client(reader, writer)
+            finally:
+                writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    return loop.run_until_complete(asyncio.wait_for(run(), 5))
+
+
+def send_request(address, flags=0):
+    """Act as the web server: send a request and return the response body."""
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    deadline = time.monotonic() + 5
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        try:
+            sock.connect(address)
+            break
+        except OSError:
+            # The workers may not be listening yet
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+
+            time.sleep(0.05)
+
+    with sock:
+        sock.sendall(begin_request(flags=flags) + FCGIStdin(1, b'').encode())
+        return receive_response(sock)
+
+
+def receive_response(sock):
+    """Return the response body (the PID of the worker) of a request sent to the socket."""
+    buffer = bytearray()
+    records = []
+    while not records or not isinstance(records[-1], FCGIEndRequest):
+        data = sock.recv(65536)
+        assert data, 'the connection was closed before the request was finished'
+        buffer.extend(data)
+        while True:
+            record = decode_record(buffer)
+            if record is None:
+                break
+
+            records.append(record)
+
+    return int(stdout_data(records).lstrip(b'\r\n'))
@@ -0,0 +1,21 @@
+import sys
+
+import pytest
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_asyncio.py')
+    collect_ignore.append('test_asgi.py')
+    collect_ignore.append('test_wsgi.py')
+    collect_ignore.append('test_prefork.py')
+    collect_ignore.append('test_runner.py')
+else:
+    import asyncio
+
+    @pytest.fixture
+    def loop():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        yield loop
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,116 @@
+import asyncio
+
+from fcgiproto.asgi import ASGIAdapter
+from fcgiproto.constants import FCGI_KEEP_CONN
+from fcgiproto.records import FCGIStdin
+
+from asyncio_helpers import begin_request, read_records, run_server, stdout_data
+
+
+def test_scope(loop):
+    async def app(scope, receive, send):
+        scopes.append(scope)
+        await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+        await send({'type': 'http.response.body'})
+
+    async def client(reader, writer):
+        writer.write(begin_request(params=[
+            ('REQUEST_METHOD', 'PUT'), ('REQUEST_URI', '/app/foo%20bar?x=1'),
+            ('QUERY_STRING', 'x=1'), ('SERVER_PROTOCOL', 'HTTP/1.0'), ('HTTPS', 'on'),
+            ('CONTENT_TYPE', 'text/plain'), ('HTTP_X_FOO', 'bar'), ('REMOTE_ADDR', '10.0.0.1'),
+            ('REMOTE_PORT', '5000'), ('SERVER_NAME', 'example.org'), ('SERVER_PORT', '443')
+        ]) + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    scopes = []
+    records = run_server(loop, ASGIAdapter(app, '/app'), client)
+    assert stdout_data(records) == b'Status: 204\r\n\r\n'
+    scope = scopes[0]
+    assert scope['type'] == 'http'
+    assert scope['http_version'] == '1.0'
+    assert scope['method'] == 'PUT'
+    assert scope['scheme'] == 'https'
+    assert scope['path'] == '/app/foo bar'
+    assert scope['raw_path'] == b'/app/foo%20bar'
+    assert scope['query_string'] == b'x=1'
+    assert scope['root_path'] == '/app'
+    assert scope['headers'] == [(b'content-type', b'text/plain'), (b'x-foo', b'bar')]
+    assert scope['client'] == ('10.0.0.1', 5000)
+    assert scope['server'] == ('example.org', 443)
+
+
+def test_streaming(loop):
+    async def app(scope, receive, send):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message['body'])
+            if not message['more_body']:
+                break
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+        for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b'!'})
+
+    async def client(reader, writer):
+        writer.write(begin_request(flags=FCGI_KEEP_CONN) + FCGIStdin(1, b'hello ').encode())
+        await asyncio.sleep(0.1)
+        writer.write(FCGIStdin(1, b'world').encode() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, ASGIAdapter(app), client)
+    assert stdout_data(records) == b'Status: 200\r\ncontent-type: text/plain\r\n\r\nhello world!'
+
+
+def test_early_response(loop):
+    """Test that the request body is still delivered when the app responds before reading it."""
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'early ', 'more_body': True})
+        message = await receive()
+        assert not message['more_body']
+        await send({'type': 'http.response.body', 'body': message['body']})
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'body').encode() +
+                     FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, ASGIAdapter(app), client)
+    assert stdout_data(records) == b'Status: 200\r\n\r\nearly body'
+
+
+def test_early_response_large_body(loop):
+    """Test that reading ahead a body larger than read_high_water doesn't stall."""
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'early ', 'more_body': True})
+        message = await receive()
+        await send({'type': 'http.response.body', 'body': str(len(message['body'])).encode()})
+
+    async def client(reader, writer):
+        writer.write(begin_request())
+        for _ in range(20):
+            writer.write(FCGIStdin(1, b'x' * 10000).encode())
+
+        writer.write(FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, ASGIAdapter(app), client,
+                         connection_options={'read_high_water': 50000, 'read_low_water': 10000})
+    assert stdout_data(records) == b'Status: 200\r\n\r\nearly 200000'
+
+
+def test_incomplete_response(loop):
+    async def app(scope, receive, send):
+        pass
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, ASGIAdapter(app), client)
+    assert stdout_data(records).startswith(b'Status: 500\r\n')
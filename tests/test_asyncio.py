@@ -0,0 +1,258 @@
+import asyncio
+
+import pytest
+
+from fcgiproto.asyncio import start_server
+from fcgiproto.constants import FCGI_KEEP_CONN, FCGI_REQUEST_COMPLETE, FCGI_FILTER
+from fcgiproto.records import FCGIStdin, FCGIEndRequest, FCGIAbortRequest, FCGIData, FCGIStderr
+from fcgiproto.stats import StatsRegistry, REQUESTS_COMPLETED
+
+from asyncio_helpers import begin_request, read_records, run_server, stdout_data
+
+
+def test_request_response(loop):
+    async def handler(request):
+        assert request.params['REQUEST_METHOD'] == 'POST'
+        body = await request.body.read()
+        request.write_stderr(b'got %d bytes' % len(body))
+        request.send_headers([(b'Content-Type', b'text/plain')])
+        await request.write(b'you sent: ')
+        await request.end(body)
+
+    async def client(reader, writer):
+        writer.write(begin_request(params=[('REQUEST_METHOD', 'POST')]) +
+                     FCGIStdin(1, b'hello ').encode())
+        writer.write(FCGIStdin(1, b'world').encode() + FCGIStdin(1, b'').encode())
+        records = await read_records(reader)
+        assert await reader.read() == b''  # the connection is closed without FCGI_KEEP_CONN
+        return records
+
+    records = run_server(loop, handler, client)
+    assert stdout_data(records) == b'Content-Type: text/plain\r\n\r\nyou sent: hello world'
+    assert b''.join(record.content for record in records
+                    if isinstance(record, FCGIStderr)) == b'got 11 bytes'
+    assert isinstance(records[-1], FCGIEndRequest)
+    assert records[-1].protocol_status == FCGI_REQUEST_COMPLETE
+
+
+def test_keep_connection(loop):
+    async def handler(request):
+        async for chunk in request.body:
+            pass
+
+        request.send_headers([])
+        await request.write(request.params['NUMBER'].encode('ascii'))
+
+    async def client(reader, writer):
+        responses = []
+        for number in range(3):
+            writer.write(begin_request(flags=FCGI_KEEP_CONN, params=[('NUMBER', str(number))]) +
+                         FCGIStdin(1, b'xyz').encode() + FCGIStdin(1, b'').encode())
+            responses.append(stdout_data(await read_records(reader)))
+
+        return responses
+
+    assert run_server(loop, handler, client) == [b'\r\n0', b'\r\n1', b'\r\n2']
+
+
+def test_concurrent_requests(loop):
+    async def handler(request):
+        if request.request_id == 1:
+            # This only completes if request 2 is processed concurrently
+            await event.wait()
+        else:
+            event.set()
+
+        request.send_headers([])
+        await request.end(b'response %d' % request.request_id)
+
+    async def client(reader, writer):
+        writer.write(begin_request(1, FCGI_KEEP_CONN) + begin_request(2, FCGI_KEEP_CONN) +
+                     FCGIStdin(1, b'').encode() + FCGIStdin(2, b'').encode())
+        return await read_records(reader, (1, 2))
+
+    event = asyncio.Event()
+    records = run_server(loop, handler, client)
+    assert stdout_data(records, 1) == b'\r\nresponse 1'
+    assert stdout_data(records, 2) == b'\r\nresponse 2'
+
+
+def test_filter_request(loop):
+    async def handler(request):
+        body = await request.body.read()
+        data = await request.secondary_data.read()
+        request.send_headers([])
+        await request.end(body + data)
+
+    async def client(reader, writer):
+        writer.write(begin_request(role=FCGI_FILTER) + FCGIStdin(1, b'abc').encode() +
+                     FCGIStdin(1, b'').encode() + FCGIData(1, b'def').encode() +
+                     FCGIData(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, handler, client, connection_options={'roles': [FCGI_FILTER]})
+    assert stdout_data(records) == b'\r\nabcdef'
+
+
+def test_handler_error(loop):
+    async def handler(request):
+        raise Exception('foo')
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'data').encode() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, handler, client)
+    assert stdout_data(records).startswith(b'Status: 500\r\n')
+
+
+def test_handler_error_after_headers(loop):
+    """Test that the request is not ended normally if the handler fails mid-response."""
+    async def handler(request):
+        request.send_headers([(b'Content-Type', b'text/plain')])
+        await request.write(b'partial')
+        raise Exception('foo')
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, handler, client)
+    assert not any(isinstance(record, FCGIEndRequest) for record in records)
+
+
+def test_end_error(loop):
+    """Test that the request is still finished if the handler fails to end it."""
+    async def handler(request):
+        await request.end(12345)
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, handler, client)
+    assert stdout_data(records).startswith(b'Status: 500\r\n')
+    assert isinstance(records[-1], FCGIEndRequest)
+
+
+def test_abort_request(loop):
+    async def handler(request):
+        try:
+            await request.body.read()
+        except asyncio.CancelledError:
+            cancelled.append(request.request_id)
+            raise
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'data').encode())
+        await asyncio.sleep(0.1)
+        writer.write(FCGIAbortRequest(1).encode())
+        return await read_records(reader)
+
+    cancelled = []
+    records = run_server(loop, handler, client)
+    assert cancelled == [1]
+    assert [record.__class__ for record in records] == [FCGIEndRequest]
+
+
+def test_cancel_handler(loop):
+    """Test that cancelling a handler for other reasons than an abort doesn't end the request."""
+    async def handler(request):
+        tasks.append(request._task)
+        await request.body.read()
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'data').encode())
+        while not tasks:
+            await asyncio.sleep(0.01)
+
+        tasks[0].cancel()
+        while not tasks[0].done():
+            await asyncio.sleep(0.01)
+
+    tasks = []
+    run_server(loop, handler, client)
+    assert tasks[0].cancelled()
+
+
+def test_read_flow_control(loop):
+    async def handler(request):
+        await ready.wait()
+        paused.append(request._protocol._reading_paused)
+        received = 0
+        while True:
+            chunk = await request.body.read(5000)
+            if not chunk:
+                break
+
+            received += len(chunk)
+
+        request.send_headers([])
+        await request.end(str(received).encode('ascii'))
+
+    async def client(reader, writer):
+        writer.write(begin_request())
+        for _ in range(100):
+            writer.write(FCGIStdin(1, b'x' * 10000).encode())
+
+        writer.write(FCGIStdin(1, b'').encode())
+        await asyncio.sleep(0.1)
+        ready.set()
+        return await read_records(reader)
+
+    ready = asyncio.Event()
+    paused = []
+    records = run_server(loop, handler, client,
+                         connection_options={'read_high_water': 50000, 'read_low_water': 10000})
+    assert paused == [True]
+    assert stdout_data(records) == b'\r\n1000000'
+
+
+@pytest.mark.parametrize('fail', [False, True], ids=['read', 'unread'])
+def test_read_all_flow_control(loop, fail):
+    """Test that reading a body larger than read_high_water in one go doesn't stall."""
+    async def handler(request):
+        if fail:
+            # The body is read to the end before the error response is sent
+            raise Exception('foo')
+
+        body = await request.body.read()
+        request.send_headers([])
+        await request.end(str(len(body)).encode('ascii'))
+
+    async def client(reader, writer):
+        writer.write(begin_request())
+        for _ in range(20):
+            writer.write(FCGIStdin(1, b'x' * 10000).encode())
+
+        writer.write(FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, handler, client,
+                         connection_options={'read_high_water': 50000, 'read_low_water': 10000})
+    if fail:
+        assert stdout_data(records).startswith(b'Status: 500\r\n')
+    else:
+        assert stdout_data(records) == b'\r\n200000'
+
+
+def test_stats_registry(loop):
+    async def handler(request):
+        request.send_headers([])
+        await request.end(b'ok')
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    registry = StatsRegistry()
+    run_server(loop, handler, client, stats_registry=registry)
+    assert registry.totals()[REQUESTS_COMPLETED] == 1
+
+
+def test_stats_registry_conflict(loop):
+    coro = start_server(None, '127.0.0.1', 0, connection_options={'stats': None},
+                        stats_registry=StatsRegistry())
+    exc = pytest.raises(ValueError, loop.run_until_complete, coro)
+    assert str(exc.value) == ('stats_registry and the "stats" connection option are mutually '
+                              'exclusive')
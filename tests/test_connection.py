@@ -1,13 +1,24 @@
 import pytest
 
-from fcgiproto.connection import FastCGIConnection
+from fcgiproto.connection import FastCGIConnection, FileSegment
 from fcgiproto.constants import (
     FCGI_RESPONDER, FCGI_AUTHORIZER, FCGI_FILTER, FCGI_REQUEST_COMPLETE, FCGI_UNKNOWN_ROLE)
 from fcgiproto.events import (
     RequestBeginEvent, RequestAbortEvent, RequestDataEvent, RequestSecondaryDataEvent)
+from fcgiproto.exceptions import ProtocolError
 from fcgiproto.records import (
     FCGIBeginRequest, FCGIStdin, FCGIParams, FCGIStdout, FCGIEndRequest, encode_name_value_pairs,
-    FCGIAbortRequest, FCGIGetValues, FCGIGetValuesResult, FCGIUnknownType, FCGIData)
+    FCGIAbortRequest, FCGIGetValues, FCGIGetValuesResult, FCGIUnknownType, FCGIData, FCGIStderr,
+    to_bytes)
+from fcgiproto.states import RequestState
+
+
+# memoryview.obj, used to check that data was not copied, only exists on Python 3
+memoryview_has_obj = hasattr(memoryview(b''), 'obj')
+
+
+def join(buffers):
+    return b''.join(to_bytes(buffer) for buffer in buffers)
 
 
 @pytest.fixture
@@ -170,3 +181,467 @@ def test_send_headers_invalid_value(conn):
     headers = [(b'Invalid', 1)]
     exc = pytest.raises(TypeError, conn.send_headers, 1, headers)
     assert str(exc.value) == 'header values must be bytestrings, not int'
+
+
+def test_feed_multiple_records(conn):
+    data = FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + FCGIParams(1, b'').encode()
+    data += b''.join(FCGIStdin(1, ('%d' % i).encode('ascii')).encode() for i in range(100))
+    data += FCGIStdin(1, b'').encode()
+    events = conn.feed_data(data[:-3])
+    assert len(events) == 101
+    assert [event.data for event in events[1:]] == [('%d' % i).encode('ascii') for i in range(100)]
+    assert conn._input_buffer == data[-8:-3]
+
+    events = conn.feed_data(data[-3:])
+    assert len(events) == 1
+    assert events[0].data == b''
+    assert not conn._input_buffer
+
+
+def test_zero_copy():
+    conn = FastCGIConnection(zero_copy=True)
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode())
+    content = encode_name_value_pairs([('REQUEST_METHOD', 'POST')])
+    events = conn.feed_data(FCGIParams(1, content).encode() + FCGIParams(1, b'').encode())
+    assert events[0].params == {'REQUEST_METHOD': 'POST'}
+
+    data = FCGIStdin(1, b'content').encode() + FCGIStdin(1, b'more').encode()
+    chunk = data[:-2]
+    events = conn.feed_data(chunk)
+    assert len(events) == 1
+    assert isinstance(events[0].data, memoryview)
+    if memoryview_has_obj:
+        assert events[0].data.obj is chunk
+
+    assert to_bytes(events[0].data) == b'content'
+
+    events = conn.feed_data(bytearray(data[-2:]))
+    assert len(events) == 1
+    assert isinstance(events[0].data, memoryview)
+    assert events[0].data.readonly
+    assert to_bytes(events[0].data) == b'more'
+
+
+def start_request(conn, request_id=1, role=FCGI_RESPONDER):
+    conn.feed_data(FCGIBeginRequest(request_id, role, 0).encode() +
+                   FCGIParams(request_id, b'').encode() + FCGIStdin(request_id, b'').encode())
+
+
+@pytest.mark.parametrize('data_type', [bytes, bytearray, memoryview])
+def test_send_data_large(conn, data_type):
+    body = data_type(b'x' * 65535 + b'y' * 65535 + b'z' * 10)
+    start_request(conn)
+    conn.send_data(1, body, end_request=True)
+    segments = conn.buffers_to_send()
+    if memoryview_has_obj:
+        assert all(segment.obj is getattr(body, 'obj', body) for segment in segments[1:4:2])
+    assert join(segments) == FCGIStdout(1, b'x' * 65535).encode() + \
+        FCGIStdout(1, b'y' * 65535).encode() + FCGIStdout(1, b'z' * 10).encode() + \
+        FCGIStdout(1, b'').encode() + FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode()
+
+
+def test_send_data_empty_end_request(conn):
+    start_request(conn)
+    conn.send_data(1, b'', end_request=True)
+    assert conn.data_to_send() == \
+        FCGIStdout(1, b'').encode() + FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode()
+
+
+def test_buffers_to_send(conn):
+    body = b'x' * 2000
+    start_request(conn)
+    conn.send_headers(1, [(b'Content-Length', b'2004')])
+    conn.send_data(1, body)
+    conn.send_data(1, b'tail', end_request=True)
+    buffers = conn.buffers_to_send()
+    assert len(buffers) == 3
+    assert buffers[1] is body
+    assert join(buffers) == \
+        FCGIStdout(1, b'Content-Length: 2004\r\n\r\n').encode() + FCGIStdout(1, body).encode() + \
+        FCGIStdout(1, b'tail').encode() + FCGIStdout(1, b'').encode() + \
+        FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode()
+    assert conn.buffers_to_send() == []
+
+    # The returned buffers must not be modified by the connection afterwards
+    conn.feed_data(FCGIGetValues(['FCGI_MPXS_CONNS']).encode())
+    assert bytes(buffers[2]).endswith(FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode())
+
+
+def test_data_to_send_buffer_types(conn):
+    """Test that data_to_send() joins bytearray and memoryview output into a bytestring."""
+    start_request(conn)
+    conn.send_data(1, bytearray(b'abc'))
+    conn.send_data(1, memoryview(b'def'), end_request=True)
+    data = conn.data_to_send()
+    assert isinstance(data, bytes)
+    assert data == FCGIStdout(1, b'abc').encode() + FCGIStdout(1, b'def').encode() + \
+        FCGIStdout(1, b'').encode() + FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode()
+
+
+@pytest.mark.skipif(not memoryview_has_obj, reason='memoryview.obj is not available')
+@pytest.mark.parametrize('use_buffer', [False, True], ids=['feed_data', 'get_buffer'])
+def test_zero_copy_misaligned_reads(use_buffer):
+    """
+    Test that only records split across reads are copied, and the rest of each read is decoded
+    in place.
+
+    """
+    conn = FastCGIConnection(zero_copy=True)
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + FCGIParams(1, b'').encode())
+    body = b''.join(letter * 1000 for letter in (b'a', b'b', b'c', b'd', b'e', b'f', b'g'))
+    data = b''.join(FCGIStdin(1, body[i:i + 1000]).encode() for i in range(0, len(body), 1000))
+    received = []
+    in_place = 0
+    for i in range(0, len(data), 2500):
+        if use_buffer:
+            chunk = conn.get_buffer()
+            chunk[:len(data[i:i + 2500])] = data[i:i + 2500]
+            events = conn.buffer_updated(len(data[i:i + 2500]))
+            chunk = chunk.obj
+        else:
+            chunk = data[i:i + 2500]
+            events = conn.feed_data(chunk)
+
+        assert len(conn._input_buffer) < 1008
+        for event in events:
+            received.append(bytes(event.data))
+            in_place += event.data.obj is chunk
+
+    assert b''.join(received) == body
+    assert in_place == 5  # two of the seven records straddle a read boundary
+
+
+@pytest.mark.parametrize('zero_copy', [False, True], ids=['copy', 'zero_copy'])
+def test_get_buffer(zero_copy):
+    conn = FastCGIConnection(zero_copy=zero_copy)
+    data = FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + FCGIParams(1, b'').encode() + \
+        FCGIStdin(1, b'content').encode() + FCGIStdin(1, b'').encode()
+
+    buffer = conn.get_buffer()
+    assert len(buffer) == 65536
+    buffer[:len(data) - 4] = data[:-4]
+    events = conn.buffer_updated(len(data) - 4)
+    assert len(events) == 2
+    assert to_bytes(events[1].data) == b'content'
+    assert isinstance(events[1].data, memoryview if zero_copy else bytes)
+
+    next_buffer = conn.get_buffer(100000)
+    assert len(next_buffer) == 100000
+    next_buffer[:4] = data[-4:]
+    received = events[1].data
+    events = conn.buffer_updated(4)
+    assert len(events) == 1
+    assert to_bytes(events[0].data) == b''
+
+    # Reusing the receive buffer must not affect data from previously generated events
+    conn.get_buffer()[:7] = b'garbage'
+    assert to_bytes(received) == b'content'
+
+
+def test_params_span_records(conn):
+    content = encode_name_value_pairs([('REQUEST_METHOD', 'GET'), ('QUERY_STRING', 'a=1')])
+    events = conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() +
+                            FCGIParams(1, content[:5]).encode() +
+                            FCGIParams(1, content[5:20]).encode() +
+                            FCGIParams(1, content[20:]).encode() + FCGIParams(1, b'').encode())
+    assert events[0].params == {'REQUEST_METHOD': 'GET', 'QUERY_STRING': 'a=1'}
+
+
+def test_params_decoded_incrementally(conn):
+    """Test that only the data of an incomplete pair is buffered while receiving parameters."""
+    content = encode_name_value_pairs([('REQUEST_METHOD', 'GET'), ('QUERY_STRING', 'a=1')])
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() +
+                   FCGIParams(1, content[:20]).encode())
+    state = conn._request_states[1]
+    assert list(state.params.items()) == [(b'REQUEST_METHOD', b'GET')]
+    assert state.params_decoder._buffer == content[19:20]
+
+    events = conn.feed_data(FCGIParams(1, content[20:]).encode() + FCGIParams(1, b'').encode())
+    assert events[0].params._pairs is not state.params
+    assert events[0].params == {'REQUEST_METHOD': 'GET', 'QUERY_STRING': 'a=1'}
+    assert not state.params
+    assert not state.params_decoder._buffer
+
+
+def test_params_incomplete_pair(conn):
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() +
+                   FCGIParams(1, b'\x03\x06foo').encode())
+    exc = pytest.raises(ProtocolError, conn.feed_data, FCGIParams(1, b'bar').encode() +
+                        FCGIParams(1, b'').encode())
+    assert str(exc.value).endswith('name/value data missing from buffer')
+
+
+def test_coalesce_data():
+    conn = FastCGIConnection(roles=[FCGI_FILTER], coalesce_data=True)
+    conn.feed_data(FCGIBeginRequest(1, FCGI_FILTER, 0).encode() + FCGIParams(1, b'').encode() +
+                   FCGIBeginRequest(2, FCGI_FILTER, 0).encode() + FCGIParams(2, b'').encode())
+    events = conn.feed_data(
+        FCGIStdin(1, b'a').encode() + FCGIStdin(2, b'x').encode() + FCGIStdin(1, b'b').encode() +
+        FCGIStdin(1, b'c').encode() + FCGIStdin(1, b'').encode() + FCGIData(1, b'd').encode() +
+        FCGIData(1, b'e').encode() + FCGIStdin(2, b'y').encode())
+    assert [(type(event), event.request_id, event.data) for event in events] == [
+        (RequestDataEvent, 1, b'abc'),
+        (RequestDataEvent, 2, b'xy'),
+        (RequestDataEvent, 1, b''),
+        (RequestSecondaryDataEvent, 1, b'de')
+    ]
+
+    events = conn.feed_data(FCGIStdin(2, b'z').encode())
+    assert [(event.request_id, event.data) for event in events] == [(2, b'z')]
+
+
+def test_write_flow_control():
+    conn = FastCGIConnection(write_high_water=3000, write_low_water=1000)
+    start_request(conn)
+    assert conn.is_writable
+    assert conn.send_data(1, b'x' * 2000)
+    assert conn.pending_bytes == 2008
+    assert not conn.send_data(1, b'y' * 2000)
+    assert conn.pending_bytes == 4016
+    assert not conn.is_writable
+
+    buffers = conn.buffers_to_send(2500)
+    assert sum(len(buffer) for buffer in buffers) == 2008
+    assert conn.pending_bytes == 2008
+    assert not conn.is_writable
+
+    buffers += conn.buffers_to_send(10)
+    assert conn.pending_bytes == 0
+    assert conn.is_writable
+    assert join(buffers) == \
+        FCGIStdout(1, b'x' * 2000).encode() + FCGIStdout(1, b'y' * 2000).encode()
+
+
+def test_write_flow_control_invalid_limits():
+    exc = pytest.raises(ValueError, FastCGIConnection, write_high_water=1000, write_low_water=1001)
+    assert str(exc.value) == 'write_low_water must not be greater than write_high_water'
+
+
+def test_read_flow_control():
+    conn = FastCGIConnection(read_high_water=3000, read_low_water=1000)
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + FCGIParams(1, b'').encode() +
+                   FCGIBeginRequest(2, FCGI_RESPONDER, 0).encode() + FCGIParams(2, b'').encode())
+    conn.feed_data(FCGIStdin(1, b'x' * 2000).encode() + FCGIStdin(2, b'y' * 1500).encode())
+    assert conn.unacknowledged_bytes() == 3500
+    assert conn.unacknowledged_bytes(1) == 2000
+    assert conn.unacknowledged_bytes(2) == 1500
+    assert conn.should_pause_reading
+
+    conn.acknowledge_data(1, 2000)
+    assert conn.unacknowledged_bytes() == 1500
+    assert conn.should_pause_reading
+
+    # Finishing the request drops its unacknowledged data from the total
+    conn.feed_data(FCGIStdin(2, b'').encode())
+    conn.send_data(2, b'', end_request=True)
+    assert conn.unacknowledged_bytes() == 0
+    assert conn.unacknowledged_bytes(2) == 0
+    assert not conn.should_pause_reading
+
+    # Acknowledging data of finished requests or more data than received is harmless
+    conn.acknowledge_data(2, 100)
+    conn.acknowledge_data(1, 100)
+    assert conn.unacknowledged_bytes() == 0
+
+
+def test_read_flow_control_abort(conn):
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + FCGIParams(1, b'').encode() +
+                   FCGIStdin(1, b'x' * 100).encode())
+    assert conn.unacknowledged_bytes() == 100
+    conn.feed_data(FCGIAbortRequest(1).encode())
+    assert conn.unacknowledged_bytes() == 0
+
+
+def test_read_flow_control_invalid_limits():
+    exc = pytest.raises(ValueError, FastCGIConnection, read_high_water=1000, read_low_water=1001)
+    assert str(exc.value) == 'read_low_water must not be greater than read_high_water'
+
+
+def test_send_stderr(conn):
+    start_request(conn)
+    conn.send_stderr(1, b'first\n')
+    conn.send_stderr(1, bytearray(b'second\n'))
+    assert conn.data_to_send() == b''
+
+    conn.send_headers(1, [(b'Content-Type', b'text/plain')])
+    conn.send_stderr(1, b'third\n')
+    conn.send_data(1, b'body', end_request=True)
+    assert conn.data_to_send() == (
+        FCGIStderr(1, b'first\nsecond\n').encode() +
+        FCGIStdout(1, b'Content-Type: text/plain\r\n\r\n').encode() +
+        FCGIStderr(1, b'third\n').encode() +
+        FCGIStdout(1, b'body').encode() +
+        FCGIStdout(1, b'').encode() +
+        FCGIStderr(1, b'').encode() +
+        FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode())
+
+
+def test_send_stderr_flush(conn):
+    start_request(conn)
+    conn.send_stderr(1, b'message', flush=True)
+    assert conn.data_to_send() == FCGIStderr(1, b'message').encode()
+
+    # Large amounts of error output are sent without waiting for a flush
+    conn.send_stderr(1, b'x' * 70000)
+    assert conn.data_to_send() == (FCGIStderr(1, b'x' * 65535).encode() +
+                                   FCGIStderr(1, b'x' * 4465).encode())
+
+    conn.send_data(1, b'', end_request=True)
+    assert conn.data_to_send() == (FCGIStdout(1, b'').encode() + FCGIStderr(1, b'').encode() +
+                                   FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode())
+
+
+def test_send_stderr_invalid_state(conn):
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode())
+    exc = pytest.raises(ProtocolError, conn.send_stderr, 1, b'message')
+    assert str(exc.value) == ('FastCGI protocol violation: cannot send FCGIStderr record in the '
+                              'EXPECT_PARAMS state')
+
+
+def test_send_file(conn, tmpdir):
+    path = tmpdir.join('file')
+    path.write_binary(b'a' * 10 + b'x' * 65535 + b'y' * 100 + b'b' * 10)
+    with path.open('rb') as f:
+        start_request(conn)
+        conn.send_headers(1, [])
+        assert not conn.send_file(1, f.fileno(), 10, 65635, end_request=True)
+        plan = conn.output_plan()
+        assert [item.__class__ for item in plan] == [bytearray, FileSegment, bytearray,
+                                                     FileSegment, bytearray]
+        assert [(item.offset, item.count) for item in plan[1::2]] == [(10, 65535), (65545, 100)]
+        assert join(item.read() if isinstance(item, FileSegment) else item
+                    for item in plan) == (
+            FCGIStdout(1, b'\r\n').encode() + FCGIStdout(1, b'x' * 65535).encode() +
+            FCGIStdout(1, b'y' * 100).encode() + FCGIStdout(1, b'').encode() +
+            FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode())
+        assert conn.pending_bytes == 0
+        assert conn.is_writable
+
+
+def test_send_file_read(conn, tmpdir):
+    path = tmpdir.join('file')
+    path.write_binary(b'abcdef')
+    with path.open('rb') as f:
+        start_request(conn)
+        conn.send_file(1, f.fileno(), 1, 4)
+        conn.send_data(1, b'ghi')
+        assert conn.data_to_send() == (FCGIStdout(1, b'bcde').encode() +
+                                       FCGIStdout(1, b'ghi').encode())
+
+        # A failed read must leave the queued output of all requests intact
+        start_request(conn, 2)
+        conn.send_file(1, f.fileno(), 4, 4)
+        conn.send_data(2, b'xyz')
+        pending_bytes = conn.pending_bytes
+        exc = pytest.raises(IOError, conn.data_to_send)
+        assert str(exc.value) == 'file ended 2 bytes short of the segment end'
+        assert conn.pending_bytes == pending_bytes
+
+        path.write_binary(b'abcdefgh')
+        assert conn.data_to_send() == (FCGIStdout(1, b'efgh').encode() +
+                                       FCGIStdout(2, b'xyz').encode())
+
+
+@pytest.mark.parametrize('priority', [1, 2])
+def test_output_scheduling(conn, priority):
+    body = b'x' * 65535 * 3
+    start_request(conn, 1)
+    start_request(conn, 2)
+    conn.set_priority(1, priority)
+    conn.send_data(1, body, end_request=True)
+    conn.send_headers(2, [])
+    conn.send_data(2, b'small', end_request=True)
+
+    # The small response is sent after the first turn of the large one
+    large_records = [FCGIStdout(1, b'x' * 65535).encode()] * 3 + [
+        FCGIStdout(1, b'').encode() + FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode()]
+    small_records = [
+        FCGIStdout(2, b'\r\n').encode() + FCGIStdout(2, b'small').encode() +
+        FCGIStdout(2, b'').encode() + FCGIEndRequest(2, 0, FCGI_REQUEST_COMPLETE).encode()]
+    expected = large_records[:priority] + small_records + large_records[priority:]
+    assert conn.data_to_send() == b''.join(expected)
+    assert conn.pending_bytes == 0
+    assert not conn._output_queues
+
+
+def test_output_scheduling_partial(conn):
+    start_request(conn, 1)
+    start_request(conn, 2)
+    conn.send_data(1, b'x' * 65535 * 2)
+    conn.send_data(2, b'y' * 2000)
+    conn.send_data(1, b'z')
+
+    # Records are never split when switching between requests
+    assert join(conn.buffers_to_send(66000)) == FCGIStdout(1, b'x' * 65535).encode()
+    assert join(conn.buffers_to_send(66000)) == FCGIStdout(2, b'y' * 2000).encode()
+    assert join(conn.buffers_to_send()) == (FCGIStdout(1, b'x' * 65535).encode() +
+                                            FCGIStdout(1, b'z').encode())
+
+
+def test_output_small_drains(conn):
+    start_request(conn)
+    for i in range(100):
+        conn.send_data(1, b'x' * 2000)
+
+    buffers = []
+    while conn.pending_bytes:
+        buffers += conn.buffers_to_send(1)
+        queue = conn._output_queues.get(1)
+        if queue is not None:
+            # The retrieved items are discarded in batches, not one by one
+            assert queue.head * 2 < len(queue.items)
+
+    assert join(buffers) == FCGIStdout(1, b'x' * 2000).encode() * 100
+
+
+def test_set_priority_invalid(conn):
+    exc = pytest.raises(ValueError, conn.set_priority, 1, 0)
+    assert str(exc.value) == 'priority must be a positive integer'
+
+
+def test_unknown_request_id(conn):
+    exc = pytest.raises(ProtocolError, conn.feed_data, FCGIStdin(5, b'data').encode())
+    assert str(exc.value) == ('FastCGI protocol violation: received unexpected FCGIStdin record '
+                              'in the EXPECT_BEGIN_REQUEST state')
+    exc = pytest.raises(ProtocolError, conn.send_data, 5, b'data')
+    assert str(exc.value) == ('FastCGI protocol violation: cannot send FCGIStdout record in the '
+                              'EXPECT_BEGIN_REQUEST state')
+    assert not conn._request_states
+
+
+def test_request_state_reuse(conn):
+    start_request(conn, 1)
+    request_state = conn._request_states[1]
+    conn.send_data(1, b'', end_request=True)
+    assert conn._request_states == {}
+    assert conn._state_pool == [request_state]
+
+    start_request(conn, 2)
+    assert conn._request_states[2] is request_state
+    assert request_state.state == RequestState.EXPECT_STDOUT
+    assert conn._state_pool == []
+
+
+def test_close(conn):
+    start_request(conn, 1)
+    start_request(conn, 2)
+    conn.feed_data(FCGIBeginRequest(3, FCGI_RESPONDER, 0).encode() +
+                   FCGIParams(3, b'').encode() + FCGIStdin(3, b'data').encode())
+    conn.send_data(1, b'data')
+    assert sorted(conn.close()) == [1, 2, 3]
+    assert conn._request_states == {}
+    assert len(conn._state_pool) == 3
+    assert conn.unacknowledged_bytes() == 0
+    assert conn.pending_bytes == 0
+    assert conn.data_to_send() == b''
+
+
+@pytest.mark.parametrize('record, state', [
+    (FCGIStdin(1, b'data'), 'EXPECT_PARAMS'),
+    (FCGIData(1, b'data'), 'EXPECT_PARAMS')
+], ids=['stdin', 'data'])
+def test_data_unexpected_state(conn, record, state):
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode())
+    exc = pytest.raises(ProtocolError, conn.feed_data, record.encode())
+    assert str(exc.value) == ('FastCGI protocol violation: received unexpected %s record in the '
+                              '%s state' % (record.__class__.__name__, state))
@@ -0,0 +1,64 @@
+# coding: utf-8
+from collections import OrderedDict
+
+import pytest
+
+from fcgiproto.events import RequestParams, RequestBeginEvent
+from fcgiproto.records import encode_name_value_pairs
+
+
+@pytest.fixture
+def params():
+    return RequestParams([(b'REQUEST_METHOD', b'GET'),
+                          (b'QUERY_STRING', u'ä=ö'.encode('utf-8'))])
+
+
+def test_params_mapping(params):
+    assert params[u'REQUEST_METHOD'] == u'GET'
+    assert params[b'QUERY_STRING'] == u'ä=ö'
+    assert list(params) == [u'REQUEST_METHOD', u'QUERY_STRING']
+    assert len(params) == 2
+    assert params == {u'REQUEST_METHOD': u'GET', u'QUERY_STRING': u'ä=ö'}
+    assert params.get(u'CONTENT_LENGTH') is None
+    pytest.raises(KeyError, params.__getitem__, u'CONTENT_LENGTH')
+    pytest.raises(KeyError, params.__getitem__, u'Ä')
+
+
+def test_params_contains(params):
+    assert u'REQUEST_METHOD' in params
+    assert b'REQUEST_METHOD' in params
+    assert u'CONTENT_LENGTH' not in params
+    assert u'Ä' not in params
+
+
+def test_params_bytes(params):
+    assert params.get_bytes(u'QUERY_STRING') == u'ä=ö'.encode('utf-8')
+    assert params.get_bytes(b'REQUEST_METHOD') == b'GET'
+    assert params.get_bytes(u'Ä', b'default') == b'default'
+    assert params.raw_items() == [(b'REQUEST_METHOD', b'GET'),
+                                  (b'QUERY_STRING', u'ä=ö'.encode('utf-8'))]
+
+
+def test_params_from_encoded():
+    params = RequestParams.from_encoded(encode_name_value_pairs(
+        [(b'REQUEST_METHOD', b'GET'), (b'QUERY_STRING', u'\xe4'.encode('utf-8'))]))
+    assert params._pairs is None
+    assert params[u'QUERY_STRING'] == u'\xe4'
+    assert params.raw_items() == [(b'REQUEST_METHOD', b'GET'),
+                                  (b'QUERY_STRING', u'\xe4'.encode('utf-8'))]
+    assert params._encoded is None
+
+
+def test_params_from_raw_pairs():
+    pairs = OrderedDict([(b'REQUEST_METHOD', b'GET')])
+    params = RequestParams.from_raw_pairs(pairs)
+    assert params._pairs is pairs
+    assert params == {u'REQUEST_METHOD': u'GET'}
+
+
+def test_begin_event_params(params):
+    assert RequestBeginEvent(1, 1, 0, params).params is params
+    converted = RequestBeginEvent(1, 1, 0, [(u'FOO', u'b\xe4r')]).params
+    assert isinstance(converted, RequestParams)
+    assert converted == {u'FOO': u'b\xe4r'}
+    assert converted.get_bytes(u'FOO') == u'b\xe4r'.encode('utf-8')
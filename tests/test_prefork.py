@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import signal
+import time
+
+import pytest
+
+from fcgiproto.constants import FCGI_KEEP_CONN
+from fcgiproto.prefork import PreforkServer
+
+from asyncio_helpers import send_request
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='os.fork() is not available')
+
+
+async def handle_request(request):
+    await request.body.read()
+    request.send_headers([])
+    await request.end(str(os.getpid()).encode('ascii'))
+
+
+@pytest.fixture
+def run_server():
+    processes = []
+
+    def run(server):
+        server.listen()
+        process = multiprocessing.get_context('fork').Process(target=server.run)
+        process.start()
+        processes.append(process)
+        # The supervisor's copy of the sockets is all that's needed from now on
+        address = server.addresses[0]
+        server.sockets = None
+        return process, address
+
+    yield run
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+
+def test_unix_socket_max_requests(tmpdir, run_server):
+    path = str(tmpdir.join('fcgi.sock'))
+    server = PreforkServer(handle_request, path=path, workers=1, max_requests=1)
+    process, address = run_server(server)
+    pids = [send_request(address, FCGI_KEEP_CONN) for _ in range(3)]
+    assert len(set(pids)) == 3
+    assert process.pid not in pids
+
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(5)
+    assert process.exitcode == 0
+    assert not os.path.exists(path)
+
+
+def test_reuse_port_reload(run_server):
+    server = PreforkServer(handle_request, '127.0.0.1', 0, workers=2, reuse_port=True)
+    process, address = run_server(server)
+    old_pids = {send_request(address) for _ in range(10)}
+
+    os.kill(process.pid, signal.SIGHUP)
+    deadline = time.monotonic() + 5
+    while True:
+        pid = send_request(address)
+        if pid not in old_pids:
+            break
+
+        assert time.monotonic() < deadline, 'the workers were not replaced'
+        time.sleep(0.05)
+
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(5)
+    assert process.exitcode == 0
+
+
+def test_worker_restart(run_server):
+    server = PreforkServer(handle_request, '127.0.0.1', 0, workers=1)
+    process, address = run_server(server)
+    pid = send_request(address)
+    os.kill(pid, signal.SIGKILL)
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            new_pid = send_request(address)
+        except OSError:
+            new_pid = pid
+
+        if new_pid != pid:
+            break
+
+        assert time.monotonic() < deadline, 'the worker was not restarted'
+        time.sleep(0.05)
+
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(5)
+    assert process.exitcode == 0
+
+
+def test_invalid_arguments():
+    pytest.raises(ValueError, PreforkServer, handle_request)
+    pytest.raises(ValueError, PreforkServer, port=9000)
+    pytest.raises(ValueError, PreforkServer, handle_request, port=9000,
+                  handler_factory=lambda: handle_request)
+    pytest.raises(ValueError, PreforkServer, handle_request, path='/tmp/foo', reuse_port=True)
@@ -3,7 +3,8 @@ import pytest
 from fcgiproto.records import (
     encode_name_value_pairs, decode_name_value_pairs, decode_record, FCGIStdin, FCGIBeginRequest,
     FCGIEndRequest, FCGIUnknownType, FCGIStdout, FCGIGetValues, FCGIGetValuesResult,
-    FCGIAbortRequest)
+    FCGIAbortRequest, decode_record_from, decode_raw_name_value_pairs, NameValuePairDecoder,
+    FCGIParams)
 from fcgiproto.exceptions import ProtocolError
 
 
@@ -135,3 +136,57 @@ def test_decode_unknown_record_type():
     buffer = bytearray(b'\x01\x0c\x01\x00\x00\x00\x00\x00')
     exc = pytest.raises(ProtocolError, decode_record, buffer)
     assert str(exc.value).endswith('unknown record type: 12')
+
+
+def test_decode_record_from():
+    buffer = bytearray(b'\x01\x05\x00\x01\x00\x03\x01\x00foo\x00'
+                       b'\x01\x05\x00\x01\x00\x03\x00\x00bar\x01\x05')
+    record, offset = decode_record_from(buffer, 0)
+    assert record.content == b'foo'
+    assert offset == 12
+    record, offset = decode_record_from(buffer, offset)
+    assert record.content == b'bar'
+    assert offset == 23
+    assert decode_record_from(buffer, offset) == (None, 23)
+    assert len(buffer) == 25
+
+
+@pytest.mark.parametrize('record', [
+    FCGIStdout(5, b'data'),
+    FCGIStdout(5, memoryview(b'data')),
+    FCGIParams(1, b''),
+    FCGIBeginRequest(5, 1, 1),
+    FCGIEndRequest(5, 65537, 2),
+    FCGIUnknownType(12),
+    FCGIAbortRequest(5),
+    FCGIGetValues(['FOO', 'BAR']),
+    FCGIGetValuesResult([('FOO', 'abc')])
+], ids=lambda record: record.__class__.__name__)
+def test_encode_into(record):
+    buffer = bytearray(b'xyz')
+    expected = record.encode()
+    assert record.encode_into(buffer) == len(expected)
+    assert buffer == b'xyz' + expected
+
+
+def test_decode_raw_name_value_pairs():
+    buffer = bytearray(b'\x03\x06foobarbar\x01\x00X')
+    assert decode_raw_name_value_pairs(buffer) == [(b'foo', b'barbar'), (b'X', b'')]
+
+
+def test_name_value_pair_decoder():
+    pairs = [(b'foo', b'barbar'), (b'x' * 200, b'y' * 300), (b'X', b'')]
+    data = encode_name_value_pairs(pairs)
+    for split in range(len(data)):
+        decoder = NameValuePairDecoder()
+        decoded = decoder.feed(data[:split])
+        decoded += decoder.feed(memoryview(data)[split:])
+        decoder.close()
+        assert decoded == pairs
+
+
+def test_name_value_pair_decoder_incomplete():
+    decoder = NameValuePairDecoder()
+    assert decoder.feed(b'\x03\x06foobarbar\x01') == [(b'foo', b'barbar')]
+    exc = pytest.raises(ProtocolError, decoder.close)
+    assert str(exc.value).endswith('not enough data to decode value length in name-value pair')
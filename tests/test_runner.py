@@ -0,0 +1,108 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import fcgiproto
+from fcgiproto.records import FCGIStdin
+from fcgiproto.runner import inherited_sockets, load_application
+
+from asyncio_helpers import begin_request, receive_response, send_request
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='os.fork() is not available')
+
+tests_dir = os.path.dirname(__file__)
+env = dict(os.environ,
+           PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(fcgiproto.__file__))))
+runner_args = [sys.executable, '-m', 'fcgiproto.runner', '--workers', '1',
+               'test_prefork:handle_request']
+
+
+@pytest.fixture
+def listening_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(10)
+    yield sock
+    sock.close()
+
+
+def stop(process):
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(10) == 0
+
+
+def test_fcgi_listensock(listening_socket):
+    """Test that a listening socket passed as standard input is adopted."""
+    address = listening_socket.getsockname()
+    process = subprocess.Popen(runner_args, stdin=listening_socket.fileno(), cwd=tests_dir,
+                               env=env)
+    try:
+        pid = send_request(address)
+        assert pid != process.pid
+    finally:
+        stop(process)
+
+    # Requests sent while no server is running are served by the next one
+    with socket.create_connection(address) as client:
+        client.sendall(begin_request() + FCGIStdin(1, b'').encode())
+        process = subprocess.Popen(runner_args, stdin=listening_socket.fileno(), cwd=tests_dir,
+                                   env=env)
+        try:
+            client.settimeout(5)
+            assert receive_response(client) != pid
+        finally:
+            stop(process)
+
+
+def test_systemd_socket_activation(listening_socket):
+    # The shell replaces itself with Python, so its PID is the one the server will have
+    script = 'LISTEN_PID=$$ LISTEN_FDS=1 exec "$@" 3<&0 0</dev/null'
+    process = subprocess.Popen(['sh', '-c', script, 'sh'] + runner_args,
+                               stdin=listening_socket.fileno(), cwd=tests_dir, env=env)
+    try:
+        assert send_request(listening_socket.getsockname())
+    finally:
+        stop(process)
+
+
+def test_reload_imports_application(tmpdir, listening_socket):
+    """Test that the application is imported in the workers, so that SIGHUP picks up changes."""
+    app_source = """
+async def handle_request(request):
+    await request.body.read()
+    request.send_headers([])
+    await request.end(b'%d')
+"""
+    tmpdir.join('reloadable.py').write(app_source % 1)
+    process = subprocess.Popen([sys.executable, '-m', 'fcgiproto.runner', '--workers', '1',
+                                'reloadable:handle_request'], stdin=listening_socket.fileno(),
+                               cwd=str(tmpdir), env=dict(env, PYTHONDONTWRITEBYTECODE='1'))
+    try:
+        address = listening_socket.getsockname()
+        assert send_request(address) == 1
+        tmpdir.join('reloadable.py').write(app_source % 2)
+        process.send_signal(signal.SIGHUP)
+        deadline = time.monotonic() + 5
+        while send_request(address) != 2:
+            assert time.monotonic() < deadline, 'the application was not reloaded'
+            time.sleep(0.05)
+    finally:
+        stop(process)
+
+
+def test_inherited_sockets_other_pid():
+    environ = {'LISTEN_PID': '1', 'LISTEN_FDS': '1'}
+    if not os.isatty(0):
+        assert inherited_sockets(environ) == []
+
+    assert environ == {'LISTEN_PID': '1', 'LISTEN_FDS': '1'}
+
+
+def test_load_application():
+    assert load_application('os.path:join') is os.path.join
+    pytest.raises(ValueError, load_application, 'os.path')
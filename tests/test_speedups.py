@@ -0,0 +1,95 @@
+import pytest
+
+from fcgiproto import records
+from fcgiproto.exceptions import ProtocolError
+
+
+@pytest.fixture(params=['python', 'speedups'])
+def backend(request):
+    if request.param == 'speedups':
+        return pytest.importorskip('fcgiproto._speedups')
+    else:
+        return type('PythonBackend', (object,), {
+            name: staticmethod(func) for name, func in records._python_implementations.items()})
+
+
+@pytest.mark.parametrize('buffer_type', [bytes, bytearray, memoryview])
+def test_unpack_header(backend, buffer_type):
+    buffer = buffer_type(b'xx\x01\x05\x01\x02\xff\xfe\x03\x00content')
+    assert backend.unpack_header(buffer, 2) == (5, 258, 65534, 3)
+    assert backend.unpack_header(buffer, 12) is None
+
+
+def test_unpack_header_wrong_version(backend):
+    exc = pytest.raises(ProtocolError, backend.unpack_header, b'\x02\x01\x00\x01\x00\x00\x00\x00',
+                        0)
+    assert str(exc.value).endswith('unexpected protocol version: 2')
+
+
+@pytest.mark.parametrize('buffer_type', [bytes, bytearray, memoryview])
+def test_decode_pairs_from(backend, buffer_type):
+    data = b'..\x03\x06foobarbar\x80\x00\x01\x00\x00' + b'x' * 256 + b'\x01\x05X'
+    pairs, offset = backend.decode_pairs_from(buffer_type(data), 2)
+    assert pairs == [(b'foo', b'barbar'), (b'x' * 256, b'')]
+    assert offset == len(data) - 3
+    assert all(type(item) is bytes for pair in pairs for item in pair)
+
+
+@pytest.mark.parametrize('data', [b'\x80\x00\x00', b'\x03', b'\x03\x06foo', b''],
+                         ids=['name_length', 'value_length', 'content', 'empty'])
+def test_decode_pairs_from_incomplete(backend, data):
+    assert backend.decode_pairs_from(data, 0) == ([], 0)
+
+
+def test_decode_pairs_from_maximal_lengths(backend):
+    """Test that lengths near the maximum can't make the bounds check overflow."""
+    data = b'\xff\xff\xff\xff\xff\xff\xff\xffxy'
+    pairs, offset = backend.decode_pairs_from(data, 0)
+    assert (pairs, offset) == ([], 0)
+    exc = pytest.raises(ProtocolError, records.check_pairs_end, data, offset)
+    assert str(exc.value).endswith('name/value data missing from buffer')
+
+
+@pytest.mark.parametrize('buffer_type', [bytes, bytearray, memoryview])
+def test_scan_pairs_from(backend, buffer_type):
+    data = b'..\x03\x06foobarbar\x80\x00\x01\x00\x00' + b'x' * 256 + b'\x01\x05X'
+    assert backend.scan_pairs_from(buffer_type(data), 2) == len(data) - 3
+    assert backend.scan_pairs_from(buffer_type(data), len(data)) == len(data)
+
+
+@pytest.mark.parametrize('data', [b'\x80\x00\x00', b'\x03', b'\x03\x06foo',
+                                  b'\xff\xff\xff\xff\xff\xff\xff\xffxy'],
+                         ids=['name_length', 'value_length', 'content', 'huge_lengths'])
+def test_scan_pairs_from_incomplete(backend, data):
+    assert backend.scan_pairs_from(data, 0) == 0
+
+
+def test_encode_name_value_pairs(backend):
+    pairs = [(u'foo', b'barbar'), [b'x' * 200, u'y' * 128], (u'', u'')]
+    assert backend.encode_name_value_pairs(pairs) == \
+        b'\x03\x06foobarbar\x80\x00\x00\xc8\x80\x00\x00\x80' + b'x' * 200 + b'y' * 128 + \
+        b'\x00\x00'
+
+
+def test_encode_name_value_pairs_non_ascii(backend):
+    pytest.raises(UnicodeEncodeError, backend.encode_name_value_pairs, [(u'foo', u'\xe4')])
+
+
+@pytest.mark.parametrize('data_type', [bytes, bytearray, memoryview])
+def test_frame_records(backend, data_type):
+    data = data_type(b'x' * 65535 + b'y')
+    parts = backend.frame_records(6, 258, data)
+    assert len(parts) == 4
+    assert parts[0] == b'\x01\x06\x01\x02\xff\xff\x00\x00'
+    assert isinstance(parts[1], memoryview)
+    assert parts[1] == b'x' * 65535
+    assert parts[2] == b'\x01\x06\x01\x02\x00\x01\x00\x00'
+    assert parts[3] == b'y'
+
+
+def test_frame_records_single(backend):
+    data = b'data'
+    header, part = backend.frame_records(6, 5, data)
+    assert header == b'\x01\x06\x00\x05\x00\x04\x00\x00'
+    assert part is data
+    assert backend.frame_records(6, 5, b'') == [b'\x01\x06\x00\x05\x00\x00\x00\x00', b'']
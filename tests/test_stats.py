@@ -0,0 +1,137 @@
+from fcgiproto.connection import FastCGIConnection
+from fcgiproto.constants import (
+    FCGI_RESPONDER, FCGI_AUTHORIZER, FCGI_STDIN, FCGI_STDOUT, FCGI_END_REQUEST, FCGI_BEGIN_REQUEST,
+    FCGI_STDERR)
+from fcgiproto.records import (
+    FCGIBeginRequest, FCGIParams, FCGIStdin, FCGIAbortRequest, FCGIGetValues)
+from fcgiproto.stats import (
+    StatsRegistry, ConnectionStats, RECORDS_RECEIVED, BYTES_RECEIVED, RECORDS_SENT, BYTES_SENT,
+    EVENTS, REQUESTS_STARTED, REQUESTS_COMPLETED, REQUESTS_ABORTED, REQUESTS_REJECTED,
+    GET_VALUES_QUERIES, PEAK_INPUT_BUFFER, PEAK_UNACKNOWLEDGED, PEAK_OUTPUT_BUFFER,
+    RequestTimeline, TimelineHistogram)
+
+
+def test_connection_counters():
+    stats = ConnectionStats()
+    conn = FastCGIConnection(stats=stats)
+    data = (FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + FCGIParams(1, b'').encode() +
+            FCGIStdin(1, b'abcd').encode() + FCGIStdin(1, b'').encode())
+    conn.feed_data(data[:-3])
+    conn.feed_data(data[-3:])
+    conn.send_stderr(1, b'x' * 2000)
+    conn.send_headers(1, [])
+    conn.send_data(1, b'y' * 70000, end_request=True)
+    output_size = conn.pending_bytes
+    assert len(conn.data_to_send()) == output_size
+
+    assert stats[RECORDS_RECEIVED + FCGI_BEGIN_REQUEST] == 1
+    assert stats[RECORDS_RECEIVED + FCGI_STDIN] == 2
+    assert stats[BYTES_RECEIVED + FCGI_STDIN] == 20
+    assert stats[RECORDS_SENT + FCGI_STDERR] == 2
+    assert stats[RECORDS_SENT + FCGI_STDOUT] == 4
+    assert stats[BYTES_SENT + FCGI_STDOUT] == 70002 + 4 * 8
+    assert stats[RECORDS_SENT + FCGI_END_REQUEST] == 1
+    assert sum(stats[BYTES_SENT + record_type] for record_type in range(12)) == output_size
+    assert stats[EVENTS] == 3
+    assert stats[REQUESTS_STARTED] == 1
+    assert stats[REQUESTS_COMPLETED] == 1
+    assert stats[PEAK_INPUT_BUFFER] == 5
+    assert stats[PEAK_UNACKNOWLEDGED] == 4
+    assert stats[PEAK_OUTPUT_BUFFER] == output_size
+
+
+def test_request_outcomes():
+    stats = ConnectionStats()
+    conn = FastCGIConnection(stats=stats)
+    conn.feed_data(FCGIBeginRequest(1, FCGI_AUTHORIZER, 0).encode() +
+                   FCGIBeginRequest(2, FCGI_RESPONDER, 0).encode() + FCGIAbortRequest(2).encode() +
+                   FCGIGetValues(['FCGI_MPXS_CONNS']).encode() +
+                   b'\x01\x0c\x00\x00\x00\x00\x00\x00')
+    conn.end_request(2)
+    assert stats[REQUESTS_STARTED] == 1
+    assert stats[REQUESTS_REJECTED] == 1
+    assert stats[REQUESTS_ABORTED] == 1
+    assert stats[REQUESTS_COMPLETED] == 1
+    assert stats[GET_VALUES_QUERIES] == 1
+    assert stats[RECORDS_RECEIVED] == 1  # the record of an unknown type
+
+
+def test_registry():
+    registry = StatsRegistry()
+    conn1 = FastCGIConnection(stats=registry.connection_stats())
+    conn2 = FastCGIConnection(stats=registry.connection_stats())
+    conn1.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + b'\x01')
+    conn2.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() +
+                    FCGIBeginRequest(2, FCGI_RESPONDER, 0).encode())
+    conn1.close()
+
+    totals = registry.totals()
+    assert totals[REQUESTS_STARTED] == 3
+    assert totals[PEAK_INPUT_BUFFER] == 1
+
+    text = registry.export_prometheus()
+    assert '# TYPE fcgiproto_records_received_total counter\n' in text
+    assert 'fcgiproto_records_received_total{type="FCGI_BEGIN_REQUEST"} 3\n' in text
+    assert 'fcgiproto_requests_started_total 3\n' in text
+    assert '# TYPE fcgiproto_peak_input_buffer_bytes gauge\n' in text
+    assert 'fcgiproto_connections_total 2\n' in text
+    assert 'fcgiproto_connections_open 1\n' in text
+
+
+def test_request_timeline():
+    timelines = []
+    histogram = TimelineHistogram(buckets=(0.5, 10))
+
+    def callback(request_id, timeline):
+        timelines.append((request_id, timeline))
+        histogram(request_id, timeline)
+
+    conn = FastCGIConnection(roles=[FCGI_RESPONDER], timeline_callback=callback)
+    conn.feed_data(FCGIBeginRequest(1, FCGI_RESPONDER, 0).encode() + FCGIParams(1, b'').encode() +
+                   FCGIBeginRequest(2, FCGI_AUTHORIZER, 0).encode() +
+                   FCGIBeginRequest(3, FCGI_RESPONDER, 0).encode() + FCGIAbortRequest(3).encode())
+    conn.feed_data(FCGIStdin(1, b'abcd').encode() + FCGIStdin(1, b'').encode())
+    conn.send_headers(1, [])
+    conn.send_data(1, b'body', end_request=True)
+    conn.end_request(3)
+
+    assert [request_id for request_id, timeline in timelines] == [1, 3]
+    timeline = timelines[0][1]
+    assert (timeline.begin <= timeline.params_end <= timeline.stdin_end <=
+            timeline.first_stdout <= timeline.end)
+    assert [phase for phase, duration in timeline.phases()] == [
+        'params', 'stdin', 'application', 'output', 'total']
+    assert all(duration >= 0 for phase, duration in timeline.phases())
+
+    aborted = timelines[1][1]
+    assert aborted.params_end is aborted.first_stdout is None
+    assert aborted.end >= aborted.begin
+    assert dict(aborted.phases()) == {'params': None, 'stdin': None, 'application': None,
+                                      'output': None, 'total': aborted.end - aborted.begin}
+
+    assert histogram.count('total') == 2
+    assert histogram.count('application') == 1
+    text = histogram.export_prometheus()
+    assert '# TYPE fcgiproto_request_phase_seconds histogram\n' in text
+    assert 'fcgiproto_request_phase_seconds_bucket{phase="total",le="0.5"} 2\n' in text
+    assert 'fcgiproto_request_phase_seconds_bucket{phase="total",le="+Inf"} 2\n' in text
+    assert 'fcgiproto_request_phase_seconds_count{phase="stdin"} 1\n' in text
+
+
+def test_timeline_histogram_buckets():
+    histogram = TimelineHistogram(buckets=(1, 2))
+    timeline = RequestTimeline(10)
+    timeline.params_end = 10.5
+    timeline.stdin_end = 12
+    timeline.first_stdout = 15
+    timeline.end = 15
+    histogram.add(timeline)
+
+    text = histogram.export_prometheus('app')
+    assert 'app_request_phase_seconds_bucket{phase="params",le="1"} 1\n' in text
+    assert 'app_request_phase_seconds_bucket{phase="stdin",le="1"} 0\n' in text
+    assert 'app_request_phase_seconds_bucket{phase="stdin",le="2"} 1\n' in text
+    assert 'app_request_phase_seconds_bucket{phase="application",le="2"} 0\n' in text
+    assert 'app_request_phase_seconds_bucket{phase="application",le="+Inf"} 1\n' in text
+    assert 'app_request_phase_seconds_bucket{phase="output",le="1"} 1\n' in text
+    assert 'app_request_phase_seconds_sum{phase="total"} 5.0\n' in text
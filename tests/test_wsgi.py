@@ -0,0 +1,121 @@
+import threading
+
+import pytest
+
+from fcgiproto.constants import FCGI_KEEP_CONN
+from fcgiproto.records import FCGIStdin, FCGIStderr
+from fcgiproto.wsgi import WSGIGateway
+
+from asyncio_helpers import begin_request, read_records, run_server, stdout_data
+
+
+@pytest.fixture
+def gateway_factory():
+    gateways = []
+
+    def create(app, **kwargs):
+        gateway = WSGIGateway(app, **kwargs)
+        gateways.append(gateway)
+        return gateway
+
+    yield create
+    for gateway in gateways:
+        gateway.executor.shutdown()
+
+
+def test_environ(loop, gateway_factory):
+    def app(environ, start_response):
+        environs.append(environ)
+        start_response('204 No Content', [])
+        return []
+
+    async def client(reader, writer):
+        writer.write(begin_request(params=[
+            ('REQUEST_METHOD', 'POST'), ('PATH_INFO', b'/f\xc3\xb6\xc3\xb6'), ('HTTPS', 'on'),
+            ('HTTP_X_FOO', 'bar')
+        ]) + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    environs = []
+    records = run_server(loop, gateway_factory(app), client)
+    assert stdout_data(records) == b'Status: 204 No Content\r\n\r\n'
+    environ = environs[0]
+    assert environ['REQUEST_METHOD'] == 'POST'
+    assert environ['PATH_INFO'] == '/f\xc3\xb6\xc3\xb6'
+    assert environ['HTTP_X_FOO'] == 'bar'
+    assert environ['QUERY_STRING'] == ''
+    assert environ['wsgi.url_scheme'] == 'https'
+    assert environ['wsgi.multithread']
+
+
+def test_streaming(loop, gateway_factory):
+    def app(environ, start_response):
+        environ['wsgi.errors'].write('reading\n')
+        lines = environ['wsgi.input'].readlines()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        for line in lines:
+            yield line.upper()
+
+    async def client(reader, writer):
+        writer.write(begin_request(flags=FCGI_KEEP_CONN) + FCGIStdin(1, b'hello\nwor').encode())
+        writer.write(FCGIStdin(1, b'ld\n!').encode() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, gateway_factory(app), client)
+    assert stdout_data(records) == \
+        b'Status: 200 OK\r\nContent-Type: text/plain\r\n\r\nHELLO\nWORLD\n!'
+    assert [record.content for record in records if isinstance(record, FCGIStderr)] == \
+        [b'reading\n', b'']
+
+
+def test_read_sizes(loop, gateway_factory):
+    def app(environ, start_response):
+        wsgi_input = environ['wsgi.input']
+        parts = [wsgi_input.read(3), wsgi_input.readline(2), wsgi_input.readline(),
+                 wsgi_input.read(), wsgi_input.read(1)]
+        start_response('200 OK', [])
+        return [repr(parts).encode('ascii')]
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'abcdef\nghi').encode() +
+                     FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, gateway_factory(app), client)
+    assert stdout_data(records) == \
+        b"Status: 200 OK\r\n\r\n[b'abc', b'de', b'f\\n', b'ghi', b'']"
+
+
+def test_concurrent_requests(loop, gateway_factory):
+    def app(environ, start_response):
+        if environ['NUMBER'] == '1':
+            # This only completes if request 2 is processed concurrently
+            assert event.wait(5)
+        else:
+            event.set()
+
+        start_response('200 OK', [])
+        return [environ['NUMBER'].encode('ascii')]
+
+    async def client(reader, writer):
+        writer.write(begin_request(1, FCGI_KEEP_CONN, params=[('NUMBER', '1')]) +
+                     begin_request(2, FCGI_KEEP_CONN, params=[('NUMBER', '2')]) +
+                     FCGIStdin(1, b'').encode() + FCGIStdin(2, b'').encode())
+        return await read_records(reader, (1, 2))
+
+    event = threading.Event()
+    records = run_server(loop, gateway_factory(app, max_workers=2), client)
+    assert stdout_data(records, 1) == b'Status: 200 OK\r\n\r\n1'
+    assert stdout_data(records, 2) == b'Status: 200 OK\r\n\r\n2'
+
+
+def test_application_error(loop, gateway_factory):
+    def app(environ, start_response):
+        raise Exception('foo')
+
+    async def client(reader, writer):
+        writer.write(begin_request() + FCGIStdin(1, b'data').encode() + FCGIStdin(1, b'').encode())
+        return await read_records(reader)
+
+    records = run_server(loop, gateway_factory(app), client)
+    assert stdout_data(records).startswith(b'Status: 500\r\n')